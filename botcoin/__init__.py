@@ -1,4 +1,6 @@
-from . backtest.engine import BacktestEngine
+from . backtest.engine import BacktestEngine, VectorBacktestEngine, GridBacktestEngine
+from . backtest.search import ParameterSearch
+from . backtest.walkforward import WalkForward
 from . common.data import BarError
 from . common.strategy import Strategy
 from . live.engine import LiveEngine
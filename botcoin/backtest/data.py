@@ -1,31 +1,154 @@
-from botcoin.common.data import MarketData, Bars
+from datetime import timedelta
+import logging
+
+import numpy as np
+
+from botcoin import settings
+from botcoin.common.data import MarketData, Bars, BarError
 from botcoin.common.events import MarketEvent
+from botcoin.common.indicators import RollingWindows, compute_indicator
+from botcoin.common.panel import OPEN, HIGH, LOW, CLOSE
+from botcoin.utils import _round
 
 class BacktestMarketData(MarketData):
 
     def __init__(self, csv_dir, symbol_list, normalize_prices, normalize_volume,
-                 round_decimals, date_from='', date_to=''):
-
-        super(BacktestMarketData, self).__init__(csv_dir,symbol_list, normalize_prices, normalize_volume, round_decimals)
-
-        for s in symbol_list:
-            # Limit between date_From and date_to
-            self._data[s]['df'] = self._data[s]['df'][date_from:] if date_from else self._data[s]['df']
-            self._data[s]['df'] = self._data[s]['df'][:date_to] if date_to else self._data[s]['df']
-
-            # Check for empty dfs
-            if self._data[s]['df'].empty:
-                logging.warning("Empty DataFrame loaded for {}.".format(filename)) # Possibly invalid date ranges?
-
-            # Dataframe iterrows  generator
-            self._data[s]['bars'] = self._data[s]['df'].iterrows()
-
-            # List that will hold all rows from iterrows, one at a time
-            self._data[s]['latest_bars'] = []
+                 round_decimals, date_from='', date_to='', data_cache=settings.DATA_CACHE,
+                 load_workers=settings.LOAD_WORKERS, max_lookback=settings.MAX_LOOKBACK,
+                 batch_events=settings.BATCH_EVENTS):
+
+        super(BacktestMarketData, self).__init__(csv_dir,symbol_list, normalize_prices, normalize_volume, round_decimals,
+                                                 data_cache, load_workers, max_lookback)
+        self._initialize_backtest(date_from, date_to, batch_events)
+
+    @classmethod
+    def attach(cls, handle, date_from='', date_to='', max_lookback=settings.MAX_LOOKBACK,
+               batch_events=settings.BATCH_EVENTS):
+        market = super(BacktestMarketData, cls).attach(handle, max_lookback)
+        market._initialize_backtest(date_from, date_to, batch_events)
+        return market
+
+    def slice(self, date_from=None, date_to=None, history=None):
+        """ Returns a new market, not backtested yet, over this market's bars
+        between date_from and date_to, by default the same as this market's.
+        Up to history bars before date_from, by default as many as this market
+        has, are only history strategies can look back on and aren't backtested.
+        Values are shared instead of copied. """
+        market = self.__class__.__new__(self.__class__)
+        market._panel = self._panel
+        MarketData._initialize(market, self.max_lookback)
+        market._initialize_backtest(self.date_from if date_from is None else date_from, date_to, self.batch_events,
+                                    self._history if history is None else history)
+
+        market.load_time = timedelta(0)
+        return market
+
+    def _initialize_backtest(self, date_from, date_to, batch_events, history=0):
+        """ Sets up backtest state once the panel is loaded or attached. """
+        # One MarketEvent per phase instead of one per symbol
+        self.batch_events = batch_events
+
+        # Limit between date_From and date_to, plus up to history bars before
+        # date_from that are only there to be looked back on
+        panel = self._panel.slice(date_from, date_to)
+        if history and len(panel):
+            first = self._panel.index.get_loc(panel.index[0])
+            history = min(history, first)
+            panel = self._panel.slice(self._panel.index[first - history], date_to)
+        self._panel = panel
+        self._history = history if len(panel) else 0
+
+        # Check for empty panel
+        if not len(self._panel):
+            logging.warning("Empty DataFrame loaded for {}.".format(self.symbol_list)) # Possibly invalid date ranges?
+
+        # Position of today's bar in the panel, everything before it is history
+        self._cursor = self._history - 1
+
+        # History is known upfront, so indicators in Bars can be kept incrementally
+        self._rolling = RollingWindows(self._panel.values)
+        self._rolling.cursor = self._cursor
+
+        # Indicators declared by strategies, name -> (time x symbol) values
+        self._indicators = {}
+        # Today's bar only counts for indicators once the market has closed
+        self._day_closed = False
 
         self.continue_execution = True
-        self.date_from = self._data[self.symbol_list[0]]['df'].index[0]
-        self.date_to = self._data[self.symbol_list[0]]['df'].index[-1]
+        self.date_from = self._panel.index[self._history]
+        self.date_to = self._panel.index[-1]
+
+    def _today(self, i):
+        if self._cursor >= 0:
+            return self.updated_at, self._panel.values[self._cursor, i]
+
+    def _window(self, i, N, include_today):
+        # Today's bar is the row at cursor, so any window is a slice of the panel
+        stop = max(self._cursor + 1 if include_today else self._cursor, 0)
+        start = max(stop - N, 0)
+        return self._panel.datetime_values[start:stop], self._panel.values[start:stop, i]
+
+    def _panel_window(self, N, include_today):
+        stop = max(self._cursor + 1 if include_today else self._cursor, 0)
+        start = max(stop - N, 0)
+        return self._panel.datetime_values[start:stop], self._panel.values[start:stop]
+
+    def precompute_indicators(self, names):
+        """ Computes indicators over the whole history, for all symbols at once. """
+        for name in names:
+            if name not in self._indicators:
+                self._indicators[name] = compute_indicator(self._panel.values, name)
+
+    def indicator(self, symbol, name):
+        """
+        Returns the value of an indicator declared in strategy's INDICATORS, e.g.
+        'sma_20', 'std_20', 'donchian_high_50', 'donchian_low_5' or 'atr_14'.
+        Only completed bars are used: up to yesterday's during the day, and up to
+        today's after the market closes.
+        """
+        if name not in self._indicators:
+            raise ValueError("Indicator {} was not declared in strategy's INDICATORS.".format(name))
+
+        row = self._cursor if self._day_closed else self._cursor - 1
+        value = self._indicators[name][row, self._symbols[symbol]] if row >= 0 else np.nan
+
+        if np.isnan(value):
+            raise BarError("Not enough bars yet.")
+        return _round(value)
+
+    def _next_bar(self):
+        """ Moves the cursor to the next bar and returns its (symbol x field)
+        values, or None when there are no bars left. """
+        if self._cursor + 1 >= len(self._panel):
+            return None
+
+        self._cursor += 1
+        self._rolling.advance()
+        self._day_closed = False
+        self.updated_at = self._panel.datetimes[self._cursor]
+        return self._panel.values[self._cursor]
+
+    def _relay_phase(self, sub_type):
+        """ Relays a phase's MarketEvents, one per symbol or a single one when batched,
+        only to queues subscribed to each symbol. Phases and symbols no strategy
+        handles are skipped altogether. When batched, portfolios follow changes to
+        subscriptions while handling the event, see Portfolio.handle_market_event. """
+        if not self._event_needed(sub_type):
+            return
+
+        if self.batch_events:
+            relayed = False
+            for q in self.events_queue_list:
+                symbols = self._subscribed_symbols(q) if self._needs_event(q, sub_type) else None
+                if symbols:
+                    q.put(MarketEvent(sub_type, symbols=symbols))
+                    relayed = True
+            if relayed:
+                yield
+        else:
+            for s in self.symbol_list:
+                if self._relay_market_event(MarketEvent(sub_type, s)):
+                    yield
 
     def _update_bars(self):
         """
@@ -37,67 +160,42 @@ class BacktestMarketData(MarketData):
                      negative day)
             close - one event per symbol
             after_close - single event
+        With batch_events, open, during and close are a single event carrying
+        all symbols instead.
 
         Before raising MarketEvents, all prices need to be updated to maintain
         consistency otherwise portfolio_value will be calculated based on open price
         and it will influence position size calculation
         """
 
-        try:
-            # Before day starts, adding bars from yesterday to 'latest_bars'
-            for s in self.symbol_list:
-                if self._todays_bar(s):
-                    self._data[s]['latest_bars'].append(self._todays_bar(s))
-
-            for s in self.symbol_list:
-                new_row = next(self._data[s]['bars'])
-
-                self._data[s]['updated_at'] = new_row[0]
-                self._data[s]['open'] = new_row[1][0]
-                self._data[s]['high'] = new_row[1][1]
-                self._data[s]['low'] = new_row[1][2]
-                self._data[s]['close'] = new_row[1][3]
-                self._data[s]['volume'] = new_row[1][4]
-
-            self.updated_at = new_row[0]
+        # Before day starts, moving cursor makes yesterday's bar part of history
+        today = self._next_bar()
+        if today is None:
+            self.continue_execution = False
+            return
 
-            # Before open
-            self._relay_market_event(MarketEvent('before_open'))
-            yield
+        # Before open
+        self._relay_market_event(MarketEvent('before_open'))
+        yield
 
-            # On open - open = latest_bars[-1][1]
-            for s in self.symbol_list:
-                self._data[s]['last_price'] = self._data[s]['open']
-            for s in self.symbol_list:
-                self._relay_market_event(MarketEvent('open', s))
-                yield
+        # On open
+        self._set_last_prices(today[:, OPEN])
+        yield from self._relay_phase('open')
 
-            # During #1
-            for s in self.symbol_list:
-                d = self._data[s]
-                self._data[s]['last_price'] = d['low'] if d['close']>d['open'] else d['high']
-            for s in self.symbol_list:
-                self._relay_market_event(MarketEvent('during', s))
-                yield
+        # During #1
+        positive = today[:, CLOSE] > today[:, OPEN]
+        self._set_last_prices(np.where(positive, today[:, LOW], today[:, HIGH]))
+        yield from self._relay_phase('during')
 
-            # During #2
-            for s in self.symbol_list:
-                d = self._data[s]
-                self._data[s]['last_price'] = d['high'] if d['close']>d['open'] else d['low']
-            for s in self.symbol_list:
-                self._relay_market_event(MarketEvent('during', s))
-                yield
+        # During #2
+        self._set_last_prices(np.where(positive, today[:, HIGH], today[:, LOW]))
+        yield from self._relay_phase('during')
 
-            # On close
-            for s in self.symbol_list:
-                self._data[s]['last_price'] = self._data[s]['close']
-            for s in self.symbol_list:
-                self._relay_market_event(MarketEvent('close', s))
-                yield
-
-            # After close, last_price will still be close
-            self._relay_market_event(MarketEvent('after_close'))
-            yield
+        # On close
+        self._set_last_prices(today[:, CLOSE])
+        yield from self._relay_phase('close')
 
-        except StopIteration:
-            self.continue_execution = False
+        # After close, last_price will still be close
+        self._day_closed = True
+        self._relay_market_event(MarketEvent('after_close'))
+        yield
@@ -1,36 +1,52 @@
 import collections
 from datetime import timedelta, datetime
 import logging
+import multiprocessing
 
+import numpy as np
 import pandas as pd
 
 from botcoin import settings
 from botcoin.backtest.data import BacktestMarketData
 from botcoin.common.strategy import Strategy
-from botcoin.backtest.portfolio import BacktestPortfolio
+from botcoin.backtest.portfolio import BacktestPortfolio, VectorPortfolio, GridPortfolio, GridMember
 
 
 class BacktestEngine(object):
-    def __init__(self, strategies, data_dir, start_automatically=True):
+    portfolio_class = BacktestPortfolio
+
+    # Portfolio attributes backtests in other processes send back, if portfolio has them
+    POOL_RESULTS = ('performance', 'all_trades', 'all_holdings', 'ledger')
+
+    def __init__(self, strategies, data_dir, start_automatically=True, market=None):
+        """ Backtests strategies, each in its own portfolio. Settings of the whole
+        backtest (BACKTEST_WORKERS, PRUNE_PERCENTILE and PRUNE_EVERY_BARS) are
+        taken from strategies[0], as market settings are in load_market. """
 
         if not strategies:
             raise ValueError("Empty strategies list in your algo file.")
 
-        # Single market object will be used for all backtesting instances
-        self.market = BacktestMarketData(
-            data_dir, #should come from script loader
-            strategies[0].SYMBOL_LIST,
-            date_from = getattr(strategies[0], 'DATE_FROM', datetime.now() - timedelta(weeks=52)),
-            date_to = getattr(strategies[0], 'DATE_TO', datetime.now()),
-            normalize_prices = getattr(strategies[0], 'NORMALIZE_PRICES', settings.NORMALIZE_PRICES),
-            normalize_volume = getattr(strategies[0], 'NORMALIZE_VOLUME', settings.NORMALIZE_VOLUME),
-            round_decimals = getattr(strategies[0], 'ROUND_DECIMALS', settings.ROUND_DECIMALS),
-        )
+        # Single market object will be used for all backtesting instances. Bars
+        # already loaded (e.g. another engine's market) are backtested again
+        # from a fresh slice of them instead of reading csvs
+        self.market = market.slice() if market is not None else self.load_market(strategies, data_dir)
+
+        # Indicators declared by any strategy are computed once for all of them
+        self.market.precompute_indicators(set(
+            name for strategy in strategies for name in getattr(strategy, 'INDICATORS', [])
+        ))
+
+        # Number of processes portfolios are split between when backtesting
+        self.backtest_workers = getattr(strategies[0], 'BACKTEST_WORKERS', settings.BACKTEST_WORKERS)
+
+        # Portfolios ranking below this percentile of their peers stop being backtested
+        self.prune_percentile = getattr(strategies[0], 'PRUNE_PERCENTILE', settings.PRUNE_PERCENTILE)
+        self.prune_every_bars = getattr(strategies[0], 'PRUNE_EVERY_BARS', settings.PRUNE_EVERY_BARS)
 
         self.portfolios = []
 
         for strategy in strategies:
-            port = BacktestPortfolio(self.market, strategy)
+            port = self.portfolio_class(self.market, strategy)
             self.portfolios.append(port)
 
         logging.info("Backtesting {} {} with {} symbols from {} to {}".format(
@@ -46,6 +62,25 @@ class BacktestEngine(object):
             self.start()
             self.calc_performance()
 
+    @classmethod
+    def load_market(cls, strategies, data_dir):
+        """ Loads market data for strategies, with settings from strategies[0]. """
+        return BacktestMarketData(
+            data_dir, #should come from script loader
+            strategies[0].SYMBOL_LIST,
+            date_from = getattr(strategies[0], 'DATE_FROM', datetime.now() - timedelta(weeks=52)),
+            date_to = getattr(strategies[0], 'DATE_TO', datetime.now()),
+            normalize_prices = getattr(strategies[0], 'NORMALIZE_PRICES', settings.NORMALIZE_PRICES),
+            normalize_volume = getattr(strategies[0], 'NORMALIZE_VOLUME', settings.NORMALIZE_VOLUME),
+            round_decimals = getattr(strategies[0], 'ROUND_DECIMALS', settings.ROUND_DECIMALS),
+            data_cache = getattr(strategies[0], 'DATA_CACHE', settings.DATA_CACHE),
+            load_workers = getattr(strategies[0], 'LOAD_WORKERS', settings.LOAD_WORKERS),
+            batch_events = getattr(strategies[0], 'BATCH_EVENTS', settings.BATCH_EVENTS),
+            # Shared market needs to fit the longest lookback, unlimited if any strategy is
+            max_lookback = min(getattr(s, 'MAX_LOOKBACK', settings.MAX_LOOKBACK) for s in strategies) and \
+                           max(getattr(s, 'MAX_LOOKBACK', settings.MAX_LOOKBACK) for s in strategies),
+        )
+
     def start(self):
         """
         Starts backtesting for all portfolios created.
@@ -53,18 +88,93 @@ class BacktestEngine(object):
         to run simultaneously with a single market object
         """
         start_time = datetime.now()
-        while self.market.continue_execution:
-            for _ in self.market._update_bars():
-                [portfolio.run_cycle() for portfolio in self.portfolios]
 
-        [portfolio.update_last_positions_and_holdings() for portfolio in self.portfolios]
+        workers = min(self.backtest_workers, len(self.portfolios))
+        if workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            logging.warning("Parallel backtests need fork, running {} portfolios in a single process.".format(len(self.portfolios)))
+            workers = 1
+        elif workers > 1 and multiprocessing.current_process().daemon:
+            # e.g. engines run by a walk forward in forked processes, which can't fork again
+            workers = 1
+        elif workers > 1 and self.prune_percentile and self.prune_every_bars:
+            # Peers would only be the portfolios in the same process, so which ones
+            # survive would depend on the number of workers
+            logging.warning("Percentile pruning ranks all portfolios together, running {} portfolios in a single process.".format(len(self.portfolios)))
+            workers = 1
+
+        if workers > 1:
+            self._run_in_pool(workers)
+        else:
+            self._run(self.portfolios)
 
         logging.info("Backtest took " + str((datetime.now()-start_time)))
 
+    def _run(self, portfolios):
+        """ Runs portfolios in lockstep over the whole market, dropping the
+        ones pruned at the end of each day. """
+        self.market.events_queue_list = [portfolio.events_queue for portfolio in portfolios]
+
+        bars = 0
+        while self.market.continue_execution and portfolios:
+            for _ in self.market._update_bars():
+                [portfolio.run_cycle() for portfolio in portfolios]
+
+            if self.market.continue_execution:
+                bars += 1
+                portfolios = self._prune(portfolios, bars)
+
+        [portfolio.update_last_positions_and_holdings() for portfolio in portfolios]
+
+    def _prune(self, portfolios, bars):
+        """
+        Truncates portfolios whose total is below prune_percentile of the ones
+        still running, every prune_every_bars bars. Portfolios truncated by
+        this or by their own rules are closed as of today and no longer get
+        market events. Returns portfolios still running.
+        """
+        if self.prune_percentile and self.prune_every_bars and bars % self.prune_every_bars == 0:
+            totals = np.array([portfolio.holdings['total'] for portfolio in portfolios])
+            threshold = np.percentile(totals, self.prune_percentile)
+            for portfolio, total in zip(portfolios, totals):
+                if total < threshold:
+                    portfolio.truncate("total below percentile {} of peers".format(self.prune_percentile))
+
+        truncated = [portfolio for portfolio in portfolios if portfolio.truncated_at is not None]
+        if not truncated:
+            return portfolios
+
+        [portfolio.update_last_positions_and_holdings() for portfolio in truncated]
+        portfolios = [portfolio for portfolio in portfolios if portfolio.truncated_at is None]
+        self.market.events_queue_list = [portfolio.events_queue for portfolio in portfolios]
+        return portfolios
+
+    def _run_in_pool(self, workers):
+        """
+        Splits portfolios between forked processes, which inherit the market
+        already loaded instead of reading csvs again. Each process backtests
+        its share of portfolios and returns their performance, trades,
+        holdings and ledger (POOL_RESULTS) to be set on portfolios here.
+        """
+        global _pool_engine
+        _pool_engine = self
+
+        shards = [list(range(len(self.portfolios)))[w::workers] for w in range(workers)]
+        try:
+            # A fresh process per shard, forked while the market is still untouched
+            with multiprocessing.get_context('fork').Pool(workers, maxtasksperchild=1) as pool:
+                shard_results = pool.map(_run_shard, shards, chunksize=1)
+        finally:
+            _pool_engine = None
+
+        for shard, results in zip(shards, shard_results):
+            for i, portfolio_results in zip(shard, results):
+                [setattr(self.portfolios[i], name, value) for name, value in portfolio_results.items()]
+
     def calc_performance(self, order_by='sharpe'):
         start_time = datetime.now()
 
-        [portfolio.calc_performance() for portfolio in self.portfolios]
+        # Portfolios backtested in other processes already have performance
+        [portfolio.calc_performance() for portfolio in self.portfolios if portfolio.performance is None]
 
         # Order engines by sharpe (used for plotting)
         self.portfolios = sorted(self.portfolios, key=lambda x: x.performance[order_by], reverse=True)
@@ -80,6 +190,7 @@ class BacktestEngine(object):
                 portfolio.performance['pct_trades_profit'],
                 portfolio.performance['dangerous'],
                 portfolio.performance['dd_max'],
+                portfolio.performance['truncated'],
             ] for portfolio in self.portfolios ],
             columns=[
                 'strategy',
@@ -90,6 +201,7 @@ class BacktestEngine(object):
                 'profit %',
                 'dangerous',
                 'max dd',
+                'truncated',
             ],
         )
 
@@ -126,3 +238,51 @@ class BacktestEngine(object):
 
     def strategy_finishing_methods(self):
         [portfolio.strategy.backtest_done(portfolio.performance) for portfolio in self.portfolios]
+
+
+class VectorBacktestEngine(BacktestEngine):
+    """
+    Backtests strategies that implement signals(), returning entries and exits
+    as boolean arrays over the whole panel, without going through market events,
+    signals, orders and fills. Results have the same performance stats as
+    BacktestEngine's.
+    """
+    portfolio_class = VectorPortfolio
+
+    def _run(self, portfolios):
+        """ Runs portfolios over the whole market panel. """
+        [portfolio.run() for portfolio in portfolios]
+
+
+class GridBacktestEngine(BacktestEngine):
+    """
+    Backtests strategies that implement signals() or grid_signals() like
+    VectorBacktestEngine does, but runs all strategies of the same class and
+    settings (e.g. a parameter sweep) together in a single GridPortfolio.
+    """
+    portfolio_class = GridMember
+
+    def _run(self, portfolios):
+        """ Runs each group of strategies sharing class and settings as one GridPortfolio. """
+        groups = collections.OrderedDict()
+        for portfolio in portfolios:
+            key = (type(portfolio.strategy), tuple(sorted(portfolio.settings_dict.items())))
+            groups.setdefault(key, []).append(portfolio)
+
+        for members in groups.values():
+            grid = GridPortfolio(self.market, [member.strategy for member in members])
+            grid.run()
+            for k, member in enumerate(members):
+                member.all_holdings, member.all_trades = grid.holdings(k), grid.trades(k)
+
+
+# Engine being backtested by a process pool, inherited by forked workers
+_pool_engine = None
+
+def _run_shard(indices):
+    """ Backtests portfolios at indices of _pool_engine, in a forked worker. """
+    portfolios = [_pool_engine.portfolios[i] for i in indices]
+    _pool_engine._run(portfolios)
+    [portfolio.calc_performance() for portfolio in portfolios]
+    return [{name: getattr(portfolio, name) for name in _pool_engine.POOL_RESULTS if hasattr(portfolio, name)}
+            for portfolio in portfolios]
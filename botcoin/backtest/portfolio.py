@@ -1,22 +1,123 @@
+import logging
 from math import fsum
+
 import numpy as np
+import pandas as pd
 
-from botcoin.common.events import FillEvent
+from botcoin import utils
+from botcoin.common import performance
+from botcoin.common.events import EventQueue, FillEvent
+from botcoin.common.holdings import HoldingsRecorder
+from botcoin.common.panel import CLOSE
 from botcoin.common.portfolio import Portfolio
+from botcoin.common.risk import RiskAnalysis
 from botcoin.common.trade import Trade
 
+class _RunningSum(object):
+    """
+    Exact sum of floats added one at a time, kept as non-overlapping partials
+    (Shewchuk's algorithm, which math.fsum uses). Values can be taken out by
+    adding their negation, and value() is rounded the same as math.fsum of
+    every value still in it, so running totals don't drift.
+    """
+    __slots__ = ('partials',)
+
+    def __init__(self):
+        self.partials = []
+
+    def add(self, x):
+        partials = self.partials
+        i = 0
+        for y in partials:
+            if abs(x) < abs(y):
+                x, y = y, x
+            hi = x + y
+            lo = y - (hi - x)
+            if lo:
+                partials[i] = lo
+                i += 1
+            x = hi
+        partials[i:] = [x]
+
+    def value(self):
+        return fsum(self.partials)
+
+
 class BacktestPortfolio(Portfolio):
+    # Backtests run in a single thread, no need for locking
+    events_queue_class = EventQueue
+
+    # Columns of each fill in ledger
+    LEDGER_COLUMNS = ['datetime', 'symbol', 'direction', 'quantity', 'price', 'commission']
+
+    def __init__(self, market, strategy):
+        super(BacktestPortfolio, self).__init__(market, strategy)
+
+        # Every fill, as a tuple of LEDGER_COLUMNS
+        self.ledger = []
+
+        # Estimated cost of buy orders not filled yet, symbol -> cost
+        self._pending_costs = {}
+        # Market value of open trades, kept as a running sum of each held
+        # symbol's quantity * last price. Fills replace their symbol's value
+        # and the first query after a price phase updates held symbols' ones
+        self._position_values = {}
+        self._market_value = _RunningSum()
+        self._market_value_version = market.price_version
+
+        # Highest total so far, for PRUNE_MAX_DRAWDOWN
+        self._high_water_mark = self.INITIAL_CAPITAL
+
+        # One holding per bar
+        self.all_holdings.reserve(len(market._panel))
 
     def cash_balance(self):
         # Pending orders that remove cash from account
-        money_held = fsum([t.estimated_cost for t in self.open_trades.values() if t.direction in ('BUY','COVER') and not t.open_is_fully_filled])
+        money_held = fsum(self._pending_costs.values())
+
+        if self.CHECK_MARK_TO_MARKET:
+            self._check_mark_to_market('Cash held', money_held, fsum([
+                t.estimated_cost for t in self.open_trades.values() if t.direction in ('BUY','COVER') and not t.open_is_fully_filled]))
+
         return self.holdings['cash'] - money_held
 
     def net_liquidation(self):
-        market_value = fsum([self.open_trades[s].open_filled_quantity * self.market.last_price(s) for s in self.open_trades])
+        if self._market_value_version != self.market.price_version:
+            for symbol in self._position_values:
+                self._update_position_value(symbol)
+            self._market_value_version = self.market.price_version
+
+        market_value = self._market_value.value()
+        if self.CHECK_MARK_TO_MARKET:
+            self._check_mark_to_market('Market value', market_value, self._calc_market_value())
 
         return self.holdings['cash'] + market_value
 
+    def _update_position_value(self, symbol):
+        """ Replaces symbol's value in the running market value with the one
+        at its last price, or removes it if symbol is no longer held. """
+        old = self._position_values.get(symbol, 0.0)
+        if symbol in self.open_trades:
+            new = self.open_trades[symbol].open_filled_quantity * self.market.last_price(symbol)
+            self._position_values[symbol] = new
+        else:
+            new = 0.0
+            self._position_values.pop(symbol, None)
+
+        if new != old:
+            if old:
+                self._market_value.add(-old)
+            if new:
+                self._market_value.add(new)
+
+    def _calc_market_value(self):
+        return fsum([self.open_trades[s].open_filled_quantity * self.market.last_price(s) for s in self.open_trades])
+
+    def _check_mark_to_market(self, name, kept, recomputed):
+        if kept != recomputed:
+            logging.critical('{} kept by portfolio is {}, but should be {}.'.format(name, kept, recomputed))
+            raise AssertionError("Inconsistency in Portfolio mark to market")
+
     def check_signal_consistency(self, symbol, exec_price, direction):
         """ Looks for consistency errors common during backtesting, such as
          execution price outside low-high range. """
@@ -36,9 +137,15 @@ class BacktestPortfolio(Portfolio):
                 self.strategy, self.market.updated_at, symbol, exec_price
             ))
 
-    def execute_order(self, order):
+    def place_order(self, order):
+        # Fills are known straight away, no need to go through events_queue
+        self.execute_order(order, inline=True)
+
+    def execute_order(self, order, inline=False):
         if order.direction in ('BUY', 'SHORT'):
             self.open_trades[order.symbol] = Trade(order)  # Start trade
+            if order.direction == 'BUY':
+                self._pending_costs[order.symbol] = order.estimated_cost
         else:
             # Checks if there is a similar order in pending_orders to protect
             # against repeated signals coming from strategy
@@ -52,6 +159,15 @@ class BacktestPortfolio(Portfolio):
         # in case I mess up and remove abs() again
         assert(commission>=0)
 
+        if inline:
+            # Fake fill applied straight away, at market time
+            filled_at = self.market.updated_at
+            if order.direction in ('BUY', 'SHORT'):
+                self.open_trades[order.symbol].opened_at = filled_at
+            self.ledger.append((filled_at, order.symbol, order.direction, order.quantity, order.limit_price, commission))
+            self.apply_fill(order.symbol, order.direction, order.quantity, order.limit_price, commission, filled_at)
+            return
+
         # Fake fill
         fill_event = FillEvent(
             order.symbol,
@@ -63,6 +179,31 @@ class BacktestPortfolio(Portfolio):
 
         self.events_queue.put(fill_event)
 
+    def apply_fill(self, symbol, direction, quantity, price, commission, filled_at):
+        super(BacktestPortfolio, self).apply_fill(symbol, direction, quantity, price, commission, filled_at)
+        self._update_position_value(symbol)
+
+        if symbol in self._pending_costs and (symbol not in self.open_trades or self.open_trades[symbol].open_is_fully_filled):
+            del self._pending_costs[symbol]
+
+    def market_closed(self):
+        super(BacktestPortfolio, self).market_closed()
+
+        # Pruning rules, once any of them is hit the engine stops backtesting this portfolio
+        total = self.holdings['total']
+        self._high_water_mark = max(self._high_water_mark, total)
+
+        if self.PRUNE_MAX_DRAWDOWN and total < self._high_water_mark * (1 - self.PRUNE_MAX_DRAWDOWN):
+            self.truncate("drawdown above {:.0%}".format(self.PRUNE_MAX_DRAWDOWN))
+        elif self.PRUNE_MIN_EQUITY and total < self.INITIAL_CAPITAL * self.PRUNE_MIN_EQUITY:
+            self.truncate("total below {:.0%} of initial capital".format(self.PRUNE_MIN_EQUITY))
+
+    def truncate(self, reason):
+        """ Flags portfolio to stop being backtested, keeping its results up to today. """
+        if self.truncated_at is None:
+            logging.info("Pruning {} on {}, {}.".format(self.strategy, self.market.updated_at, reason))
+            self.truncated_at = self.market.updated_at
+
     def update_last_positions_and_holdings(self):
         # Adds latest current position and holding into 'all' lists, so they
         # can be part of performance as well
@@ -78,3 +219,439 @@ class BacktestPortfolio(Portfolio):
             trade.fake_close_trade(self.market.updated_at, quantity * self.market.last_price(trade.symbol))
 
             self.all_trades.append(trade)
+
+
+class VectorPortfolio(object):
+    """
+    Portfolio for strategies that implement signals(), used by
+    VectorBacktestEngine. Entries and exits come as boolean arrays for the
+    whole backtest, and are executed on the close of the bar they're raised
+    on, in symbol_list order, with the same sizing, commission and slippage
+    rules (RiskAnalysis) as BacktestPortfolio. Only long trades are supported.
+    """
+    def __init__(self, market, strategy):
+
+        self.all_holdings = None
+        self.all_trades = []
+        self.performance = None
+
+        self.market = market
+        self.strategy = strategy
+
+        self.settings_dict = utils._grab_settings_from_strategy(strategy)
+
+        # Grabbing config from strategy
+        [setattr(self, key, val) for key, val in self.settings_dict.items()]
+
+        self.risk = RiskAnalysis(self.settings_dict, self.cash_balance, self.net_liquidation)
+
+        # Setting attributes in strategy
+        self.strategy.market = self.market
+        self.strategy.risk = self.risk
+
+        # Open quantity of each symbol, cash and commission paid so far
+        self._quantity = np.zeros(len(market.symbol_list))
+        self._cash = self.INITIAL_CAPITAL
+        self._commission = 0.0
+        self._prices = None
+
+    def cash_balance(self):
+        return self._cash
+
+    def net_liquidation(self):
+        held = np.flatnonzero(self._quantity)
+        return self._cash + fsum(self._quantity[held] * self._prices[held])
+
+    def _positions(self, signals):
+        """ Turns strategy's entries and exits into +1 (buy) and -1 (sell)
+        orders, the same way Strategy.buy only works when neutral and
+        Strategy.sell only when long. Exits win when both are raised. Signals
+        on the market's history bars are ignored. """
+        close = self.market._panel.values[:, :, CLOSE]
+
+        entries, exits = (np.asarray(a, dtype=bool) for a in signals)
+        if entries.shape != close.shape or exits.shape != close.shape:
+            raise ValueError("Strategy signals need to be (time x symbol) arrays of shape {}.".format(close.shape))
+
+        h = self.market._history
+        entries, exits, close = entries[h:], exits[h:], close[h:]
+
+        # Bars without prices can't be traded
+        tradable = close > 0.0
+        status = np.where(exits & tradable, 0.0, np.where(entries & tradable, 1.0, np.nan))
+        status = pd.DataFrame(status).ffill().fillna(0.0).values
+
+        return np.diff(status, axis=0, prepend=0.0)
+
+    def run(self):
+        """ Executes orders on the bars that have any, then builds holdings of
+        every bar from cash and quantities held after each of those bars. """
+        panel = self.market._panel
+        orders = self._positions(self.strategy.signals(panel))
+
+        # Signals are computed over history bars too, but only bars after them are backtested
+        h = self.market._history
+        close = panel.values[h:, :, CLOSE]
+        datetimes, index = panel.datetimes[h:], panel.index[h:]
+
+        # Trades opened, symbol position -> Trade
+        open_trades = {}
+
+        order_rows, order_cols = np.nonzero(orders)
+        rows = np.unique(order_rows)
+        bounds = np.searchsorted(order_rows, rows, side='right')
+
+        # Cash, commission, open trades and quantities after each row's orders
+        cash, commission = np.empty(len(rows)), np.empty(len(rows))
+        open_count = np.empty(len(rows), dtype=int)
+        quantity = np.empty((len(rows), len(self.market.symbol_list)))
+
+        for r, t in enumerate(rows):
+            self._prices = close[t]
+
+            for i in order_cols[bounds[r-1] if r else 0:bounds[r]]:
+                if orders[t, i] > 0:
+                    trade = self._buy(datetimes[t], i, open_trades)
+                    if trade:
+                        open_trades[i] = trade
+                elif i in open_trades:
+                    self._sell(datetimes[t], open_trades.pop(i))
+
+            cash[r], commission[r], open_count[r], quantity[r] = \
+                self._cash, self._commission, len(open_trades), self._quantity
+
+        # Position in rows of the last bar with orders up to each bar, and before it
+        bars = np.arange(len(index))
+        after = np.searchsorted(rows, bars, side='right') - 1
+        before = np.searchsorted(rows, bars, side='left') - 1
+
+        def carried(values, positions, initial):
+            """ Values of the last row at positions, initial before the first one. """
+            if not len(rows):
+                return np.full((len(index),) + values.shape[1:], initial, dtype=values.dtype)
+            valid = (positions >= 0).reshape((-1,) + (1,)*(values.ndim - 1))
+            return np.where(valid, values[np.maximum(positions, 0)], initial)
+
+        # Total is calculated on close, before that bar's orders are executed
+        held = carried(quantity, before, 0.0)
+        held_value = np.where(held != 0, held * close, 0.0)
+        # Summed with fsum, same as BacktestPortfolio, only on bars anything is held
+        market_value = np.zeros(len(index))
+        for t in np.flatnonzero((held != 0).any(axis=1)):
+            market_value[t] = fsum(held_value[t])
+        total = carried(cash, before, float(self.INITIAL_CAPITAL)) + market_value
+        cash = carried(cash, after, float(self.INITIAL_CAPITAL))
+
+        negative = np.flatnonzero((cash < 0) | (total < 0))
+        if len(negative):
+            t = negative[0]
+            raise AssertionError("Cash or total is negative on {}. Cash={}, Total={}".format(
+                datetimes[t], cash[t], total[t]))
+
+        self.all_holdings = HoldingsRecorder.from_frame(pd.DataFrame({
+            'cash': cash,
+            'commission': carried(commission, after, 0.0),
+            'total': total,
+            'open_trades': carried(open_count, before, 0),
+            'subscribed_symbols': len(self.market.symbol_list),
+        }, index=index))
+
+        # "Fake close" trades that are open, so they can be part of trades performance stats
+        for i, trade in open_trades.items():
+            trade.fake_close_trade(datetimes[-1], -trade.quantity * close[-1, i])
+            self.all_trades.append(trade)
+
+    def _buy(self, datetime, i, open_trades):
+        if len(open_trades) >= self.MAX_LONG_POSITIONS:
+            return
+
+        adj_price = self.risk.adjust_price_for_slippage('BUY', self._prices[i])
+        quantity, estimated_commission = self.risk.calculate_quantity_and_commission('BUY', adj_price)
+
+        if quantity < 0:
+            logging.warning(
+                "{} order quantity for {}. Cash balance {}, price {}, round lot size {}. This is a sign of inconsistency in portfolio holdings.".format(
+                quantity, self.strategy, self.cash_balance(), adj_price, self.ROUND_LOT_SIZE,
+            ))
+        if quantity <= 0:
+            return
+
+        trade = VectorTrade(self.market.symbol_list[i], datetime, quantity, adj_price,
+                            self.risk.determine_commission(quantity, adj_price))
+        self._fill(i, quantity, adj_price, trade.open_commission)
+        return trade
+
+    def _sell(self, datetime, trade):
+        i = self.market._symbols[trade.symbol]
+        adj_price = self.risk.adjust_price_for_slippage('SELL', self._prices[i])
+        quantity = -trade.quantity
+
+        trade.close(datetime, adj_price, self.risk.determine_commission(quantity, adj_price))
+        self._fill(i, quantity, adj_price, trade.close_commission)
+        self.all_trades.append(trade)
+
+    def _fill(self, i, quantity, price, commission):
+        self._commission += commission
+        self._cash -= (quantity * price + commission)
+        self._quantity[i] += quantity
+
+    def calc_performance(self):
+        if not self.all_holdings:
+            raise ValueError("Portfolio with empty holdings")
+
+        self.performance = performance.calc_performance(
+            self.all_holdings.frame(), performance.trades_frame(self.all_trades), self.THRESHOLD_DANGEROUS_TRADE)
+        return self.performance
+
+
+class VectorTrade(Trade):
+    """ Trade filled straight away, without going through orders and fills. """
+    def __init__(self, symbol, opened_at, quantity, price, commission):
+        self.symbol = symbol
+        self.direction = 'BUY'
+        self.opened_at = opened_at
+        self.quantity = quantity
+
+        self.open_filled_quantity = quantity
+        self.avg_open_price = price
+        self.open_cost = quantity*price
+        self.open_commission = commission
+
+        self.close_filled_quantity = 0.0
+        self.close_cost = 0.0
+        self.close_commission = 0.0
+
+    def close(self, closed_at, price, commission):
+        self.close_filled_quantity = -self.quantity
+        self.close_cost = -self.quantity*price
+        self.close_commission = commission
+        self.avg_close_price = price
+
+        self.closed_at = closed_at
+        self.pnl = -(self.open_cost + self.close_cost + self.commission)
+
+
+
+class GridPortfolio(object):
+    """
+    Runs many strategies of the same class and settings, usually a parameter
+    sweep, as a single portfolio keeping one set of positions per strategy.
+    Cash is a (strategy) array and quantities and open trades (strategy x
+    symbol) arrays, all updated together on each bar, so a whole sweep costs
+    about one VectorPortfolio's worth of python. Entries and exits come from
+    the strategy class' grid_signals() and are executed the same way as in
+    VectorPortfolio, on close and in symbol_list order, long only.
+    """
+    # Columns of each batch of trades, as arrays over the trades in it
+    TRADE_BATCH_COLUMNS = ['strategy', 'symbol', 'opened_on', 'closed_on', 'quantity',
+                           'open_price', 'close_price', 'close_cost', 'commission']
+
+    def __init__(self, market, strategies):
+        self.market = market
+        self.strategies = list(strategies)
+
+        self.settings_dict = utils._grab_settings_from_strategy(self.strategies[0])
+
+        # Grabbing config from strategy
+        [setattr(self, key, val) for key, val in self.settings_dict.items()]
+
+        # Only used for sizing and commissions, cash is kept here for each strategy
+        self.risk = RiskAnalysis(self.settings_dict, None, None)
+
+        # Setting attributes in strategies
+        for strategy in self.strategies:
+            strategy.market = self.market
+            strategy.risk = self.risk
+
+        # (strategy x time) holdings by column, and trades of all strategies, once run
+        self._holdings = None
+        self._trades = None
+        self._trades_bounds = None
+
+    def run(self):
+        """ Goes through all bars after the market's history ones, executing
+        orders of all strategies and recording holdings. """
+        panel = self.market._panel
+        close = panel.values[:, :, CLOSE]
+        K, (T, S) = len(self.strategies), close.shape
+
+        entries, exits = (np.asarray(a, dtype=bool) for a in type(self.strategies[0]).grid_signals(panel, self.strategies))
+        if entries.shape != (K, T, S) or exits.shape != (K, T, S):
+            raise ValueError("Strategy grid signals need to be (strategy x time x symbol) arrays of shape {}.".format((K, T, S)))
+
+        h = self.market._history
+        entries, exits, close, T = entries[:, h:], exits[:, h:], close[h:], T - h
+        datetimes = panel.datetimes[h:]
+
+        # Open quantity of each symbol, cash and commission paid so far, for each strategy
+        quantity = np.zeros((K, S))
+        cash = np.full(K, float(self.INITIAL_CAPITAL))
+        commission = np.zeros(K)
+        # 1 while entries are the latest signal of a symbol, 0 after exits
+        status = np.zeros((K, S))
+
+        # Price, commission and bar of each open trade
+        open_price, open_commission = np.zeros((K, S)), np.zeros((K, S))
+        opened_on = np.zeros((K, S), dtype=int)
+
+        # Batches of closed trades, as tuples of TRADE_BATCH_COLUMNS
+        trades = []
+        holdings = {c: np.empty((K, T)) for c in ('cash', 'commission', 'total', 'open_trades')}
+
+        for t in range(T):
+            prices = close[t]
+
+            # Total is calculated on close, before any orders are executed
+            total = cash + np.sum(quantity * prices, axis=1, where=quantity != 0)
+            open_trades = np.count_nonzero(quantity, axis=1)
+            holdings['total'][:, t], holdings['open_trades'][:, t] = total, open_trades
+
+            # Same as VectorPortfolio._positions, one bar at a time
+            tradable = prices > 0.0
+            orders = np.where(exits[:, t] & tradable, 0.0, np.where(entries[:, t] & tradable, 1.0, status)) - status
+            status += orders
+
+            for i in np.flatnonzero(orders.any(axis=0)):
+                sell = np.flatnonzero((orders[:, i] < 0) & (quantity[:, i] != 0))
+                if len(sell):
+                    adj_price = self.risk.adjust_price_for_slippage('SELL', prices[i])
+                    q = -quantity[sell, i]
+                    c = self.risk.determine_commissions(q, adj_price)
+                    trades.append((sell, np.full(len(sell), i), opened_on[sell, i], np.full(len(sell), t), -q,
+                                   open_price[sell, i], np.full(len(sell), adj_price), q*adj_price, open_commission[sell, i] + c))
+
+                    commission[sell] += c
+                    cash[sell] -= (q * adj_price + c)
+                    quantity[sell, i] += q
+                    open_trades[sell] -= 1
+
+                buy = np.flatnonzero((orders[:, i] > 0) & (open_trades < self.MAX_LONG_POSITIONS))
+                if len(buy):
+                    adj_price = self.risk.adjust_price_for_slippage('BUY', prices[i])
+                    buy, q = self._size(buy, adj_price, cash, quantity, prices)
+                    c = self.risk.determine_commissions(q, adj_price)
+
+                    commission[buy] += c
+                    cash[buy] -= (q * adj_price + c)
+                    quantity[buy, i] += q
+                    open_trades[buy] += 1
+                    open_price[buy, i], open_commission[buy, i], opened_on[buy, i] = adj_price, c, t
+
+            holdings['cash'][:, t], holdings['commission'][:, t] = cash, commission
+
+            negative = (cash < 0) | (total < 0)
+            if negative.any():
+                k = np.flatnonzero(negative)[0]
+                raise AssertionError("Cash or total is negative on {} for {}. Cash={}, Total={}".format(
+                    datetimes[t], self.strategies[k], cash[k], total[k]))
+
+        # "Fake close" trades that are open, in the order they were opened
+        held, symbols = np.nonzero(quantity)
+        order = np.lexsort((symbols, opened_on[held, symbols]))
+        held, symbols = held[order], symbols[order]
+        q = quantity[held, symbols]
+        close_cost = -q * close[-1, symbols]
+        trades.append((held, symbols, opened_on[held, symbols], np.full(len(held), T - 1), q,
+                       open_price[held, symbols], close_cost/-q, close_cost, open_commission[held, symbols]))
+
+        self._holdings = holdings
+        self._trades, self._trades_bounds = self._trades_frame(trades)
+
+    def _size(self, buy, adj_price, cash, quantity, prices):
+        """ Sizes positions of strategies at positions buy the same way
+        RiskAnalysis does, given each strategy's cash and net liquidation.
+        Returns strategies actually buying and their quantities. """
+        net_liquidation = cash[buy] + np.sum(quantity[buy] * prices, axis=1, where=quantity[buy] != 0)
+
+        # Cash to be spent on this position
+        if self.CAPITAL_TRADABLE_CAP:
+            position_cash = np.minimum(self.CAPITAL_TRADABLE_CAP, net_liquidation)*self.POSITION_SIZE
+        else:
+            position_cash = net_liquidation*self.POSITION_SIZE
+
+        # Adjust position down if not enough money
+        missing = position_cash > cash[buy]
+        if self.ADJUST_POSITION_DOWN:
+            position_cash = np.where(missing, cash[buy], position_cash)
+        elif missing.any():
+            logging.warning("Can't adjust position, {} missing cash.".format(str(position_cash[missing]-cash[buy][missing])))
+            buy, position_cash = buy[~missing], position_cash[~missing]
+
+        q = self.risk.fit_quantities('BUY', adj_price, position_cash)
+        if (q < 0).any():
+            logging.warning(
+                "{} order quantity for {}. Cash balance {}, price {}, round lot size {}. This is a sign of inconsistency in portfolio holdings.".format(
+                q[q < 0], [self.strategies[k] for k in buy[q < 0]], cash[buy][q < 0], adj_price, self.ROUND_LOT_SIZE,
+            ))
+        return buy[q > 0], q[q > 0]
+
+    def _trades_frame(self, batches):
+        """
+        Builds a single DataFrame with trades of all strategies, given batches
+        of TRADE_BATCH_COLUMNS. Each strategy's trades keep the order of batches,
+        same as VectorPortfolio.all_trades. Returns it along with the row each
+        strategy's trades start at.
+        """
+        columns = dict(zip(self.TRADE_BATCH_COLUMNS, (np.concatenate(column) for column in zip(*batches))))
+
+        order = np.argsort(columns['strategy'], kind='stable')
+        columns = {name: values[order] for name, values in columns.items()}
+
+        # Quantities are ints when sized in whole round lots, as in RiskAnalysis
+        quantity = columns['quantity']
+        if isinstance(self.ROUND_LOT_SIZE, int) and self.ROUND_LOT_SIZE:
+            quantity = quantity.astype(np.int64)
+
+        index = self.market._panel.index[self.market._history:]
+        trades = pd.DataFrame({
+            'symbol': np.array(self.market.symbol_list, dtype=object)[columns['symbol']],
+            'pnl': -(quantity*columns['open_price'] + columns['close_cost'] + columns['commission']),
+            'open_datetime': index.values[columns['opened_on']],
+            'close_datetime': index.values[columns['closed_on']],
+            'quantity': quantity,
+            'open_price': columns['open_price'],
+            'close_price': columns['close_price'],
+            'commission': columns['commission'],
+        }, columns=performance.TRADE_COLUMNS)
+
+        return trades, np.searchsorted(columns['strategy'], np.arange(len(self.strategies) + 1))
+
+    def holdings(self, k):
+        """ Returns the all_holdings of the strategy at position k. """
+        return HoldingsRecorder.from_frame(pd.DataFrame({
+            'cash': self._holdings['cash'][k],
+            'commission': self._holdings['commission'][k],
+            'total': self._holdings['total'][k],
+            'open_trades': self._holdings['open_trades'][k].astype(int),
+            'subscribed_symbols': len(self.market.symbol_list),
+        }, index=self.market._panel.index[self.market._history:]))
+
+    def trades(self, k):
+        """ Returns the all_trades DataFrame of the strategy at position k. """
+        start, stop = self._trades_bounds[k], self._trades_bounds[k + 1]
+        return self._trades.iloc[start:stop].reset_index(drop=True)
+
+
+class GridMember(object):
+    """ Stands for a portfolio of one of the strategies run by a GridPortfolio,
+    holding its holdings, trades and performance. """
+    def __init__(self, market, strategy):
+        self.market = market
+        self.strategy = strategy
+
+        self.settings_dict = utils._grab_settings_from_strategy(strategy)
+
+        # Grabbing config from strategy
+        [setattr(self, key, val) for key, val in self.settings_dict.items()]
+
+        self.all_holdings = None
+        self.all_trades = None
+        self.performance = None
+
+    def calc_performance(self):
+        if not self.all_holdings:
+            raise ValueError("Portfolio with empty holdings")
+
+        self.performance = performance.calc_performance(
+            self.all_holdings.frame(), self.all_trades, self.THRESHOLD_DANGEROUS_TRADE)
+        return self.performance
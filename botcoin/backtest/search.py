@@ -0,0 +1,197 @@
+from datetime import datetime
+import logging
+from math import ceil, log
+
+import numpy as np
+import pandas as pd
+
+from botcoin.backtest.engine import BacktestEngine
+
+
+class ParameterSearch(object):
+    """
+    Searches parameters of a strategy within ranges like the ones passed to
+    botcoin.optimize, e.g. ((2,20,1), (10,100,5)), running a fixed budget of
+    backtests in batches instead of every combination. Strategies are built
+    as strategy_class(*params) and each batch is picked, depending on method,
+    from results of the previous ones:
+        random -- parameters not backtested yet, drawn uniformly
+        halving -- successive halving, a batch is backtested on the first bars
+                   of history and its best 1/eta again on eta times as many
+                   bars, until the best one is backtested on all of them
+        surrogate -- after a random batch, parameters a quadratic model of
+                     order_by fitted to all results so far predicts best
+    Each backtest counts towards budget, including the ones of halving on
+    part of history. Market data is loaded once and shared by all batches.
+    """
+    METHODS = ('random', 'halving', 'surrogate')
+
+    # Fewest bars halving backtests on, as performance needs some history
+    MIN_BARS = 20
+    # Unseen parameters the surrogate model predicts, per parameters picked
+    SURROGATE_POOL = 100
+
+    def __init__(self, strategy_class, ranges, data_dir, method='random', budget=50, batch_size=10,
+                 order_by='sharpe', eta=2, engine_class=BacktestEngine, market=None, seed=None):
+
+        if method not in self.METHODS:
+            raise ValueError("Search method needs to be one of {}.".format(', '.join(self.METHODS)))
+        if budget < 1 or batch_size < 1 or eta < 2:
+            raise ValueError("Search needs budget and batch_size of at least 1 and eta of at least 2.")
+
+        self.strategy_class = strategy_class
+        self.axes = [np.arange(*r) for r in ranges]
+        if not self.axes or not all(len(axis) for axis in self.axes):
+            raise ValueError("Empty parameter ranges.")
+
+        self.data_dir = data_dir
+        self.method = method
+        self.budget = budget
+        self.batch_size = batch_size
+        self.order_by = order_by
+        self.eta = eta
+        self.engine_class = engine_class
+        self.market = market
+        self.rng = np.random.default_rng(seed)
+
+        # Candidates are flat indexes into the grid of all combinations of axes
+        self._shape = tuple(len(axis) for axis in self.axes)
+        self._size = int(np.prod(self._shape, dtype=object))
+
+        # Candidates backtested so far, with their order_by on all bars
+        self._seen = {}
+        # Results row of each candidate's longest backtest
+        self._rows = {}
+        self._trace = []
+        self._batches = 0
+
+        self.results, self.trace = None, None
+
+    def run(self):
+        """
+        Runs the search until budget is spent or every combination was
+        backtested. Returns results, one row per parameters backtested with
+        the same columns as BacktestEngine's ordered by order_by, and trace,
+        one row per backtest with its batch, parameters, bars and order_by.
+        """
+        start_time = datetime.now()
+
+        if self.market is None:
+            self.market = self.engine_class.load_market([self.strategy_class(*self.params(0))], self.data_dir)
+
+        getattr(self, '_' + self.method)()
+
+        # Backtests on all bars first, halving ones on part of history after them
+        self.results = pd.DataFrame(list(self._rows.values())).sort_values(
+            ['truncated', self.order_by], ascending=[True, False], na_position='last', kind='mergesort',
+        ).reset_index(drop=True)
+        self.trace = pd.DataFrame(self._trace, columns=['batch', 'strategy', 'params', 'bars', self.order_by])
+
+        logging.info("Search of {} backtests took {}".format(len(self.trace), str(datetime.now()-start_time)))
+        return self.results, self.trace
+
+    def params(self, candidate):
+        """ Returns the tuple of parameters of a flat index into the grid. """
+        return tuple(axis[i].item() for axis, i in zip(self.axes, np.unravel_index(candidate, self._shape)))
+
+    @property
+    def remaining(self):
+        return self.budget - len(self._trace)
+
+    def _evaluate(self, candidates, bars=None):
+        """ Backtests strategies with candidates as a single batch, on the
+        first bars of history or all of it. Returns their order_by. """
+        market = self.market if bars is None else self.market.slice(date_to=self.market._panel.index[bars-1])
+        strategies = [self.strategy_class(*self.params(c)) for c in candidates]
+        engine = self.engine_class(strategies, self.data_dir, market=market)
+
+        self._batches += 1
+        bars = len(engine.market._panel)
+        truncated = bars < len(self.market._panel)
+
+        rows = {id(portfolio.strategy): row for portfolio, (_, row) in zip(engine.portfolios, engine.results.iterrows())}
+        scores = []
+        for candidate, strategy in zip(candidates, strategies):
+            row = rows[id(strategy)].copy()
+            row['truncated'] = row['truncated'] or truncated
+            score = row[self.order_by]
+
+            self._trace.append((self._batches, str(strategy), self.params(candidate), bars, score))
+            self._rows[candidate] = row
+            self._seen[candidate] = score if not truncated else self._seen.get(candidate, np.nan)
+            scores.append(score)
+
+        return np.array(scores, dtype=float)
+
+    def _sample(self, n):
+        """ Returns up to n candidates not backtested yet, drawn uniformly. """
+        if self._size - len(self._seen) <= n:
+            unseen = np.setdiff1d(np.arange(self._size), list(self._seen))
+            return [int(c) for c in self.rng.permutation(unseen)]
+
+        picked = {}
+        while len(picked) < n:
+            for c in self.rng.integers(self._size, size=n - len(picked)):
+                if int(c) not in self._seen:
+                    picked[int(c)] = None
+        return list(picked)[:n]
+
+    def _random(self):
+        while self.remaining > 0:
+            candidates = self._sample(min(self.batch_size, self.remaining))
+            if not candidates:
+                break
+            self._evaluate(candidates)
+
+    def _halving(self):
+        total_bars = len(self.market._panel)
+
+        while self.remaining > 0:
+            candidates = self._sample(min(self.batch_size, self.remaining))
+            if not candidates:
+                break
+
+            # Rungs of the same bracket backtest fewer candidates on more bars
+            rungs = int(log(len(candidates), self.eta) + 1e-9) + 1
+            for rung in range(rungs):
+                candidates = candidates[:self.remaining]
+                if not candidates:
+                    break
+                bars = max(ceil(total_bars / self.eta**(rungs - 1 - rung)), min(self.MIN_BARS, total_bars))
+                scores = self._evaluate(candidates, bars if bars < total_bars else None)
+
+                # Best first, backtests without order_by (e.g. no trades) last
+                best = np.argsort(-np.nan_to_num(scores, nan=-np.inf), kind='stable')
+                candidates = [candidates[i] for i in best[:ceil(len(candidates)/self.eta)]]
+
+    def _surrogate(self):
+        while self.remaining > 0:
+            n = min(self.batch_size, self.remaining)
+
+            seen = np.array(list(self._seen), dtype=np.int64)
+            scores = np.array(list(self._seen.values()), dtype=float)
+            known = np.isfinite(scores)
+            features = self._quadratic_features(seen[known])
+
+            if known.sum() <= features.shape[1]:
+                candidates = self._sample(n)
+            else:
+                coefficients = np.linalg.lstsq(features, scores[known], rcond=None)[0]
+                pool = self._sample(n*self.SURROGATE_POOL)
+                predicted = self._quadratic_features(np.array(pool, dtype=np.int64)) @ coefficients
+                candidates = [pool[i] for i in np.argsort(-predicted, kind='stable')[:n]]
+
+            if not candidates:
+                break
+            self._evaluate(candidates)
+
+    def _quadratic_features(self, candidates):
+        """ Returns constant, linear, squared and cross terms of candidates'
+        parameters, scaled to [0, 1] over their ranges. """
+        indexes = np.array(np.unravel_index(candidates, self._shape), dtype=float).T
+        x = indexes / np.maximum(np.array(self._shape) - 1, 1)
+
+        columns = [np.ones(len(x))]
+        columns += [x[:, i] for i in range(x.shape[1])]
+        columns += [x[:, i]*x[:, j] for i in range(x.shape[1]) for j in range(i, x.shape[1])]
+        return np.column_stack(columns)
@@ -0,0 +1,152 @@
+from datetime import datetime
+import logging
+import multiprocessing
+
+import pandas as pd
+
+from botcoin import settings
+from botcoin.backtest.engine import BacktestEngine
+from botcoin.backtest.search import ParameterSearch
+from botcoin.common import performance
+
+
+class WalkForward(object):
+    """
+    Walk forward optimization of a strategy's parameters within ranges, as in
+    ParameterSearch. History loaded for the strategy is split in windows of
+    train_bars followed by test_bars, moving test_bars at a time (or always
+    training from the first bar if anchored). Parameters are searched on each
+    train window, with search_options passed to ParameterSearch, and the best
+    ones backtested on the test window right after it. Strategies start each
+    test window with INITIAL_CAPITAL, looking back on up to MAX_LOOKBACK bars
+    before it (all of them if unlimited) without trading on them, and only
+    windows that fit whole in history are run.
+
+    Windows run in parallel between workers forked processes, over slices of
+    market data loaded once.
+    """
+    def __init__(self, strategy_class, ranges, data_dir, train_bars, test_bars, anchored=False,
+                 workers=settings.BACKTEST_WORKERS, engine_class=BacktestEngine, **search_options):
+
+        if train_bars < 2 or test_bars < 2:
+            raise ValueError("Walk forward windows need at least 2 train and 2 test bars.")
+
+        # Checks search options upfront instead of in each window
+        self._first_params = ParameterSearch(strategy_class, ranges, data_dir, engine_class=engine_class,
+                                             **search_options).params(0)
+
+        self.strategy_class = strategy_class
+        self.ranges = ranges
+        self.data_dir = data_dir
+        self.train_bars = train_bars
+        self.test_bars = test_bars
+        self.anchored = anchored
+        self.workers = workers
+        self.engine_class = engine_class
+        self.search_options = search_options
+        self.order_by = search_options.get('order_by', 'sharpe')
+
+        self.market = None
+        self.equity_curve, self.windows, self.performance = None, None, None
+
+    def run(self):
+        """
+        Runs every window. Returns the out of sample equity curve, test
+        windows' equity curves stitched one after the other, and windows, one
+        row per window with its dates, parameters picked and their order_by
+        on the train window, followed by test results with the same columns
+        as BacktestEngine's.
+        """
+        start_time = datetime.now()
+
+        if self.market is None:
+            self.market = self.engine_class.load_market([self.strategy_class(*self._first_params)], self.data_dir)
+
+        self._windows = self.split(len(self.market._panel))
+        if not self._windows:
+            raise ValueError("History of {} bars is too short for {} train and {} test bars.".format(
+                len(self.market._panel), self.train_bars, self.test_bars))
+
+        workers = min(self.workers, len(self._windows))
+        if workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            logging.warning("Parallel walk forward needs fork, running {} windows in a single process.".format(len(self._windows)))
+            workers = 1
+
+        if workers > 1:
+            outputs = self._run_in_pool(workers)
+        else:
+            outputs = [self._run_window(i) for i in range(len(self._windows))]
+
+        # Each test window's equity continues from where the previous one ended
+        curves, level = [], 1.0
+        for _, curve in outputs:
+            curves.append(curve * level)
+            level = curves[-1].iloc[-1]
+
+        self.equity_curve = pd.concat(curves).rename('equity_curve')
+        self.windows = pd.DataFrame([row for row, _ in outputs])
+        self.performance = performance.curves_performance(self.equity_curve.to_frame()).iloc[0]
+
+        logging.info("Walk forward of {} windows took {}".format(len(self._windows), str(datetime.now()-start_time)))
+        return self.equity_curve, self.windows
+
+    def split(self, bars):
+        """ Returns (train from, test from, test to) bar positions of each window
+        fitting in bars, test to not included. """
+        windows = []
+        start = 0
+        while start + self.train_bars + self.test_bars <= bars:
+            test_from = start + self.train_bars
+            windows.append((0 if self.anchored else start, test_from, test_from + self.test_bars))
+            start += self.test_bars
+        return windows
+
+    def _run_window(self, i):
+        """ Searches parameters on window i's train bars and backtests the best
+        ones on its test bars. Returns its windows row and test equity curve. """
+        train_from, test_from, test_to = self._windows[i]
+        index = self.market._panel.index
+
+        search = ParameterSearch(self.strategy_class, self.ranges, self.data_dir, engine_class=self.engine_class,
+                                 market=self.market.slice(index[train_from], index[test_from-1]),
+                                 **self.search_options)
+        results, trace = search.run()
+        best = results.iloc[0]
+        params = trace.loc[trace['strategy'] == best['strategy'], 'params'].iloc[0]
+
+        # Bars before the test window are history, so indicators don't start from scratch
+        history = min(test_from, self.market.max_lookback) if self.market.max_lookback else test_from
+        test = self.engine_class([self.strategy_class(*params)], self.data_dir,
+                                 market=self.market.slice(index[test_from], index[test_to-1], history))
+        portfolio = test.portfolios[0]
+
+        row = {
+            'train from': index[train_from],
+            'train to': index[test_from-1],
+            'test from': index[test_from],
+            'test to': index[test_to-1],
+            'params': params,
+            'train ' + self.order_by: best[self.order_by],
+        }
+        row.update(test.results.iloc[0])
+        return row, portfolio.performance['all_holdings']['total'] / portfolio.INITIAL_CAPITAL
+
+    def _run_in_pool(self, workers):
+        """ Splits windows between forked processes, which inherit the market
+        already loaded. Returns outputs of _run_window in window order. """
+        global _pool_walk_forward
+        _pool_walk_forward = self
+
+        try:
+            with multiprocessing.get_context('fork').Pool(workers, maxtasksperchild=1) as pool:
+                return pool.map(_run_window, range(len(self._windows)), chunksize=1)
+        finally:
+            _pool_walk_forward = None
+
+
+# Walk forward being run by a process pool, inherited by forked workers
+_pool_walk_forward = None
+
+def _run_window(i):
+    """ Runs window i of _pool_walk_forward, in a forked worker. """
+    return _pool_walk_forward._run_window(i)
@@ -1,51 +1,124 @@
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import logging
 import numpy as np
 import os
 import pandas as pd
+import zipfile
 
+from botcoin import settings
 from botcoin.common.events import MarketEvent
-from botcoin.utils import _round
+from botcoin.common.indicators import compute_indicator, parse_indicator
+from botcoin.common.panel import MarketPanel, OPEN, HIGH, LOW, CLOSE, VOLUME
+from botcoin.utils import _round, _near_rounding_boundary
+
+# Bump whenever the layout of cached files changes so old ones get rebuilt
+CACHE_VERSION = 1
 
 class MarketData(object):
     """ General MarketData that is subclassed in both live and backtest modes. """
 
-    def __init__(self, csv_dir, symbol_list, normalize_prices, normalize_volume, round_decimals):
+    # Columns in each csv, after the datetime index
+    CSV_COLUMNS = ('open', 'high', 'low', 'close', 'volume', 'adj_close')
+
+    def __init__(self, csv_dir, symbol_list, normalize_prices, normalize_volume, round_decimals,
+                 data_cache=settings.DATA_CACHE, load_workers=settings.LOAD_WORKERS,
+                 max_lookback=settings.MAX_LOOKBACK):
 
         # To keep track how long loading everything took
         start_load_datetime = datetime.now()
         self.symbol_list = sorted(list(set(symbol_list)))
 
-        # Dictionary where all symbol data is kept
-        self._data = {}
-        # events_queue for all portfolios using this market object
-        self.events_queue_list = []
-
-        # Parsing csvs, treating data and setting bars
-        self._read_all_csvs(csv_dir, normalize_prices, normalize_volume, round_decimals)
+        # Parsing csvs into a single panel where all symbol data is kept
+        frames = self._read_all_csvs(csv_dir, normalize_prices, normalize_volume, round_decimals, data_cache, load_workers)
+        self._panel = MarketPanel.from_frames(frames, self.symbol_list)
         self._check_data_consistency()
         self._pad_empty_values()
 
-        self.load_time = datetime.now()-start_load_datetime
+        MarketData._initialize(self, max_lookback)
 
-    def _read_all_csvs(self, csv_dir, normalize_prices, normalize_volume, round_decimals):
+        self.load_time = datetime.now()-start_load_datetime
 
-        comb_index = None
+    def _initialize(self, max_lookback):
+        """ Sets up everything around self._panel, once it's loaded or attached. """
+        self.symbol_list = self._panel.symbol_list
+        self._symbols = self._panel.symbols
 
-        for s in self.symbol_list:
+        # events_queue for all portfolios using this market object
+        self.events_queue_list = []
+        # MarketEvent sub_types each queue needs, queues not in it get all events
+        self.event_sub_types = {}
+        # Function returning the mask and list of symbols each queue is subscribed
+        # to, given symbol_list. Queues not in it get events for all symbols
+        self.event_subscriptions = {}
+
+        # Maximum number of bars strategies can look back, 0 for no limit
+        self.max_lookback = max_lookback
+
+        # Last recorded price of each symbol, nan until first price arrives
+        self._last_price = np.full(len(self.symbol_list), np.nan)
+        # Bumped whenever any last price changes, so values derived from last
+        # prices can be cached until then
+        self.price_version = 0
+
+        # Incremental windows used by Bars indicators, when history is fixed
+        self._rolling = None
+
+        # Shared memory block this market's panel was published to
+        self._published = None
+
+    @classmethod
+    def attach(cls, handle, max_lookback=settings.MAX_LOOKBACK):
+        """
+        Builds a market over a panel published by another process with
+        publish(), skipping all csv loading. Values are read-only and shared
+        with every other process attached to the same handle.
+        """
+        start_load_datetime = datetime.now()
 
-            self._data[s] = {}
-            filename = s + '.csv'
+        market = cls.__new__(cls)
+        market._panel = MarketPanel.attach(handle)
+        MarketData._initialize(market, max_lookback)
+
+        market.load_time = datetime.now()-start_load_datetime
+        return market
+
+    def publish(self):
+        """ Copies market data into shared memory once, returning a handle other
+        processes can pass to attach(). Call unpublish() when they're done. """
+        if self._published is None:
+            self._published = self._panel.publish()
+        return self._published[1]
+
+    def unpublish(self):
+        """ Frees shared memory used by publish(). """
+        if self._published is not None:
+            block, handle = self._published
+            block.close()
+            block.unlink()
+            self._published = None
+
+    def _read_all_csvs(self, csv_dir, normalize_prices, normalize_volume, round_decimals,
+                       data_cache=False, load_workers=1):
+        """ Returns a dict of DataFrames, one per symbol, all sharing the same index. """
+
+        read = self._read_cached_csv if data_cache else self._read_csv
+        args = [(csv_dir, s + '.csv', normalize_prices, normalize_volume, round_decimals) for s in self.symbol_list]
+
+        if load_workers > 1 and len(args) > 1:
+            with ProcessPoolExecutor(max_workers=load_workers) as executor:
+                dfs = list(executor.map(read, *zip(*args)))
+        else:
+            dfs = [read(*a) for a in args]
 
-            self._data[s]['df'] = self._read_csv(csv_dir, filename, normalize_prices, normalize_volume, round_decimals)
+        if not dfs:
+            return {}
 
-            # Combine different file indexes to account for nonexistent values
-            # (needs 'is not None' because of Pandas 'The truth value of a DatetimeIndex is ambiguous.' error)
-            comb_index = comb_index.union(self._data[s]['df'].index) if comb_index is not None else self._data[s]['df'].index
+        # Combine all file indexes in a single pass to account for nonexistent values
+        comb_index = pd.DatetimeIndex(np.unique(np.concatenate([df.index.values for df in dfs])), name='datetime')
 
         # Reindex
-        for s in self.symbol_list:
-            self._data[s]['df'] = self._data[s]['df'].reindex(index=comb_index, method=None)
+        return {s: df.reindex(index=comb_index, method=None) for s, df in zip(self.symbol_list, dfs)}
 
     @staticmethod
     def _read_csv(csv_dir, filename, normalize_prices,
@@ -55,7 +128,7 @@ class MarketData(object):
             os.path.expanduser(csv_dir+filename),
             header=None,
             index_col=0,
-            names=['datetime', 'open', 'high', 'low', 'close', 'volume', 'adj_close']
+            names=('datetime',) + MarketData.CSV_COLUMNS,
         )
 
         try:
@@ -84,85 +157,176 @@ class MarketData(object):
 
         return df
 
-    def _check_data_consistency(self):
-        inconsistencies = []
-        for s in self.symbol_list:
-            df = self._data[s]['df']
+    @classmethod
+    def _read_cached_csv(cls, csv_dir, filename, normalize_prices,
+                         normalize_volume, round_decimals):
+        """
+        Same as _read_csv, but keeps the parsed DataFrame as a .npz file in
+        settings.DATA_CACHE_DIR. Cached files are keyed by the csv's size and
+        mtime plus the settings used to parse it, and are rebuilt when stale.
+        """
+        csv_path = os.path.expanduser(csv_dir+filename)
+        cache_dir = os.path.join(os.path.dirname(csv_path), settings.DATA_CACHE_DIR)
+        cache_path = os.path.join(cache_dir, os.path.splitext(filename)[0] + '.npz')
+
+        stat = os.stat(csv_path)
+        key = '{}:{}:{}:{}:{}:{}'.format(
+            CACHE_VERSION, stat.st_size, stat.st_mtime_ns,
+            bool(normalize_prices), bool(normalize_volume), round_decimals,
+        )
 
-            if (df['high'] < df['low']).any() == True:
-                dates = df.loc[(df['high'] < df['low']) == True].index
-                inconsistencies.append('{} high < low on {}'.format(s, dates))
+        try:
+            with np.load(cache_path) as cached:
+                if str(cached['key']) == key:
+                    return pd.DataFrame(
+                        {c: cached[c] for c in cls.CSV_COLUMNS},
+                        index=pd.DatetimeIndex(cached['datetime'], name='datetime'),
+                    )
+        except (IOError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+            # Missing or unreadable cache, will be rebuilt below
+            pass
+
+        df = cls._read_csv(csv_dir, filename, normalize_prices, normalize_volume, round_decimals)
 
-            if (df['high'] < df['open']).any() == True:
-                dates = df.loc[(df['high'] < df['open']) == True].index
-                inconsistencies.append('{} high < open on {}'.format(s, dates))
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # Writing to a temporary file first so a concurrent reader never
+            # sees a partially written cache
+            tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, key=np.array(key), datetime=df.index.values,
+                         **{c: df[c].values for c in cls.CSV_COLUMNS})
+            os.replace(tmp_path, cache_path)
+        except (IOError, OSError) as e:
+            logging.warning("Could not write data cache for {}: {}".format(filename, e))
 
-            if (df['high'] < df['close']).any() == True:
-                dates = df.loc[(df['high'] < df['close']) == True].index
-                inconsistencies.append('{} high < close on {}'.format(s, dates))
+        return df
 
-            if (df['low'] > df['open']).any() == True:
-                dates = df.loc[(df['low'] > df['open']) == True].index
-                inconsistencies.append('{} low > open on {}'.format(s, dates))
+    def _check_data_consistency(self):
+        values, index = self._panel.values, self._panel.index
+        o, h, l, c = (values[:, :, f] for f in (OPEN, HIGH, LOW, CLOSE))
+
+        checks = (
+            ('high < low', h < l),
+            ('high < open', h < o),
+            ('high < close', h < c),
+            ('low > open', l > o),
+            ('low > close', l > c),
+        )
 
-            if (df['low'] > df['close']).any() == True:
-                dates = df.loc[(df['low'] > df['close']) == True].index
-                inconsistencies.append('{} low > close on {}'.format(s, dates))
+        inconsistencies = []
+        for i, s in enumerate(self.symbol_list):
+            for description, mask in checks:
+                if mask[:, i].any():
+                    inconsistencies.append('{} {} on {}'.format(s, description, index[mask[:, i]]))
 
         if inconsistencies:
             raise ValueError('Possible inconsistencies in data, cancelling backtest.\n' + '\n'.join(inconsistencies))
 
     def _pad_empty_values(self):
-
-        for s in self.symbol_list:
-            df = self._data[s]['df']
-
-            # Fill NaN with 0 in volume column
-            df['volume'] = df['volume'].fillna(0)
-            # Pad close price forward
-            df['close'] = df['close'].ffill()
-            # Fill any remaining close NaN in 0 (e.g. beginning of file)
-            df['close'] = df['close'].fillna(0)
-
-            # Fill open high and low NaN with close price
-            for col in ['open', 'high', 'low']:
-                df[col] = df[col].fillna(df['close'])
-
-            self._data[s]['df'] = df
+        values = self._panel.values
+        close = values[:, :, CLOSE]
+
+        # Fill NaN with 0 in volume column
+        volume = values[:, :, VOLUME]
+        volume[np.isnan(volume)] = 0
+
+        # Pad close price forward, by taking the latest non NaN row of each symbol
+        rows = np.where(np.isnan(close), 0, np.arange(len(close))[:, None])
+        np.maximum.accumulate(rows, axis=0, out=rows)
+        close[:] = close[rows, np.arange(close.shape[1])]
+        # Fill any remaining close NaN in 0 (e.g. beginning of file)
+        close[np.isnan(close)] = 0
+
+        # Fill open high and low NaN with close price
+        for f in (OPEN, HIGH, LOW):
+            col = values[:, :, f]
+            empty = np.isnan(col)
+            col[empty] = close[empty]
 
     def _relay_market_event(self, e):
-        """ Puts e, which should be a MarketEvent on all queues in self.events_queue_list """
+        """ Puts e, which should be a MarketEvent on all queues in self.events_queue_list
+        that need its sub_type and are subscribed to its symbol. Returns number of
+        queues e was put on. """
         if isinstance(e, MarketEvent):
-            [q.put(e) for q in self.events_queue_list]
+            queues = [q for q in self.events_queue_list if self._needs_event(q, e.sub_type) and
+                      (e.symbol is None or self._subscribed_to(q, e.symbol))]
+            [q.put(e) for q in queues]
+            return len(queues)
         else:
             raise TypeError("MarketData._relay_market_event only accepts MarketEvent objects.")
 
-    def _todays_bar(self, symbol):
-        """ Returns today's prices, volume and last_timestamp as an ordered tuple. """
-
-        if 'updated_at' in self._data[symbol]:
-            return (
-                self._data[symbol]['updated_at'],
-                self._data[symbol]['open'],
-                self._data[symbol]['high'],
-                self._data[symbol]['low'],
-                self._data[symbol]['close'],
-                self._data[symbol]['volume'],
-            )
+    def _needs_event(self, queue, sub_type):
+        sub_types = self.event_sub_types.get(queue)
+        return sub_types is None or sub_type in sub_types
+
+    def _subscribed_symbols(self, queue):
+        """ Returns symbols queue is subscribed to, in symbol_list order """
+        subscription = self.event_subscriptions.get(queue)
+        return subscription(self.symbol_list)[1] if subscription else self.symbol_list
+
+    def _subscribed_to(self, queue, symbol):
+        subscription = self.event_subscriptions.get(queue)
+        return subscription(self.symbol_list)[0][self._symbols[symbol]] if subscription else True
+
+    def _event_needed(self, sub_type):
+        """ True if any queue needs MarketEvents of sub_type """
+        return any(self._needs_event(q, sub_type) for q in self.events_queue_list)
+
+    def _today(self, i):
+        """ Returns datetime and values of today's bar for symbol at position i, or None. """
+        raise NotImplementedError("MarketData needs to implement _today")
+
+    def _window(self, i, N, include_today):
+        """
+        Returns datetimes and a (bars x fields) array with up to N of the
+        latest bars of the symbol at position i, optionally ending with today's bar.
+        """
+        raise NotImplementedError("MarketData needs to implement _window")
+
+    def _panel_window(self, N, include_today):
+        """
+        Returns datetimes and a (bars x symbols x fields) array with up to N of
+        the latest bars of all symbols, optionally ending with today's bar.
+        """
+        raise NotImplementedError("MarketData needs to implement _panel_window")
+
+    def _set_last_prices(self, prices):
+        """ Records last price of all symbols at once. """
+        self._last_price[:] = prices
+        self.price_version += 1
 
     def last_price(self, symbol):
         """ Returns last recorded price """
-        if not 'last_price' in self._data[symbol]:
+        price = self._last_price[self._symbols[symbol]]
+        if np.isnan(price):
             raise BarError("Not enough bars yet.")
-        return self._data[symbol]['last_price']
+        return price
 
     def change(self, symbol):
         """ Returns change between last close and last recorded price """
         # In case execution just started and there is no current price
-        if not 'last_price' in self._data[symbol]:
-            raise BarError("Not enough bars yet.")
+        last_price = self.last_price(symbol)
         last_close = self.yesterday(symbol).close
-        return self._data[symbol]['last_price']/last_close - 1
+        return last_price/last_close - 1
+
+    def indicator(self, symbol, name):
+        """
+        Returns latest value of an indicator declared in strategy's INDICATORS,
+        computed from completed bars in history, so today's bar isn't used.
+        Backtests look it up in values precomputed for the whole history instead.
+        """
+        kind, N, _ = parse_indicator(name)
+        i = self._symbols[symbol]
+
+        # True range of atr also needs the close before its first bar
+        _, values = self._panel_window(N + 1 if kind == 'atr' else N, False)
+        value = compute_indicator(values[:, i:i+1], name)[-1, 0] if len(values) else np.nan
+
+        if np.isnan(value):
+            raise BarError("Not enough bars yet.")
+        return _round(value)
 
     def bars(self, symbol, N=1):
         """ Returns latest N bars including today's values """
@@ -172,69 +336,196 @@ class MarketData(object):
         """ Returns latest N bars not including today's values """
         return self._bar_dispatcher('past_bars', symbol, N)
 
+    def panel_bars(self, N=1, field='close'):
+        """
+        Returns a read-only (N x symbols) array of the latest N values of field,
+        including today's, for all symbols in symbol_list, and a boolean array
+        telling which symbols have N valid bars (same rules as bars()).
+        """
+        return self._panel_dispatcher(N, field, True)
+
+    def past_panel_bars(self, N=1, field='close'):
+        """ Same as panel_bars but not including today's values """
+        return self._panel_dispatcher(N, field, False)
+
+    def panel_mavg(self, N, field='close'):
+        """
+        Returns moving averages of the latest N values of field, including
+        today's, for all symbols in symbol_list, rounded the same as
+        Bars.mavg, and which symbols have N valid bars. Symbols without them
+        get nan.
+        """
+        values, valid = self.panel_bars(N, field)
+
+        # Symbols as rows, so each mean adds up values in the same order as a single symbol's
+        means = np.full(len(self.symbol_list), np.nan)
+        means[valid] = np.ascontiguousarray(values[:, valid].T).mean(axis=1)
+        return _round(means), valid
+
+    def rank(self, values, ascending=False):
+        """
+        Ranks symbols by values, either an array with one value per symbol or
+        a field name, in which case latest values of field are used. Returns an
+        array of ranks starting at 1 for the highest value (lowest if
+        ascending), with nan for symbols without a valid value.
+        """
+        values = self._cross_section(values)
+        valid = ~np.isnan(values)
+
+        order = np.argsort(values[valid] if ascending else -values[valid], kind='stable')
+        ranks = np.full(len(values), np.nan)
+        ranks[np.flatnonzero(valid)[order]] = np.arange(1, len(order) + 1)
+        return ranks
+
+    def top_n(self, values, n, ascending=False):
+        """
+        Returns up to n symbols with the highest values (lowest if ascending),
+        values being an array with one value per symbol or a field name.
+        Symbols without a valid value are left out.
+        """
+        ranks = self.rank(values, ascending)
+        return [self.symbol_list[i] for i in np.argsort(ranks, kind='stable')[:n] if ranks[i] <= n]
+
+    def _cross_section(self, values):
+        if isinstance(values, str):
+            values, valid = self.panel_bars(1, values)
+            values = np.where(valid, values[-1] if len(values) else np.nan, np.nan)
+        values = np.asarray(values, dtype=float)
+
+        if values.shape != (len(self.symbol_list),):
+            raise ValueError("Expected one value per symbol in symbol_list, got shape {}.".format(values.shape))
+        return values
+
+    def _panel_dispatcher(self, N, field, include_today):
+        if field not in Bars.FIELDS:
+            raise ValueError("Unknown field {}, should be one of {}.".format(field, ', '.join(Bars.FIELDS)))
+
+        if self.max_lookback and N > self.max_lookback:
+            raise ValueError("Can't look back {} bars, MAX_LOOKBACK is {}.".format(N, self.max_lookback))
+
+        datetimes, values = self._panel_window(N, include_today)
+
+        # Symbols with N bars and no 0.0 (or missing) close prices
+        if len(values) == N:
+            valid = (values[:, :, CLOSE] > 0.0).all(axis=0)
+        else:
+            valid = np.zeros(len(self.symbol_list), dtype=bool)
+
+        values = values[:, :, Bars.FIELDS[field]]
+        values.setflags(write=False)
+        return values, valid
+
     def today(self, symbol):
         """ Returns today's OHLC values in a bar """
         return self._bar_dispatcher('today', symbol)
 
     def yesterday(self, symbol):
-        """ Returns yesterday's values - last bar in self._latest_bars """
+        """ Returns yesterday's values - last bar before today """
         return self._bar_dispatcher('yesterday', symbol)
 
     def _bar_dispatcher(self, option, symbol, N=1, ):
+        i = self._symbols[symbol]
+
+        if self.max_lookback and N > self.max_lookback:
+            raise ValueError("Can't look back {} bars, MAX_LOOKBACK is {}.".format(N, self.max_lookback))
+
         if option == 'today':
-            bars = [self._todays_bar(symbol)]
-            # bars = self._data[symbol]['latest_bars'][-1:]  # old implementation
+            datetimes, values = self._window(i, 1, True)
 
         elif option == 'yesterday':
-            bars = self._data[symbol]['latest_bars'][-1:]
+            datetimes, values = self._window(i, 1, False)
 
         elif option == 'bars':
-            bars = self._data[symbol]['latest_bars'][-(N-1):]
-            bars.append(self._todays_bar(symbol))
+            datetimes, values = self._window(i, N, True)
 
         elif option == 'past_bars':
-            bars = self._data[symbol]['latest_bars'][-N:]
-            # bars = self._data[symbol]['latest_bars'][-(N+1):-1]  # old implementation
+            datetimes, values = self._window(i, N, False)
 
-        if not bars:
+        if not len(values):
             raise BarError("Something wrong with latest_bars")
 
-        if len(bars) != N:
+        if len(values) != N:
             raise BarError("Not enough bars yet.")
 
-        if len([bar for bar in bars if bar[4] > 0.0]) != len(bars):
+        if not values[:, CLOSE].min() > 0.0:
             raise BarError("Empty bars found. Latest_bars for {} has one or more 0.0 close prices, and will be disconsidered.".format(symbol))
 
-        result = Bars(bars, True) if option in ('today', 'yesterday') else Bars(bars)
-        return result
+        if option in ('today', 'yesterday'):
+            return Bars(datetimes, values, True)
+
+        rolling = (self._rolling, self._rolling.cursor, i, option == 'bars') if self._rolling else None
+        return Bars(datetimes, values, rolling=rolling)
 
 
 class Bars(object):
     """
     Object exposed to users to reflect prices on a single or on multiple days.
+    On multiple days, open, high, low, close, vol and datetime are read-only
+    numpy views of the market's history, so no values are copied.
     """
-    def __init__(self, latest_bars, single_bar=False):
-        self.length = len(latest_bars)
-
-        if single_bar:
-            self.datetime = latest_bars[-1][0]
-            self.open = latest_bars[-1][1]
-            self.high = latest_bars[-1][2]
-            self.low = latest_bars[-1][3]
-            self.close = latest_bars[-1][4]
-            self.vol = latest_bars[-1][5]
-        else:
-            self.datetime = [i[0] for i in latest_bars]
-            self.open = [i[1] for i in latest_bars]
-            self.high = [i[2] for i in latest_bars]
-            self.low = [i[3] for i in latest_bars]
-            self.close = [i[4] for i in latest_bars]
-            self.vol = [i[5] for i in latest_bars]
+    FIELDS = {'open': OPEN, 'high': HIGH, 'low': LOW, 'close': CLOSE, 'vol': VOLUME}
+
+    def __init__(self, datetimes, values, single_bar=False, rolling=None):
+        values.setflags(write=False)
+
+        self._datetimes = datetimes
+        self._values = values
+        self._single_bar = single_bar
+        # (RollingWindows, cursor when created, symbol position, include_today)
+        self._rolling = rolling
+        self.length = len(values)
+
+    def _field(self, f):
+        return self._values[-1, f] if self._single_bar else self._values[:, f]
+
+    @property
+    def datetime(self):
+        return pd.Timestamp(self._datetimes[-1]) if self._single_bar else self._datetimes
+
+    @property
+    def open(self):
+        return self._field(OPEN)
+
+    @property
+    def high(self):
+        return self._field(HIGH)
+
+    @property
+    def low(self):
+        return self._field(LOW)
+
+    @property
+    def close(self):
+        return self._field(CLOSE)
+
+    @property
+    def vol(self):
+        return self._field(VOLUME)
+
+    def _rolling_stats(self, price_type):
+        """ Mean and standard deviation kept incrementally by the market, or
+        None if not available (e.g. live market or bars from a previous day). """
+        if self._rolling and price_type in self.FIELDS:
+            windows, cursor, i, include_today = self._rolling
+            if windows.cursor == cursor:
+                return windows.stats(self.FIELDS[price_type], self.length, include_today, i)
 
     def mavg(self, price_type='close'):
+        stats = self._rolling_stats(price_type)
+        if stats and not _near_rounding_boundary(stats[0]):
+            return _round(stats[0])
+
         return _round(np.mean(getattr(self, price_type)))
 
     def bollingerbands(self, k, price_type='close'):
+        stats = self._rolling_stats(price_type)
+        if stats:
+            ave, sd = stats
+            bands = (ave, ave + (sd*k), ave - (sd*k))
+            # Falls back to computing over all values if rounding could differ
+            if not any(_near_rounding_boundary(v) for v in bands):
+                return tuple(_round(v) for v in bands)
+
         ave = np.mean(getattr(self, price_type))
         sd = np.std(getattr(self, price_type))
         upband = ave + (sd*k)
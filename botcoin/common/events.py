@@ -1,4 +1,11 @@
 import datetime
+import heapq
+import itertools
+import queue
+
+# Increasing number stamped on every event, so events with the same priority
+# are handled in the order they were created
+_sequence = itertools.count()
 
 class Event(object):
     """
@@ -7,37 +14,50 @@ class Event(object):
         10 Order
         20 Signal
         30 Market
+    Events with the same priority are ordered by creation.
     """
+    __slots__ = ('sequence',)
+
     def __lt__(self, other):
-         return (self.priority, self.created_at) < (other.priority, other.created_at)
+         return (self.priority, self.sequence) < (other.priority, other.sequence)
 
 class MarketEvent(Event):
-    def __init__(self, sub_type, symbol=None):
-        self.priority = 30
+    """ Market phase for a single symbol, or for all symbols in symbols
+    when phases are relayed in batches. """
+    __slots__ = ('sub_type', 'symbol', 'symbols')
+    priority = 30
+
+    def __init__(self, sub_type, symbol=None, symbols=None):
         self.symbol = symbol
+        self.symbols = symbols
         if sub_type and sub_type in ('before_open', 'open', 'during' ,'close', 'after_close'):
             self.sub_type = sub_type
         elif sub_type:
             raise ValueError("Wrong type of MarketEvent sub_type.")
-        self.created_at = datetime.datetime.now()
+        self.sequence = next(_sequence)
 
 
 class SignalEvent(Event):
+    __slots__ = ('symbol', 'direction', 'exec_price')
+    priority = 20
+
     def __init__(self, symbol, direction, exec_price):
         if direction not in ('BUY', 'SELL', 'SHORT', 'COVER'):
             raise ValueError("Unknown direction - {}".format(direction))
 
-        self.priority = 20
         self.symbol = symbol
         self.direction = direction
         self.exec_price = exec_price
-        self.created_at = datetime.datetime.now()
+        self.sequence = next(_sequence)
 
     def __str__(self):
         return "Signal - {}:{}:{}".format(self.symbol,self.direction,str(self.exec_price))
 
 
 class OrderEvent(Event):
+    __slots__ = ('type', 'signal', 'symbol', 'quantity', 'direction', 'limit_price',
+                 'estimated_cost', 'created_at')
+    priority = 10
 
     def __init__(self, signal, symbol, quantity, direction, limit_price,
                  estimated_cost):
@@ -45,7 +65,6 @@ class OrderEvent(Event):
         if not isinstance(signal, SignalEvent):
             raise TypeError("signal is not instance of SignalEvent")
 
-        self.priority = 10
         self.type = 'LMT'
         self.signal = signal
         self.symbol = symbol
@@ -53,7 +72,9 @@ class OrderEvent(Event):
         self.direction = direction
         self.limit_price = limit_price
         self.estimated_cost = estimated_cost
+        # Used by trades to record when they were opened
         self.created_at = datetime.datetime.now()
+        self.sequence = next(_sequence)
 
     def __str__(self):
         return "Order - {} : {} : {} : {}".format(self.symbol,self.direction,str(self.quantity),str(self.estimated_cost))
@@ -65,6 +86,8 @@ class FillEvent(Event):
     actually filled and at what price. In addition, stores
     the commission of the trade from the brokerage.
     """
+    __slots__ = ('symbol', 'direction', 'quantity', 'price', 'commission', 'created_at')
+    priority = 10
 
     def __init__(self, symbol, direction, quantity,
                  price, commission):
@@ -82,13 +105,41 @@ class FillEvent(Event):
         commission - comission paid
         """
 
-        self.priority = 10
         self.symbol = symbol
         self.direction = direction
         self.quantity = quantity
         self.price = price
         self.commission = commission
+        # Used by trades to record when they were closed
         self.created_at = datetime.datetime.now()
+        self.sequence = next(_sequence)
 
     def __str__(self):
         return "Fill - {}:{}:{}".format(self.symbol,self.direction,self.quantity)
+
+
+class EventQueue(object):
+    """
+    Priority queue of events used in backtests, where everything runs in a
+    single thread. Same interface as queue.PriorityQueue, used in live trading
+    where events come from other threads, but without any locking.
+    """
+    __slots__ = ('queue',)
+
+    def __init__(self):
+        self.queue = []
+
+    def put(self, event):
+        heapq.heappush(self.queue, event)
+
+    def get(self, block=False):
+        try:
+            return heapq.heappop(self.queue)
+        except IndexError:
+            raise queue.Empty
+
+    def empty(self):
+        return not self.queue
+
+    def qsize(self):
+        return len(self.queue)
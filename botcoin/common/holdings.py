@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+class HoldingsRecorder(object):
+    """
+    Growable, array backed record of one holding per bar. Cash, commission
+    and total are kept in a (bar x 3) float block and open_trades and
+    subscribed_symbols in a (bar x 2) int block, so a whole backtest takes a
+    few dozen bytes per bar instead of a dict per bar.
+    """
+    FLOAT_COLUMNS = ('cash', 'commission', 'total')
+    INT_COLUMNS = ('open_trades', 'subscribed_symbols')
+
+    def __init__(self, capacity=256):
+        self._length = 0
+        self._datetimes = np.empty(0, dtype='datetime64[ns]')
+        self._floats = np.empty((0, len(self.FLOAT_COLUMNS)))
+        self._ints = np.empty((0, len(self.INT_COLUMNS)), dtype=np.int64)
+        self.reserve(capacity)
+
+    @classmethod
+    def from_frame(cls, frame):
+        """ Returns a recorder holding the rows of an all_holdings DataFrame,
+        as built in one go by the vectorized portfolios. """
+        recorder = cls(len(frame))
+        recorder._datetimes[:] = frame.index.values
+        recorder._floats[:] = frame[list(cls.FLOAT_COLUMNS)].values
+        recorder._ints[:] = frame[list(cls.INT_COLUMNS)].values
+        recorder._length = len(frame)
+        return recorder
+
+    def __len__(self):
+        return self._length
+
+    def reserve(self, capacity):
+        """ Makes room for at least capacity holdings without reallocating. """
+        if capacity <= len(self._datetimes):
+            return
+
+        def grow(array):
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:self._length] = array[:self._length]
+            return grown
+
+        self._datetimes = grow(self._datetimes)
+        self._floats = grow(self._floats)
+        self._ints = grow(self._ints)
+
+    def append(self, holding):
+        """ Records a holding dict, as built by Portfolio.construct_holding. """
+        if self._length == len(self._datetimes):
+            self.reserve(max(2*self._length, 1))
+
+        row = self._length
+        self._datetimes[row] = np.datetime64(holding['datetime'], 'ns')
+        self._floats[row] = [holding[c] for c in self.FLOAT_COLUMNS]
+        self._ints[row] = [holding.get(c, 0) for c in self.INT_COLUMNS]
+        self._length += 1
+
+    def frame(self):
+        """ Returns recorded holdings as a DataFrame indexed by datetime, over
+        views of the recorder's arrays rather than copies. """
+        index = pd.DatetimeIndex(self._datetimes[:self._length], name='datetime')
+        return pd.concat([
+            pd.DataFrame(self._floats[:self._length], index=index, columns=self.FLOAT_COLUMNS, copy=False),
+            pd.DataFrame(self._ints[:self._length], index=index, columns=self.INT_COLUMNS, copy=False),
+        ], axis=1, copy=False)
@@ -0,0 +1,124 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+from botcoin.common.panel import MarketPanel, HIGH, LOW, CLOSE
+
+# Indicators strategies can declare in INDICATORS, named <kind>_<window>, with
+# an optional _<field> suffix for sma and std (close is used by default)
+INDICATOR_KINDS = ('sma', 'std', 'donchian_high', 'donchian_low', 'atr')
+INDICATOR_NAME = re.compile(r'^({})_(\d+)(?:_({}))?$'.format('|'.join(INDICATOR_KINDS), '|'.join(MarketPanel.FIELDS)))
+
+def parse_indicator(name):
+    """ Returns kind, window and field of an indicator name, e.g. 'sma_20_high'. """
+    match = INDICATOR_NAME.match(name)
+    if not match or int(match.group(2)) < 1 or (match.group(3) and match.group(1) not in ('sma', 'std')):
+        raise ValueError("Unknown indicator {}. Indicators are named <kind>_<window>[_<field>], "
+                         "kind being one of {}.".format(name, ', '.join(INDICATOR_KINDS)))
+    return match.group(1), int(match.group(2)), match.group(3) or 'close'
+
+def compute_indicator(values, name):
+    """
+    Computes an indicator over (time x symbol x field) values, for all symbols
+    at once. Returns a (time x symbol) array where row t only uses bars up to
+    and including t. Windows without enough bars, or with a 0.0 close, are nan.
+    """
+    kind, N, field = parse_indicator(name)
+    rolling = lambda a, n=N: pd.DataFrame(a).rolling(n)
+
+    close = values[:, :, CLOSE]
+
+    if kind == 'sma':
+        result = rolling(values[:, :, MarketPanel.FIELDS.index(field)]).mean().values
+    elif kind == 'std':
+        # Population standard deviation, same as np.std in Bars.bollingerbands
+        result = rolling(values[:, :, MarketPanel.FIELDS.index(field)]).std(ddof=0).values
+    elif kind == 'donchian_high':
+        result = rolling(values[:, :, HIGH]).max().values
+    elif kind == 'donchian_low':
+        result = rolling(values[:, :, LOW]).min().values
+    elif kind == 'atr':
+        high, low = values[:, :, HIGH], values[:, :, LOW]
+        prev_close = np.vstack((close[:1], close[:-1]))
+        true_range = np.maximum(high - low, np.maximum(np.abs(high - prev_close), np.abs(low - prev_close)))
+        result = rolling(true_range).mean().values
+        # True range also depends on the previous close
+        N += 1
+
+    valid = rolling((close > 0.0).astype(float), N).min().values == 1.0
+    result[~valid] = np.nan
+    return result
+
+class RollingWindows(object):
+    """
+    Rolling sums and sums of squares of every (field, length) window requested
+    through Bars so far, kept for all symbols at once. Windows move forward one
+    bar whenever the market advances to a new day, so means and standard
+    deviations of the latest N bars are O(1) lookups instead of O(N).
+    """
+    def __init__(self, values):
+        # (time x symbol x field) values windows are computed from
+        self._values = values
+        # Row of today's bar in values
+        self.cursor = -1
+        # (field, N, include_today) -> _Window
+        self._windows = {}
+
+    def advance(self):
+        """ Moves cursor and all windows one bar forward. """
+        self.cursor += 1
+        for window in self._windows.values():
+            window.advance(self._values)
+
+    def stats(self, field, N, include_today, i):
+        """
+        Returns mean and standard deviation of the latest N values of field
+        for the symbol at position i, optionally including today's bar.
+        """
+        key = (field, N, include_today)
+        if key not in self._windows:
+            stop = self.cursor + 1 if include_today else self.cursor
+            self._windows[key] = _Window(self._values, field, N, stop)
+
+        return self._windows[key].stats(i)
+
+
+class _Window(object):
+    """
+    Sums of the N bars before stop (exclusive) for all symbols. Sums are
+    taken over differences to a reference value, which keeps sums of squares
+    small, and are recomputed from scratch every N bars to avoid drifting.
+    """
+    def __init__(self, values, field, N, stop):
+        self.field = field
+        self.N = N
+        self.stop = stop
+        self._recompute(values)
+
+    def _recompute(self, values):
+        window = values[max(self.stop - self.N, 0):max(self.stop, 0), :, self.field]
+        self.ref = window.mean(axis=0) if len(window) else np.zeros(values.shape[1])
+        diff = window - self.ref
+        self.sum = diff.sum(axis=0)
+        self.sumsq = (diff*diff).sum(axis=0)
+        self.updates = 0
+
+    def advance(self, values):
+        self.stop += 1
+        self.updates += 1
+
+        # Window still not full or due for a refresh
+        if self.stop <= self.N or self.updates >= self.N:
+            self._recompute(values)
+            return
+
+        new = values[self.stop - 1, :, self.field] - self.ref
+        old = values[self.stop - 1 - self.N, :, self.field] - self.ref
+        self.sum += new - old
+        self.sumsq += new*new - old*old
+
+    def stats(self, i):
+        mean = self.sum[i]/self.N
+        var = max(self.sumsq[i]/self.N - mean*mean, 0.0)
+        return self.ref[i] + mean, np.sqrt(var)
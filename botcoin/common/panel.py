@@ -0,0 +1,160 @@
+import collections
+import os
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import pandas as pd
+
+# Field positions in MarketPanel.values
+OPEN, HIGH, LOW, CLOSE, VOLUME = range(5)
+
+# Describes a panel published to shared memory, small enough to be sent to other processes
+PanelHandle = collections.namedtuple('PanelHandle', ['name', 'shape', 'datetime_values', 'symbol_list', 'tracker'])
+
+class MarketPanel(object):
+    """
+    Prices and volume of all symbols as a single (time x symbol x field)
+    float array sharing one datetime index. Symbols are mapped to their
+    integer position in symbol_list.
+    """
+    FIELDS = ('open', 'high', 'low', 'close', 'volume')
+
+    def __init__(self, index, symbol_list, values):
+        if values.shape != (len(index), len(symbol_list), len(self.FIELDS)):
+            raise ValueError("Panel values don't match index, symbols and fields.")
+
+        self.index = index
+        # Timestamps as a list and as a numpy array, both much faster to slice
+        # than the index itself
+        self.datetimes = list(index)
+        self.datetime_values = index.values
+        self.symbol_list = list(symbol_list)
+        self.symbols = {s: i for i, s in enumerate(self.symbol_list)}
+        self.values = values
+        # Shared memory block values live in, when attached to a published panel
+        self._shared_memory = None
+
+    @classmethod
+    def from_frames(cls, frames, symbol_list):
+        """ Builds a panel from one DataFrame per symbol, all sharing the same index. """
+        index = frames[symbol_list[0]].index if symbol_list else pd.DatetimeIndex([], name='datetime')
+        values = np.empty((len(index), len(symbol_list), len(cls.FIELDS)))
+
+        for i, s in enumerate(symbol_list):
+            values[:, i, :] = frames[s][list(cls.FIELDS)].values
+
+        return cls(index, symbol_list, values)
+
+    def __len__(self):
+        return len(self.index)
+
+    def field(self, name):
+        """ Returns (time x symbol) view of a single field. """
+        return self.values[:, :, self.FIELDS.index(name)]
+
+    def frame(self, symbol):
+        """ Returns a DataFrame (time x field) with all values of a symbol. """
+        return pd.DataFrame(self.values[:, self.symbols[symbol], :], index=self.index, columns=self.FIELDS)
+
+    def slice(self, date_from=None, date_to=None):
+        """ Returns a panel limited between date_from and date_to, sharing this panel's values. """
+        indexer = self.index.slice_indexer(date_from or None, date_to or None)
+        panel = MarketPanel(self.index[indexer], self.symbol_list, self.values[indexer])
+        panel._shared_memory = self._shared_memory
+        return panel
+
+    def publish(self, name=None):
+        """
+        Copies values into a new shared memory block. Returns the block, which
+        the publisher needs to close and unlink once it's no longer used, and
+        a PanelHandle other processes can attach to.
+        """
+        block = shared_memory.SharedMemory(name=name, create=True, size=max(self.values.nbytes, 1))
+        np.ndarray(self.values.shape, self.values.dtype, buffer=block.buf)[:] = self.values
+        return block, PanelHandle(block.name, self.values.shape, self.datetime_values, self.symbol_list,
+                                  _resource_tracker_id())
+
+    @classmethod
+    def attach(cls, handle):
+        """ Returns a read-only panel over values published by another process. """
+        block = _attach_shared_memory(handle.name, handle.tracker)
+
+        values = np.ndarray(handle.shape, np.float64, buffer=block.buf)
+        values.setflags(write=False)
+
+        panel = cls(pd.DatetimeIndex(handle.datetime_values, name='datetime'), handle.symbol_list, values)
+        panel._shared_memory = block
+        return panel
+
+
+class RingBuffer(object):
+    """
+    Fixed size (bar x symbol x field) history holding the latest capacity bars
+    of all symbols. Every bar is written twice, capacity rows apart, so the
+    latest N bars are always a contiguous slice returned without copying.
+    """
+    def __init__(self, capacity, symbol_list):
+        if capacity < 1:
+            raise ValueError("RingBuffer capacity needs to be at least 1.")
+
+        self.capacity = capacity
+        self.symbol_list = list(symbol_list)
+        self.values = np.full((2*capacity, len(self.symbol_list), len(MarketPanel.FIELDS)), np.nan)
+        self.datetime_values = np.full(2*capacity, np.datetime64('NaT'), dtype='datetime64[ns]')
+
+        # Position of the next write, between 0 and capacity
+        self._next = 0
+        self._length = 0
+
+    @classmethod
+    def from_panel(cls, panel, capacity):
+        """ Builds a ring buffer holding the latest capacity bars of panel. """
+        ring = cls(capacity, panel.symbol_list)
+        for t in range(max(len(panel) - capacity, 0), len(panel)):
+            ring.append(panel.datetime_values[t], panel.values[t])
+        return ring
+
+    def __len__(self):
+        return self._length
+
+    def append(self, datetime, values):
+        """ Adds a (symbol x field) bar, dropping the oldest one if full. """
+        for row in (self._next, self._next + self.capacity):
+            self.datetime_values[row] = datetime
+            self.values[row] = values
+
+        self._next = (self._next + 1) % self.capacity
+        self._length = min(self._length + 1, self.capacity)
+
+    def tail(self, N):
+        """ Returns datetimes and (bar x symbol x field) values of up to N latest bars. """
+        stop = self._next + self.capacity
+        start = stop - max(min(N, self._length), 0)
+        return self.datetime_values[start:stop], self.values[start:stop]
+
+
+def _resource_tracker_id():
+    """ Identifies the resource tracker unlinking shared memory blocks of this
+    process by its pipe, which processes started by multiprocessing inherit
+    from their parent. None where blocks aren't tracked. """
+    if os.name != 'posix':
+        return None
+    stat = os.fstat(resource_tracker.getfd())
+    return stat.st_dev, stat.st_ino
+
+def _attach_shared_memory(name, tracker):
+    """ Opens an existing shared memory block, published by a process using
+    tracker, without taking ownership of it. """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+
+    # Before python 3.13 attaching also registers the block with the resource
+    # tracker, which unlinks it when the process exits (bpo-39959). Only the
+    # publisher should do that, so the block is unregistered again unless this
+    # process shares the publisher's tracker, where registering changed nothing
+    block = shared_memory.SharedMemory(name=name)
+    if tracker is not None and tracker != _resource_tracker_id():
+        resource_tracker.unregister(block._name, 'shared_memory')
+    return block
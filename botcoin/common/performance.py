@@ -0,0 +1,183 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+
+# Columns of the all_trades DataFrame in performance
+TRADE_COLUMNS = ['symbol', 'pnl', 'open_datetime', 'close_datetime',
+                 'quantity', 'open_price', 'close_price', 'commission']
+
+def trades_frame(trades):
+    """ Builds the all_trades DataFrame from a list of closed (or fake closed) Trades. """
+    return pd.DataFrame(
+        [(
+            t.symbol,
+            t.pnl,
+            t.opened_at,
+            t.closed_at,
+            t.quantity,
+            t.avg_open_price,
+            t.avg_close_price,
+            t.commission,
+        ) for t in trades],
+        columns=TRADE_COLUMNS,
+    )
+
+def drawdown(curve):
+    """
+    Returns max drawdown (in %) and max drawdown duration (in bars) of an equity
+    curve, or of each column of a (bars x curves) matrix. The first bar is only
+    a starting point and nan bars are skipped when tracking the high water mark.
+    """
+    curve = np.asarray(curve, dtype=float)[1:]
+    if not len(curve):
+        return (np.nan, np.nan) if curve.ndim == 1 else (np.full(curve.shape[1], np.nan),)*2
+
+    # High water mark starting at 0
+    hwm = np.fmax.accumulate(np.fmax(curve, 0.0), axis=0)
+    drawdown = (hwm - curve)/hwm
+
+    # Bars since drawdown was last 0, nan before it first was
+    bars = np.arange(len(curve)).reshape((-1,) + (1,)*(curve.ndim - 1))
+    last_zero = np.maximum.accumulate(np.where(drawdown == 0, bars, -1), axis=0)
+    duration = np.where(last_zero >= 0, bars - last_zero, np.nan)
+
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmax(drawdown, axis=0)*100, np.nanmax(duration, axis=0)
+
+def sharpe(returns, bars_per_year):
+    """ Annualised sharpe ratio of returns, or of each column of a returns matrix. """
+    returns = np.asarray(returns, dtype=float)
+    returns = pd.Series(returns) if returns.ndim == 1 else pd.DataFrame(returns)
+    mean, std = np.asarray(returns.mean()), np.asarray(returns.std())
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(mean != 0, np.sqrt(bars_per_year) * mean / std, 0.0)[()]
+
+def sortino(returns, bars_per_year):
+    """ Annualised sortino ratio of returns (downside deviation of negative returns
+    only), or of each column of a returns matrix. """
+    returns = np.asarray(returns, dtype=float)
+    downside = np.sqrt(np.nanmean(np.minimum(returns, 0.0)**2, axis=0))
+    mean = np.nanmean(returns, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(downside > 0, np.sqrt(bars_per_year) * mean / downside, np.nan)[()]
+
+def calmar(ann_return, dd_max):
+    """ Annualised return over max drawdown, both in %. nan without drawdowns. """
+    dd_max = np.asarray(dd_max, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(dd_max > 0, np.asarray(ann_return, dtype=float) / dd_max, np.nan)[()]
+
+def rolling_returns(curve, window):
+    """ Returns over the last window bars at each bar, of a curve or each column of a matrix. """
+    curve = np.asarray(curve, dtype=float)
+    result = np.full(curve.shape, np.nan)
+    if len(curve) > window:
+        result[window:] = curve[window:] / curve[:-window] - 1
+    return result
+
+def trade_stats(pnl):
+    """ Returns trade statistics given pnl of all trades. """
+    pnl = np.asarray(pnl, dtype=float)
+    trades = len(pnl)
+    wins, losses = pnl[pnl > 0], pnl[pnl <= 0]
+
+    return {
+        'trades': trades,
+        'pct_trades_profit': len(wins)/trades if trades else 0.0,
+        'pct_trades_loss': len(losses)/trades if trades else 0.0,
+        'avg_trade_profit': wins.mean() if len(wins) else 0.0,
+        'avg_trade_loss': losses.mean() if len(losses) else 0.0,
+        'profit_factor': wins.sum()/-losses.sum() if losses.sum() < 0 else np.nan,
+        'expectancy': pnl.mean() if trades else 0.0,
+    }
+
+def curves_performance(totals):
+    """
+    Performance stats of many portfolios at once, given a DataFrame indexed by
+    datetime with portfolio totals as columns (e.g. holdings totals of every
+    portfolio in a sweep). Returns a DataFrame with one row per column.
+    """
+    returns = totals.pct_change()
+    equity = (1.0+returns).cumprod()
+
+    years = (totals.index[-1]-totals.index[0]).days/365.2425
+    bars_per_year = len(totals.index)/years
+
+    stats = pd.DataFrame(index=totals.columns)
+    stats['total_return'] = (equity.iloc[-1].values - 1.0) * 100.0
+    stats['ann_return'] = stats['total_return'] ** 1/years
+    stats['sharpe'] = sharpe(returns.values, bars_per_year)
+    stats['sortino'] = sortino(returns.values, bars_per_year)
+    stats['dd_max'], stats['dd_duration'] = drawdown(equity.values)
+    stats['calmar'] = calmar(stats['ann_return'], stats['dd_max'])
+    return stats
+
+def calc_performance(holdings, trades, threshold_dangerous_trade, truncated_at=None):
+    """
+    Calculates multiple performance stats.
+    Parameters:
+        holdings -- DataFrame indexed by datetime with one holding per bar,
+                    containing at least total and subscribed_symbols
+        trades -- DataFrame with TRADE_COLUMNS, one row per trade
+        threshold_dangerous_trade -- fraction of returns above which a single
+                    trade is considered dangerous
+        truncated_at -- datetime backtest was stopped on by a pruning rule,
+                    if it didn't run until the end
+    """
+    if holdings.empty:
+        raise ValueError("Portfolio with empty holdings")
+    results = {}
+
+    # Pruned portfolios only have results up to the day they were stopped
+    results['truncated'] = truncated_at is not None
+    results['truncated_at'] = truncated_at
+
+    # Saving all trades
+    results['all_trades'] = trades
+
+    results['dangerous_trades'] = trades[trades['pnl'] > sum(trades['pnl'])*threshold_dangerous_trade]
+
+    # Saving holdings in performance
+    curve = holdings
+    results['all_holdings'] = curve
+
+    # Creating equity curve
+    curve['returns'] = curve['total'].pct_change()
+    curve['equity_curve'] = (1.0+curve['returns']).cumprod()
+    results['equity_curve'] = curve['equity_curve']
+
+    # Number of days elapsed between first and last bar
+    days = (curve.index[-1]-curve.index[0]).days
+    years = days/365.2425
+
+    # Average bars each year, used to calculate sharpe ratio (N)
+    avg_bars_per_year = len(curve.index)/years # curve.groupby(curve.index.year).count())
+
+    # Total return
+    results['total_return'] = ((curve['equity_curve'][-1] - 1.0) * 100.0)
+
+    # Annualised return
+    results['ann_return'] = results['total_return'] ** 1/years
+
+    # Sharpe and sortino ratios
+    results['sharpe'] = sharpe(curve['returns'], avg_bars_per_year)
+    results['sortino'] = sortino(curve['returns'], avg_bars_per_year)
+
+    # Trades statistic
+    results.update(trade_stats(trades['pnl']))
+    results['trades_per_year'] = results['trades']/years
+
+    # Dangerous trades that constitute more than THRESHOLD_DANGEROUS_TRADE of returns
+    results['dangerous'] = True if not results['dangerous_trades'].empty else False
+
+    # Drawdown
+    results['dd_max'], results['dd_duration'] = drawdown(results['equity_curve'])
+    results['calmar'] = calmar(results['ann_return'], results['dd_max'])
+
+    # Subscribed symbols
+    results['subscribed_symbols'] = results['all_holdings']['subscribed_symbols']
+    results['avg_subscribed_symbols'] = results['all_holdings']['subscribed_symbols'].mean()
+
+    return results
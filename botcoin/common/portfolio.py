@@ -4,10 +4,11 @@ from math import floor
 import queue
 
 import numpy as np
-import pandas as pd
 
 from botcoin import settings, utils
 from botcoin.common.data import MarketData, BarError
+from botcoin.common import performance
+from botcoin.common.holdings import HoldingsRecorder
 from botcoin.common.events import MarketEvent, SignalEvent, OrderEvent, FillEvent
 from botcoin.common.risk import RiskAnalysis
 from botcoin.common.strategy import Strategy
@@ -16,9 +17,13 @@ class Portfolio(object):
     """
     Portfolio root class.
     """
+    # Thread-safe by default, as live events come from other threads
+    events_queue_class = queue.PriorityQueue
+
     def __init__(self, market, strategy):
 
-        self.all_holdings = []
+        # Past holdings, one per bar, and the current one
+        self.all_holdings = HoldingsRecorder()
         self.holdings = None
 
         # Current open positions
@@ -26,6 +31,11 @@ class Portfolio(object):
         # List of all closed trades
         self.all_trades = []
 
+        # Performance stats, once backtest is done
+        self.performance = None
+        # Datetime a pruning rule stopped backtesting this portfolio on
+        self.truncated_at = None
+
 
         # check for symbol names that would conflict with columns used in holdings
         for symbol in market.symbol_list:
@@ -33,7 +43,7 @@ class Portfolio(object):
                 raise ValueError("A symbol has an invalid name. Invalid names are 'cash', 'commission','total', 'returns', 'equity_curve', 'datetime'.")
 
         # Main events queue shared with Market and Execution
-        self.events_queue = queue.PriorityQueue()
+        self.events_queue = self.events_queue_class()
         self.market = market
         self.strategy = strategy
 
@@ -49,8 +59,13 @@ class Portfolio(object):
         self.strategy.market = self.market
         self.strategy.risk = self.risk
 
-        # Setting attributes in market
+        # Setting attributes in market, before_open and after_close are always
+        # needed to keep holdings but other events only if strategy handles them
         self.market.events_queue_list.append(self.events_queue)
+        self.market.event_sub_types[self.events_queue] = \
+            self.strategy._overridden_hooks() | {'before_open', 'after_close'}
+        # Symbol events are only relayed while strategy is subscribed to them
+        self.market.event_subscriptions[self.events_queue] = self.strategy._subscription
 
     @property
     def long_positions(self):
@@ -92,15 +107,15 @@ class Portfolio(object):
             self.strategy._call_strategy_method('after_close')
 
         else:
+            symbols = event.symbols if event.symbols is not None else [event.symbol]
+            # Batched events carry the strategy's subscribed symbols list itself
+            subscribed = symbols
+            k = 0
+            while k < len(symbols):
+                symbol = symbols[k]
+                k += 1
                 try:
-                    if event.sub_type == 'open':
-                        self.strategy._call_strategy_method('open', event.symbol)
-
-                    elif event.sub_type == 'during':
-                        self.strategy._call_strategy_method('during', event.symbol)
-
-                    elif event.sub_type == 'close':
-                        self.strategy._call_strategy_method('close', event.symbol)
+                    self.strategy._call_strategy_method(event.sub_type, symbol)
 
                 except BarError as e:
                     # Problems in market bars or past_bars would raise BarError
@@ -108,6 +123,20 @@ class Portfolio(object):
                     # requested should be disconsidered
                     pass
 
+                # Executes this symbol's orders before the next symbol is
+                # handled, same as when there is one event per symbol
+                if self.STRICT_EVENT_ORDER and not self.events_queue.empty():
+                    self.run_cycle()
+
+                # Symbols subscribed to or unsubscribed from while handling a
+                # batched phase, after this one in symbol_list, get it or not
+                # same as when their own event would have been relayed
+                if event.symbols is not None:
+                    changed = self.strategy._subscription(self.market.symbol_list)[1]
+                    if changed is not subscribed:
+                        subscribed, position = changed, self.market._symbols[symbol]
+                        symbols = symbols[:k] + [s for s in subscribed if self.market._symbols[s] > position]
+
     def market_opened(self):
         cur_datetime = self.market.updated_at
 
@@ -154,7 +183,7 @@ class Portfolio(object):
         self.verify_portfolio_consistency()
 
     def generate_orders(self, signal):
-        logging.debug(str(signal))
+        logging.debug('%s', signal)
 
         symbol = signal.symbol
         direction = signal.direction
@@ -192,23 +221,31 @@ class Portfolio(object):
         if quantity != 0:
             order = OrderEvent(signal, symbol, quantity, direction, adj_price, quantity*adj_price)
 
-            logging.debug(str(order))
-            self.events_queue.put(order)
+            logging.debug('%s', order)
+            self.place_order(order)
+
+    def place_order(self, order):
+        """ Sends order to be executed, through events_queue by default """
+        self.events_queue.put(order)
 
     def update_from_fill(self, fill):
-        logging.debug(str(fill))
-        trade = self.open_trades[fill.symbol]
+        logging.debug('%s', fill)
+        self.apply_fill(fill.symbol, fill.direction, fill.quantity, fill.price, fill.commission, fill.created_at)
+
+    def apply_fill(self, symbol, direction, quantity, price, commission, filled_at):
+        """ Updates holdings and trade of symbol with a fill """
+        trade = self.open_trades[symbol]
 
-        if trade.fill_is_relevant_to_portfolio(fill):
-            self.holdings['commission'] += fill.commission
-            self.holdings['cash'] -= (fill.quantity * fill.price + fill.commission)
+        if trade.is_fill_relevant(direction, quantity):
+            self.holdings['commission'] += commission
+            self.holdings['cash'] -= (quantity * price + commission)
 
-        trade.update_from_fill(fill)
+        trade.apply_fill(direction, quantity, price, commission, filled_at)
 
         # remove trade from open_trades if it has been closed
         if trade.close_is_fully_filled:
-            self.all_trades.append(self.open_trades[fill.symbol])
-            del self.open_trades[fill.symbol]
+            self.all_trades.append(self.open_trades[symbol])
+            del self.open_trades[symbol]
 
     def verify_portfolio_consistency(self):
         """ Checks for problematic values in current holding and position """
@@ -261,90 +298,13 @@ class Portfolio(object):
         """
         Calculates multiple performance stats given a portfolio object.
         """
-        def drawdown(curve):
-            hwm = [0]
-            eq_idx = curve.index
-            drawdown = pd.Series(index = eq_idx)
-            duration = pd.Series(index = eq_idx)
-
-            # Loop over the index range
-            for t in range(1, len(eq_idx)):
-                cur_hwm = max(hwm[t-1], curve[t])
-                hwm.append(cur_hwm)
-                drawdown[t]= (hwm[t] - curve[t])/hwm[t]
-                duration[t]= 0 if drawdown[t] == 0 else duration[t-1] + 1
-
-            return drawdown.max()*100, duration.max()
-
         if not self.all_holdings:
             raise ValueError("Portfolio with empty holdings")
-        results = {}
-
-        # Saving all trades
-        results['all_trades'] = pd.DataFrame(
-            [(
-                t.symbol,
-                t.pnl,
-                t.opened_at,
-                t.closed_at,
-                t.quantity,
-                t.avg_open_price,
-                t.avg_close_price,
-                t.commission,
-            ) for t in self.all_trades],
-            columns=['symbol', 'pnl', 'open_datetime', 'close_datetime',
-                     'quantity', 'open_price', 'close_price', 'commission'],
-        )
-
-        results['dangerous_trades'] = results['all_trades'][
-            results['all_trades']['pnl'] >
-            sum(results['all_trades']['pnl'])*self.THRESHOLD_DANGEROUS_TRADE
-        ]
-
-        # Saving portfolio.all_holdings in performance
-        curve = pd.DataFrame(self.all_holdings)
-        curve.set_index('datetime', inplace=True)
-        results['all_holdings'] = curve
-
-        # Creating equity curve
-        curve['returns'] = curve['total'].pct_change()
-        curve['equity_curve'] = (1.0+curve['returns']).cumprod()
-        results['equity_curve'] = curve['equity_curve']
-
-        # Number of days elapsed between first and last bar
-        days = (curve.index[-1]-curve.index[0]).days
-        years = days/365.2425
-
-        # Average bars each year, used to calculate sharpe ratio (N)
-        avg_bars_per_year = len(curve.index)/years # curve.groupby(curve.index.year).count())
-
-        # Total return
-        results['total_return'] = ((curve['equity_curve'][-1] - 1.0) * 100.0)
-
-        # Annualised return
-        results['ann_return'] = results['total_return'] ** 1/years
-
-        # Sharpe ratio
-        results['sharpe'] = np.sqrt(avg_bars_per_year) * curve['returns'].mean() / curve['returns'].std() if curve['returns'].mean() else 0.0
-
-        # Trades statistic
-        results['trades'] = len(self.all_trades)
-        results['trades_per_year'] = results['trades']/years
-        results['pct_trades_profit'] = len([trade for trade in self.all_trades if trade.pnl > 0])/results['trades'] if results['trades'] else 0.0
-        results['pct_trades_loss'] = len([trade for trade in self.all_trades if trade.pnl <= 0])/results['trades'] if results['trades'] else 0.0
-
-        # Dangerous trades that constitute more than THRESHOLD_DANGEROUS_TRADE of returns
-        results['dangerous'] = True if not results['dangerous_trades'].empty else False
-
-        # Drawdown
-        results['dd_max'], results['dd_duration'] = drawdown(results['equity_curve'])
-
-        # Subscribed symbols
-        results['subscribed_symbols'] = results['all_holdings']['subscribed_symbols']
-        results['avg_subscribed_symbols'] = results['all_holdings']['subscribed_symbols'].mean()
-
-        self.performance = results
-        return results
+
+        self.performance = performance.calc_performance(
+            self.all_holdings.frame(), performance.trades_frame(self.all_trades), self.THRESHOLD_DANGEROUS_TRADE,
+            self.truncated_at)
+        return self.performance
 
 
     def execute_order(self, order):
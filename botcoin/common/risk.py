@@ -1,5 +1,8 @@
+import logging
 from math import floor
 
+import numpy as np
+
 from botcoin.utils import _round
 
 class RiskAnalysis(object):
@@ -21,40 +24,131 @@ class RiskAnalysis(object):
         direction_mod = -1 if direction in ('SELL','SHORT') else 1
         quantity = 0
         estimated_commission = 0
-        cash_balance = self.cash_balance()
-        net_liquidation = self.net_liquidation()
 
         if direction in ('BUY', 'SHORT'):
 
-            # Cash to be spent on this position
-            if self.CAPITAL_TRADABLE_CAP:
-                position_cash = min(self.CAPITAL_TRADABLE_CAP, net_liquidation)*self.POSITION_SIZE
-            else:
-                position_cash = net_liquidation*self.POSITION_SIZE
-
-            # Adjust position down if not enough money and
-            if direction == 'BUY':
-                if position_cash > cash_balance:
-                    if self.ADJUST_POSITION_DOWN:
-                        position_cash = cash_balance
-                    else:
-                        logging.warning("Can't adjust position, {} missing cash.".format(str(position_cash-cash_balance)))
-                        return quantity, estimated_commission
+            position_cash = self._position_cash(direction)
+            if position_cash is None:
+                return quantity, estimated_commission
 
             quantity = direction_mod * position_cash / adj_price
             quantity = floor(quantity/self.ROUND_LOT_SIZE) * self.ROUND_LOT_SIZE if self.ROUND_LOT_SIZE else quantity
 
+            # Largest quantity, in round lots, whose cost and commission fit position_cash
+            quantity = self._fit_quantity(quantity, adj_price, position_cash)
             estimated_commission = self.determine_commission(quantity, adj_price)
 
-            # For as long as estimated cost is bigger than position_cash available
-            while estimated_commission + quantity * adj_price > position_cash:
-                # Adjust quantity down
-                quantity -= self.ROUND_LOT_SIZE or 1  # What if can buy less than 1 (e.g. BTC)
-                # Recalculate commission
-                estimated_commission = self.determine_commission(quantity, adj_price)
-
         elif direction in ('SELL', 'COVER'):
             quantity = -1 * current_quantity  # Should raise TypeError if current_quality is None
             estimated_commission =  self.determine_commission(quantity, adj_price)
 
         return quantity, estimated_commission
+
+    def calculate_quantities_and_commissions(self, direction, adj_prices):
+        """
+        Sizes new BUY or SHORT positions for many candidate signals at once,
+        given their adjusted prices. Quantities and commissions are the same
+        calculate_quantity_and_commission would return for each of them on its
+        own with current cash, as float arrays.
+        """
+        adj_prices = np.asarray(adj_prices, dtype=float)
+
+        position_cash = self._position_cash(direction)
+        if position_cash is None:
+            return np.zeros(adj_prices.shape), np.zeros(adj_prices.shape)
+
+        quantities = self.fit_quantities(direction, adj_prices, position_cash)
+        return quantities, self.determine_commissions(quantities, adj_prices)
+
+    def determine_commissions(self, quantities, prices):
+        """ Same as determine_commission, element-wise for arrays. """
+        return np.maximum(self.COMMISSION_FIXED + (self.COMMISSION_PCT * np.abs(quantities) * prices), self.COMMISSION_MIN)
+
+    def fit_quantities(self, direction, adj_prices, position_cash):
+        """
+        Quantities of new BUY or SHORT positions costing up to position_cash
+        with commission, in round lots, element-wise for arrays of prices and
+        position cash. Same as calculate_quantity_and_commission given the
+        same position cash.
+        """
+        adj_prices, position_cash = np.broadcast_arrays(np.asarray(adj_prices, dtype=float),
+                                                        np.asarray(position_cash, dtype=float))
+
+        direction_mod = -1 if direction == 'SHORT' else 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            initial = direction_mod * position_cash / adj_prices
+            initial = np.floor(initial/self.ROUND_LOT_SIZE) * self.ROUND_LOT_SIZE if self.ROUND_LOT_SIZE else initial
+
+        return initial - self._steps_over_budget(initial, adj_prices, position_cash) * (self.ROUND_LOT_SIZE or 1)
+
+    def _position_cash(self, direction):
+        """ Cash to be spent on a new position, or None if it can't be adjusted down to cash available. """
+        cash_balance = self.cash_balance()
+        net_liquidation = self.net_liquidation()
+
+        # Cash to be spent on this position
+        if self.CAPITAL_TRADABLE_CAP:
+            position_cash = min(self.CAPITAL_TRADABLE_CAP, net_liquidation)*self.POSITION_SIZE
+        else:
+            position_cash = net_liquidation*self.POSITION_SIZE
+
+        # Adjust position down if not enough money and
+        if direction == 'BUY':
+            if position_cash > cash_balance:
+                if self.ADJUST_POSITION_DOWN:
+                    position_cash = cash_balance
+                else:
+                    logging.warning("Can't adjust position, {} missing cash.".format(str(position_cash-cash_balance)))
+                    return None
+
+        return position_cash
+
+    def _over_budget(self, quantity, price, position_cash):
+        """ Whether cost and commission of quantity are bigger than position_cash, element-wise for arrays. """
+        commission = np.maximum(self.COMMISSION_FIXED + (self.COMMISSION_PCT * np.abs(quantity) * price), self.COMMISSION_MIN)
+        return commission + quantity * price > position_cash
+
+    def _max_quantity(self, price, position_cash):
+        """ Real valued quantity whose cost and commission are exactly position_cash,
+        with either the percentage or the minimum commission being charged. Below
+        0, when commission alone is bigger than position_cash, the percentage
+        commission on it is taken off instead of added. """
+        cash = position_cash - self.COMMISSION_FIXED
+        return np.minimum(cash / (price * np.where(cash >= 0, 1 + self.COMMISSION_PCT, 1 - self.COMMISSION_PCT)),
+                          (position_cash - self.COMMISSION_MIN) / price)
+
+    def _steps_over_budget(self, quantity, price, position_cash):
+        """
+        Number of steps (ROUND_LOT_SIZE or 1) to take off quantity, element-wise
+        for arrays, for the first of quantity, quantity - step... whose cost and
+        commission fit position_cash. Cost only grows with quantity, so steps are
+        solved for from _max_quantity and only checked against the exact
+        comparison, which takes a step more or less at most when rounding is off.
+        Prices the cost doesn't grow with (e.g. 0) get no steps.
+        """
+        step = self.ROUND_LOT_SIZE or 1
+        over = lambda k: self._over_budget(quantity - k*step, price, position_cash)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            k = np.where(over(0), np.maximum(np.ceil((quantity - self._max_quantity(price, position_cash))/step), 1.0), 0.0)
+            k[~np.isfinite(k)] = 0.0
+
+            while True:
+                up = (k > 0) & over(k)
+                if not up.any():
+                    break
+                k[up] += 1.0
+            while True:
+                down = (k > 1) & ~over(k - 1.0)
+                if not down.any():
+                    break
+                k[down] -= 1.0
+        return k
+
+    def _fit_quantity(self, quantity, price, position_cash):
+        """ Same as fit_quantities for a single quantity, keeping its type
+        (e.g. int when sized in round lots). """
+        if not self._over_budget(quantity, price, position_cash):
+            return quantity
+        k = int(self._steps_over_budget(np.array([quantity], dtype=float), price, position_cash)[0])
+        return quantity - k*(self.ROUND_LOT_SIZE or 1) if k else quantity
@@ -10,6 +10,9 @@ class Strategy(object):
     """
     Strategy root class.
     """
+    # Methods called on MarketEvents of the same sub_type
+    HOOKS = ('before_open', 'open', 'during', 'close', 'after_close')
+
     def __init__(self, *args, **kwargs):
         self.args = args
         self.kwargs = kwargs
@@ -64,6 +67,19 @@ class Strategy(object):
         self.subscribed_symbols = set()
         self.unsubscribe_all = False
 
+    def _overridden_hooks(self):
+        """ Returns HOOKS implemented by this strategy, others don't need MarketEvents. """
+        return set(h for h in self.HOOKS if h in self.__dict__ or getattr(type(self), h) is not getattr(Strategy, h))
+
+    def _subscription(self, symbol_list):
+        """ Returns a boolean mask over symbol_list of symbols this strategy is
+        subscribed to, and a list of those symbols. Used by market to only relay
+        events strategy needs, and rebuilt only after subscriptions change. """
+        if self._subscription_cache is None:
+            mask = np.array([self.is_subscribed_to(s) for s in symbol_list], dtype=bool)
+            self._subscription_cache = mask, [s for s, m in zip(symbol_list, mask) if m]
+        return self._subscription_cache
+
     def _call_strategy_method(self, method_name, symbol=None):
         method = getattr(self, method_name)
         if symbol:
@@ -91,6 +107,22 @@ class Strategy(object):
     def backtest_done(self, performance):
         pass
 
+    def signals(self, panel):
+        """ Used by VectorBacktestEngine instead of the methods above. Receives
+        the market's MarketPanel and returns entries and exits as two boolean
+        (time x symbol) arrays. Entries buy and exits sell on that bar's close. """
+        raise NotImplementedError("Strategy needs to implement signals to run on VectorBacktestEngine")
+
+    @classmethod
+    def grid_signals(cls, panel, strategies):
+        """ Used by GridBacktestEngine. Receives many instances of this class
+        (e.g. a parameter sweep) and returns their entries and exits as two
+        boolean (strategy x time x symbol) arrays. Strategies whose logic can
+        be written over vectors of parameters should override it, by default
+        each strategy's signals() are stacked. """
+        signals = [strategy.signals(panel) for strategy in strategies]
+        return np.array([entries for entries, _ in signals]), np.array([exits for _, exits in signals])
+
     # Symbol state methods and properties
     @property
     def long_symbols(self):
@@ -109,6 +141,25 @@ class Strategy(object):
     def is_neutral(self, symbol):
         return True if self.positions[symbol].status == '' else False
 
+    # Subscriptions can be assigned directly too, which rebuilds _subscription
+    @property
+    def subscribed_symbols(self):
+        return self._subscribed_symbols
+
+    @subscribed_symbols.setter
+    def subscribed_symbols(self, symbols):
+        self._subscribed_symbols = symbols
+        self._subscription_cache = None
+
+    @property
+    def unsubscribe_all(self):
+        return self._unsubscribe_all
+
+    @unsubscribe_all.setter
+    def unsubscribe_all(self, value):
+        self._unsubscribe_all = value
+        self._subscription_cache = None
+
     def is_subscribed_to(self, symbol):
         if not self.unsubscribe_all and (symbol in self.subscribed_symbols or not self.subscribed_symbols):
             return True
@@ -119,6 +170,7 @@ class Strategy(object):
         open, during_low, during_high and close. This is used to simulate
         a real time feed on a live trading algorithm. """
         self.subscribed_symbols.add(symbol)
+        self._subscription_cache = None
 
     def unsubscribe(self, symbol=None):
         """ Unsubscribes from symbol. If subscribed_symbols is empty, will
@@ -129,6 +181,7 @@ class Strategy(object):
             if not self.subscribed_symbols:
                 self.subscribed_symbols = set(self.market.symbol_list)
             self.subscribed_symbols.remove(symbol)
+            self._subscription_cache = None
 
     def trade_profitability(self, direction, entry_price, exit_price):
         """ Checks if, given an entry and exit price, a trade would be profitable.
@@ -46,45 +46,51 @@ class Trade(object):
         return self.open_commission + self.close_commission
 
     def fill_is_relevant_to_portfolio(self, fill):
+        return self.is_fill_relevant(fill.direction, fill.quantity)
+
+    def is_fill_relevant(self, direction, quantity):
         # Returns False if fill contains info which would have been already consumed by portfolio
         if (
-            (fill.direction in ('BUY', 'SHORT') and self.open_is_fully_filled) or  # fill already reported
-            (fill.direction in ('SELL', 'COVER') and self.close_is_fully_filled) or  # fill already reported
-            (abs(self.quantity) != abs(fill.quantity))  # partial fill (need abs because quantity is reversed for close (e.g. 100 buy becomse -100 sell))
+            (direction in ('BUY', 'SHORT') and self.open_is_fully_filled) or  # fill already reported
+            (direction in ('SELL', 'COVER') and self.close_is_fully_filled) or  # fill already reported
+            (abs(self.quantity) != abs(quantity))  # partial fill (need abs because quantity is reversed for close (e.g. 100 buy becomse -100 sell))
         ):
             return False
         else:
             return True
 
     def update_from_fill(self, fill):
-        if fill.direction in ('BUY', 'SHORT'):
+        self.apply_fill(fill.direction, fill.quantity, fill.price, fill.commission, fill.created_at)
+
+    def apply_fill(self, direction, quantity, price, commission, filled_at):
+        if direction in ('BUY', 'SHORT'):
 
-            self.open_filled_quantity = fill.quantity
-            self.open_commission = fill.commission
-            self.avg_open_price = fill.price
-            self.open_cost = fill.quantity*fill.price
+            self.open_filled_quantity = quantity
+            self.open_commission = commission
+            self.avg_open_price = price
+            self.open_cost = quantity*price
 
             if self.open_is_fully_filled:
-                logging.debug('{} order for {} filled'.format(self.direction, self.symbol))
+                logging.debug('%s order for %s filled', self.direction, self.symbol)
 
-        elif fill.direction in ('SELL', 'COVER'):
+        elif direction in ('SELL', 'COVER'):
 
             if not self.open_is_fully_filled:
-                raise AssertionError('Closing {} trade before it even started on {}.'.format(self.symbol,fill.created_at))
+                raise AssertionError('Closing {} trade before it even started on {}.'.format(self.symbol, filled_at))
 
-            self.close_filled_quantity = fill.quantity
-            self.close_cost = fill.quantity*fill.price
-            self.close_commission = fill.commission
-            self.avg_close_price = fill.price
+            self.close_filled_quantity = quantity
+            self.close_cost = quantity*price
+            self.close_commission = commission
+            self.avg_close_price = price
 
             if self.close_is_fully_filled:
-                self.closed_at = fill.created_at
+                self.closed_at = filled_at
                 self.pnl = -(self.open_cost + self.close_cost + self.commission)
 
                 assert(self.close_cost == -self.quantity*self.avg_close_price)
                 assert(self.open_cost == self.quantity*self.avg_open_price)
 
-                logging.debug('{} order for {} filled'.format(fill.direction, self.symbol))
+                logging.debug('%s order for %s filled', direction, self.symbol)
 
     def update_close_order(self, order):
         self.close_order = order
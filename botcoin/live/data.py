@@ -2,27 +2,88 @@ import datetime
 import logging
 import time
 
+import numpy as np
 import pandas as pd
 
+from botcoin import settings
 from botcoin.common.data import MarketData, Bars
 from botcoin.common.events import MarketEvent
+from botcoin.common.panel import MarketPanel, RingBuffer, OPEN, HIGH, LOW, CLOSE, VOLUME
 
 class LiveMarketData(MarketData):
     def __init__(self, csv_dir, symbol_list, normalize_prices, normalize_volume, round_decimals,
-                 exchange, sec_type, currency):
-        super(LiveMarketData, self).__init__(csv_dir, symbol_list, normalize_prices, normalize_volume, round_decimals)
+                 exchange, sec_type, currency, data_cache=settings.DATA_CACHE, load_workers=settings.LOAD_WORKERS,
+                 max_lookback=settings.MAX_LOOKBACK):
+        super(LiveMarketData, self).__init__(csv_dir, symbol_list, normalize_prices, normalize_volume, round_decimals,
+                                             data_cache, load_workers, max_lookback)
 
         self.exchange = exchange
         self.sec_type = sec_type
         self.currency = currency
 
-        # Adds 'df' to 'latest_bars' as list of lists, just as in historical update_bars
-        for s in self.symbol_list:
-            self._data[s]['latest_bars'] = self._data[s]['df'].reset_index()[['index', 'open', 'high', 'low', 'close', 'volume']].values.tolist()
+        # Historical bars are kept in a fixed size ring buffer, holding MAX_LOOKBACK
+        # bars or all loaded bars if there is no limit, and today's bar is built
+        # from live data and added to history once the day is over
+        self._history = RingBuffer.from_panel(self._panel, self.max_lookback or max(len(self._panel), 1))
+        self._panel = None
+
+        self._today_values = np.full((len(self.symbol_list), len(MarketPanel.FIELDS)), np.nan)
+        self._today_datetime = [None] * len(self.symbol_list)
+        self._bid = np.full(len(self.symbol_list), np.nan)
+        self._ask = np.full(len(self.symbol_list), np.nan)
 
         # Last datetime in historical data which can be from
         # any symbol (doesn't matter as all symbols share same index)
-        self.last_historical_bar_at = self._data[self.symbol_list[0]]['latest_bars'][-1][0]
+        self.last_historical_bar_at = pd.Timestamp(self._history.tail(1)[0][-1])
+
+    @classmethod
+    def attach(cls, handle, max_lookback=settings.MAX_LOOKBACK):
+        raise NotImplementedError("Live markets load their own history, only backtests can attach to published data.")
+
+    def _today(self, i):
+        if self._today_datetime[i] is not None:
+            return self._today_datetime[i], self._today_values[i]
+
+    def _window(self, i, N, include_today):
+        if not include_today:
+            datetimes, values = self._history.tail(N)
+            return datetimes, values[:, i]
+
+        today = self._today(i)
+        if not today or N < 1:
+            return self._history.datetime_values[:0], self._history.values[:0, i]
+
+        datetimes, values = self._history.tail(N - 1)
+        return (np.append(datetimes, np.datetime64(today[0], 'ns')),
+                np.vstack((values[:, i], today[1])))
+
+    def _panel_window(self, N, include_today):
+        if not include_today:
+            return self._history.tail(N)
+
+        if N < 1 or all(d is None for d in self._today_datetime):
+            return self._history.datetime_values[:0], self._history.values[:0]
+
+        # Symbols without prices today are left as nan, so they're not valid
+        datetimes, values = self._history.tail(N - 1)
+        return (np.append(datetimes, np.datetime64(self.updated_at, 'ns')),
+                np.concatenate((values, self._today_values[None])))
+
+    def _new_day(self):
+        """ Moves today's bars into history, padding symbols without prices
+        with last close, and starts a new empty bar for every symbol. """
+        today = self._today_values
+        last_close = self._history.tail(1)[1][-1, :, CLOSE]
+
+        today[:, CLOSE] = np.where(np.isnan(today[:, CLOSE]), last_close, today[:, CLOSE])
+        for f in (OPEN, HIGH, LOW):
+            today[:, f] = np.where(np.isnan(today[:, f]), today[:, CLOSE], today[:, f])
+        today[:, VOLUME] = np.where(np.isnan(today[:, VOLUME]), 0, today[:, VOLUME])
+
+        self._history.append(np.datetime64(self.updated_at.normalize(), 'ns'), today)
+
+        self._today_values = np.full_like(today, np.nan)
+        self._today_datetime = [None] * len(self.symbol_list)
 
     def _stop(self):
         self.if_socket.eDisconnect()
@@ -31,45 +92,52 @@ class LiveMarketData(MarketData):
         self.if_socket.subscribe_to_market_data(symbol, self.exchange, self.sec_type, self.currency)
 
     def _update_last_price(self, symbol, price):
+        i = self._symbols[symbol]
+        today = self._today_values[i]
+
+        self._last_price[i] = price
+        self.price_version += 1
 
-        self._data[symbol]['last_price'] = price
+        if np.isnan(today[HIGH]) or price > today[HIGH]:
+            today[HIGH] = price
 
-        if not 'high' in self._data[symbol]:
-            self._data[symbol]['high'] = price
-        elif price > self._data[symbol]['high']:
-            self._data[symbol]['high'] = price
+        if np.isnan(today[LOW]) or price < today[LOW]:
+            today[LOW] = price
 
-        if not 'low' in self._data[symbol]:
-            self._data[symbol]['low'] = price
-        elif price < self._data[symbol]['low']:
-            self._data[symbol]['low'] = price
+        if np.isnan(today[OPEN]):
+            today[OPEN] = price
 
-        if not 'open' in self._data[symbol]:
-            self._data[symbol]['open'] = price
+        today[CLOSE] = price
 
         self._relay_market_event(MarketEvent('during', symbol))
 
     def _update_volume(self, symbol, size):
-        self._data[symbol]['volume'] = size
+        self._today_values[self._symbols[symbol], VOLUME] = size
 
     def _update_ask_price(self, symbol, price):
-        self._data[symbol]['ask'] = price
+        self._ask[self._symbols[symbol]] = price
 
     def _update_bid_price(self, symbol, price):
-        self._data[symbol]['bid'] = price
+        self._bid[self._symbols[symbol]] = price
 
     def _update_high_price(self, symbol, price):
-        self._data[symbol]['high'] = price
+        self._today_values[self._symbols[symbol], HIGH] = price
 
     def _update_low_price(self, symbol, price):
-        self._data[symbol]['low'] = price
+        self._today_values[self._symbols[symbol], LOW] = price
 
     def _update_open_price(self, symbol, price):
-        self._data[symbol]['open'] = price
+        self._today_values[self._symbols[symbol], OPEN] = price
 
     def _update_last_timestamp(self, symbol, timestamp):
-        self._data[symbol]['updated_at'] = timestamp
         self._update_datetime(int(timestamp))
+        self._today_datetime[self._symbols[symbol]] = self.updated_at
 
     def _update_datetime(self, timestamp):
-        self.updated_at = pd.Timestamp(datetime.datetime.fromtimestamp(timestamp))
+        updated_at = pd.Timestamp(datetime.datetime.fromtimestamp(timestamp))
+
+        # Market data from a new day, so yesterday's bars become history
+        if any(d is not None for d in self._today_datetime) and updated_at.date() > self.updated_at.date():
+            self._new_day()
+
+        self.updated_at = updated_at
@@ -20,6 +20,9 @@ class LiveEngine(object):
             exchange = getattr(strategy, 'EXCHANGE', settings.EXCHANGE),
             sec_type = getattr(strategy, 'SEC_TYPE', settings.SEC_TYPE),
             currency = getattr(strategy, 'CURRENCY', settings.CURRENCY),
+            data_cache = getattr(strategy, 'DATA_CACHE', settings.DATA_CACHE),
+            load_workers = getattr(strategy, 'LOAD_WORKERS', settings.LOAD_WORKERS),
+            max_lookback = getattr(strategy, 'MAX_LOOKBACK', settings.MAX_LOOKBACK),
         )
 
         self.portfolio = LivePortfolio(self.market, strategy)
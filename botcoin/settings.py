@@ -6,6 +6,49 @@ NORMALIZE_PRICES = True
 # Normalize volume based on relation between adj_close and close
 NORMALIZE_VOLUME = False
 
+# Keeps parsed csvs as .npz files in DATA_CACHE_DIR (inside the data directory),
+# rebuilt whenever a csv or any of the settings used to parse it change
+DATA_CACHE = True
+DATA_CACHE_DIR = '.botcoin_cache'
+
+# Number of processes used to read csvs, 1 reads them sequentially
+LOAD_WORKERS = 1
+
+# Number of processes strategies are split between when backtesting, 1 runs
+# them all in the current process. Workers are forked, so market data is only loaded once
+BACKTEST_WORKERS = 1
+
+# Relays a single MarketEvent per phase (open, during, close) carrying all
+# symbols, instead of one per symbol, so portfolios handle their queue once per phase
+BATCH_EVENTS = True
+# When batched, orders raised for a symbol are executed before the next symbol
+# is handled, giving the same fills as one event per symbol. Turning it off
+# executes a whole phase's orders together, which only changes results for
+# strategies that look at cash or positions while a phase is running
+STRICT_EVENT_ORDER = True
+
+# Backtest portfolios keep a running market value of open trades, updated on
+# fills and for held symbols on price phases, and cash reserved by pending orders
+# between fills. Checking recomputes both from scratch on every call and raises if
+# they differ, which is slow
+CHECK_MARK_TO_MARKET = False
+
+# Pruning rules for sweeps. Portfolios hitting any of them stop being
+# backtested and their performance is marked as truncated. 0 disables a rule
+# Drawdown of total from its highest value, as a fraction (e.g. 0.5)
+PRUNE_MAX_DRAWDOWN = 0
+# Total as a fraction of INITIAL_CAPITAL
+PRUNE_MIN_EQUITY = 0
+# Every PRUNE_EVERY_BARS bars, portfolios whose total is below this percentile
+# of the ones still running (successive halving with 50). Ranking needs every
+# portfolio in one process, so BACKTEST_WORKERS is ignored when it's set
+PRUNE_PERCENTILE = 0
+PRUNE_EVERY_BARS = 0
+
+# Maximum number of bars strategies look back with bars() and past_bars().
+# Live markets only keep this many bars of history. 0 means no limit
+MAX_LOOKBACK = 0
+
 # Stuff used for live stuff
 CURRENCY = 'AUD'
 EXCHANGE = 'ASX'
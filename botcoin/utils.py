@@ -85,13 +85,29 @@ def _grab_settings_from_strategy(strategy):
     d['MAX_SHORT_POSITIONS'] = floor(getattr(strategy, 'MAX_SHORT_POSITIONS', settings.MAX_SHORT_POSITIONS))
     d['POSITION_SIZE'] = getattr(strategy, 'POSITION_SIZE', 1.0/d['MAX_LONG_POSITIONS'] if d['MAX_LONG_POSITIONS'] else 1.0/d['MAX_SHORT_POSITIONS'])
     d['ADJUST_POSITION_DOWN'] = getattr(strategy, 'ADJUST_POSITION_DOWN', settings.ADJUST_POSITION_DOWN)
+    d['STRICT_EVENT_ORDER'] = getattr(strategy, 'STRICT_EVENT_ORDER', settings.STRICT_EVENT_ORDER)
+    d['CHECK_MARK_TO_MARKET'] = getattr(strategy, 'CHECK_MARK_TO_MARKET', settings.CHECK_MARK_TO_MARKET)
+    d['PRUNE_MAX_DRAWDOWN'] = getattr(strategy, 'PRUNE_MAX_DRAWDOWN', settings.PRUNE_MAX_DRAWDOWN)
+    d['PRUNE_MIN_EQUITY'] = getattr(strategy, 'PRUNE_MIN_EQUITY', settings.PRUNE_MIN_EQUITY)
     d['THRESHOLD_DANGEROUS_TRADE'] = getattr(strategy, 'THRESHOLD_DANGEROUS_TRADE', settings.THRESHOLD_DANGEROUS_TRADE)
     d['ROUND_DECIMALS'] = ROUND_DECIMALS = getattr(strategy, 'ROUND_DECIMALS', settings.ROUND_DECIMALS)
     d['ROUND_DECIMALS_BELOW_ONE'] = ROUND_DECIMALS_BELOW_ONE = getattr(strategy, 'ROUND_DECIMALS_BELOW_ONE', settings.ROUND_DECIMALS_BELOW_ONE)
     return d
 
 def _round(value):
+    if isinstance(value, np.ndarray):
+        return np.where(value >= 1, np.round(value, ROUND_DECIMALS), np.round(value, ROUND_DECIMALS_BELOW_ONE))
     if value >= 1:
         return np.round(value, ROUND_DECIMALS)
     else:
         return np.round(value, ROUND_DECIMALS_BELOW_ONE)
+
+def _near_rounding_boundary(value, tolerance=1e-9):
+    """ True if value is close enough to a boundary of _round that tiny
+    floating point differences could make it round differently. """
+    value = abs(value)
+    if abs(value - 1) <= tolerance:
+        return True
+    decimals = ROUND_DECIMALS if value >= 1 else ROUND_DECIMALS_BELOW_ONE
+    scaled = value * 10**decimals
+    return abs(scaled - np.floor(scaled) - 0.5) <= tolerance * max(scaled, 1)
@@ -12,9 +12,13 @@ class DonchianStrategy(botcoin.Strategy):
         self.upper = self.get_arg(0, 50)
         self.lower = self.get_arg(1, 5)
 
+        # Computed once for the whole backtest instead of on every bar, live
+        # markets compute them from history when asked
+        self.INDICATORS = ['donchian_high_{}'.format(self.upper), 'donchian_low_{}'.format(self.lower)]
+
     def close(self, s):
-        upband = max(self.market.past_bars(s, self.upper).high)
-        lwband = min(self.market.past_bars(s, self.lower).low)
+        upband = self.market.indicator(s, 'donchian_high_{}'.format(self.upper))
+        lwband = self.market.indicator(s, 'donchian_low_{}'.format(self.lower))
 
         today = self.market.today(s)
 
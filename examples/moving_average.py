@@ -1,4 +1,7 @@
+import numpy as np
+
 import botcoin
+from botcoin.common.indicators import compute_indicator
 
 class MovingAverage(botcoin.Strategy):
     def initialize(self):
@@ -11,17 +14,36 @@ class MovingAverage(botcoin.Strategy):
         self.slow = self.get_arg(1, 15)
 
     def after_close(self):
+        # Moving averages of all symbols at once, symbols without enough bars are skipped
+        fast, fast_valid = self.market.panel_mavg(self.fast)
+        slow, slow_valid = self.market.panel_mavg(self.slow)
+        columns = {s: i for i, s in enumerate(self.market.symbol_list)}
+
         for symbol in self.SYMBOL_LIST:
-            try:
-                slow = self.market.bars(symbol, self.slow).mavg('close')
-                fast = self.market.bars(symbol, self.fast).mavg('close')
-
-                if fast > slow:
-                    self.buy(symbol)
-                if fast < slow:
-                    self.sell(symbol)
-            except botcoin.BarError as e:
-                pass
+            i = columns[symbol]
+            if not (fast_valid[i] and slow_valid[i]):
+                continue
+
+            if fast[i] > slow[i]:
+                self.buy(symbol)
+            if fast[i] < slow[i]:
+                self.sell(symbol)
+
+    def signals(self, panel):
+        # Same crossover for VectorBacktestEngine (backtest_algo.py -x)
+        fast = compute_indicator(panel.values, 'sma_{}'.format(self.fast))
+        slow = compute_indicator(panel.values, 'sma_{}'.format(self.slow))
+        return fast > slow, fast < slow
+
+    @classmethod
+    def grid_signals(cls, panel, strategies):
+        # Whole sweep at once for GridBacktestEngine (backtest_algo.py -p), each
+        # moving average is only computed once
+        windows = set(n for s in strategies for n in (s.fast, s.slow))
+        sma = {n: compute_indicator(panel.values, 'sma_{}'.format(n)) for n in windows}
+        fast = np.array([sma[s.fast] for s in strategies])
+        slow = np.array([sma[s.slow] for s in strategies])
+        return fast > slow, fast < slow
 
 
 # strategies = [MovingAverage(5,i) for i in botcoin.optimize((5,100,5))]
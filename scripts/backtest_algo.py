@@ -12,17 +12,25 @@ def main():
     parser.add_argument('-g', '--graph_equity', action='store_true', help='graph equity curve')
     parser.add_argument('-s', '--graph_subscriptions', action='store_true', help='graph symbol subscriptions')
     parser.add_argument('-a', '--all_trades', action='store_true', help='print all_trades dataframe')
+    parser.add_argument('-x', '--vectorized', action='store_true', help='backtest signals() of strategies with VectorBacktestEngine')
+    parser.add_argument('-p', '--grid', action='store_true', help='backtest signals() or grid_signals() of strategies together with GridBacktestEngine')
+    parser.add_argument('-w', '--workers', type=int, default=botcoin.settings.BACKTEST_WORKERS, help='number of processes strategies are split between')
     parser.add_argument('-v', '--verbose', action='store_true', help='verbose (very chatty, be careful)')
     args = parser.parse_args()
 
     botcoin.utils._basic_config(args.verbose)
+    botcoin.settings.BACKTEST_WORKERS = args.workers
 
     for f in args.algo_file:
 
         logging.info("Reading strategies from {}".format(f))
 
         # Run backtest
-        backtest = botcoin.BacktestEngine(botcoin.utils._find_strategies(f), args.data_dir)
+        if args.grid:
+            engine = botcoin.GridBacktestEngine
+        else:
+            engine = botcoin.VectorBacktestEngine if args.vectorized else botcoin.BacktestEngine
+        backtest = engine(botcoin.utils._find_strategies(f), args.data_dir)
 
         print(backtest.results)
 
@@ -1,19 +1,45 @@
 import os
+from math import ceil, floor
+import queue
 import unittest
 
+import numpy as np
+import pandas as pd
+
 import botcoin
+from botcoin.backtest.data import BacktestMarketData
+from botcoin.backtest.portfolio import BacktestPortfolio
+from botcoin.common import performance
+from botcoin.common.events import EventQueue, MarketEvent, SignalEvent, OrderEvent, FillEvent
+from botcoin.common.holdings import HoldingsRecorder
+from botcoin.common.risk import RiskAnalysis
+
+DATADIR = os.path.join(os.getcwd(),'tests/test-data/')
+
+def backtest(strategies, engine_class=botcoin.BacktestEngine, market=None, **settings):
+    """ Backtests new instances of strategies, or of the ones in a strategies
+    file, with settings set on each, optionally on an already loaded market.
+    Modules are only imported once, so their strategies can't be reused
+    between backtests. """
+    if isinstance(strategies, str):
+        strategies = botcoin.utils._find_strategies(strategies)
+    strategies = [type(s)(*s.args, **s.kwargs) for s in strategies]
+    for strategy in strategies:
+        for name, value in settings.items():
+            setattr(strategy, name, value)
+    return engine_class(strategies, DATADIR, market=market)
+
 
 class TestBacktestResults(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        datadir = os.path.join(os.getcwd(),'tests/test-data/')
         d = 'tests/test-strategies/'
 
-        cls.backtest_1 = botcoin.BacktestEngine(botcoin.utils._find_strategies(d+'1.py'), datadir)
-        cls.backtest_2 = botcoin.BacktestEngine(botcoin.utils._find_strategies(d+'2.py'), datadir)
-        cls.backtest_3 = botcoin.BacktestEngine(botcoin.utils._find_strategies(d+'3.py'), datadir)
-        cls.backtest_4 = botcoin.BacktestEngine(botcoin.utils._find_strategies(d+'4.py'), datadir)
+        cls.backtest_1 = botcoin.BacktestEngine(botcoin.utils._find_strategies(d+'1.py'), DATADIR)
+        cls.backtest_2 = botcoin.BacktestEngine(botcoin.utils._find_strategies(d+'2.py'), DATADIR)
+        cls.backtest_3 = botcoin.BacktestEngine(botcoin.utils._find_strategies(d+'3.py'), DATADIR)
+        cls.backtest_4 = botcoin.BacktestEngine(botcoin.utils._find_strategies(d+'4.py'), DATADIR)
 
     def test_backtest_1(self):
         p = self.backtest_1.portfolios[0].performance
@@ -69,3 +95,658 @@ class TestBacktestResults(unittest.TestCase):
         self.assertEqual(p['pct_trades_profit'], 0.3356164383561644)
         self.assertTrue(p['dangerous'])
         self.assertEqual(p['dd_max'], 20.876631733774534)
+
+
+# Moving average crossover of the example, with its signals and grid_signals
+MovingAverage = type(botcoin.utils._find_strategies('examples/moving_average.py', load_default_only=True)[0])
+
+class SignalsMovingAverage(MovingAverage):
+    """ The example's moving average crossover on test data, written both as
+    signals and as an event driven strategy executing the same signals on
+    after_close. """
+    def initialize(self):
+        super(SignalsMovingAverage, self).initialize()
+        self.SYMBOL_LIST = ['AMP','ANZ','BHP','BXB','CBA','CSL','IAG','MQG','NAB','ORG','QBE','RIO','SCG','SUN','TLS','WBC','WES','WFD','WOW','WPL']
+
+        self.DATE_FROM = '2014'
+        self.DATE_TO = '2015'
+
+    def after_close(self):
+        if not hasattr(self, 'entries'):
+            self.entries, self.exits = self.signals(self.market._panel)
+
+        t = self.market._cursor
+        for i, symbol in enumerate(self.market.symbol_list):
+            if self.entries[t, i]:
+                self.buy(symbol)
+            if self.exits[t, i]:
+                self.sell(symbol)
+
+
+class TestVectorBacktest(unittest.TestCase):
+
+    def test_matches_event_driven_backtest(self):
+        strategies = [SignalsMovingAverage(3, 10), SignalsMovingAverage(5, 20)]
+
+        events = backtest(strategies)
+        vector = backtest(strategies, botcoin.VectorBacktestEngine)
+
+        self.assertEqual(list(events.results['strategy']), list(vector.results['strategy']))
+        for e, v in zip(events.portfolios, vector.portfolios):
+            p, q = e.performance, v.performance
+            self.assertEqual(set(p), set(q))
+            for key in ('total_return', 'ann_return', 'sharpe', 'trades', 'pct_trades_profit', 'dangerous', 'dd_max', 'dd_duration'):
+                self.assertEqual(p[key], q[key])
+
+            columns = ['cash', 'commission', 'total', 'open_trades', 'subscribed_symbols']
+            self.assertTrue(p['all_holdings'][columns].equals(q['all_holdings'][columns]))
+            columns = ['symbol', 'pnl', 'quantity', 'open_price', 'close_price', 'commission']
+            self.assertTrue(p['all_trades'][columns].equals(q['all_trades'][columns]))
+
+            # Holdings are recorded the same way by both portfolios
+            self.assertEqual(len(e.all_holdings), len(v.all_holdings))
+            self.assertTrue(e.all_holdings.frame().equals(v.all_holdings.frame()))
+
+    def test_signals_shape(self):
+        class WrongSignals(SignalsMovingAverage):
+            def signals(self, panel):
+                return [True], [False]
+
+        with self.assertRaises(ValueError):
+            botcoin.VectorBacktestEngine([WrongSignals()], DATADIR)
+
+
+class TestParallelBacktest(unittest.TestCase):
+
+    def test_pool_matches_single_process(self):
+        strategies = [SignalsMovingAverage(f, s) for f in (3, 5) for s in (10, 20)]
+
+        single = backtest(strategies)
+        pooled = backtest(strategies, BACKTEST_WORKERS=3)
+
+        self.assertTrue(single.results.equals(pooled.results))
+        for s, p in zip(single.portfolios, pooled.portfolios):
+            self.assertTrue(s.performance['all_holdings'].equals(p.performance['all_holdings']))
+
+            # Trades, holdings and fills come back from workers too
+            self.assertEqual([t.pnl for t in s.all_trades], [t.pnl for t in p.all_trades])
+            self.assertTrue(s.all_holdings.frame().equals(p.all_holdings.frame()))
+            self.assertEqual(s.ledger, p.ledger)
+
+        # Market in this process is left untouched by workers
+        self.assertEqual(pooled.market._cursor, -1)
+
+
+class TestBatchedEvents(unittest.TestCase):
+
+    def backtest(self, batch_events, strict_event_order):
+        return backtest('tests/test-strategies/1.py', DATE_FROM='2013', DATE_TO='2014',
+                        BATCH_EVENTS=batch_events, STRICT_EVENT_ORDER=strict_event_order)
+
+    def test_batched_matches_per_symbol_events(self):
+        per_symbol = self.backtest(False, True)
+
+        for strict_event_order in (True, False):
+            batched = self.backtest(True, strict_event_order)
+            self.assertTrue(per_symbol.results.equals(batched.results))
+
+            columns = ['symbol', 'pnl', 'quantity', 'open_price', 'close_price', 'commission']
+            self.assertTrue(per_symbol.portfolios[0].performance['all_trades'][columns].equals(
+                batched.portfolios[0].performance['all_trades'][columns]))
+
+    def test_subscriptions_during_phase(self):
+        class Subscriber(botcoin.Strategy):
+            def initialize(self):
+                self.SYMBOL_LIST = ['AMP', 'BHP', 'CBA']
+                self.DATE_FROM, self.DATE_TO = '2014-01', '2014-02'
+                self.calls = []
+
+            def before_open(self):
+                self.subscribe('AMP')
+
+            def open(self, symbol):
+                self.calls.append((self.market.updated_at, symbol))
+                # Symbols subscribed to while handling a phase still get it
+                self.subscribe('CBA')
+
+        calls = []
+        for batch_events in (False, True):
+            strategy = Subscriber()
+            strategy.BATCH_EVENTS = batch_events
+            botcoin.BacktestEngine([strategy], DATADIR)
+            calls.append(strategy.calls)
+
+        self.assertEqual(calls[0], calls[1])
+        self.assertEqual([s for _, s in calls[1][:2]], ['AMP', 'CBA'])
+
+    def test_subscriptions_before_and_after_symbol(self):
+        class Subscriber(botcoin.Strategy):
+            def initialize(self):
+                self.SYMBOL_LIST = ['AMP', 'BHP', 'CBA', 'WPL']
+                self.DATE_FROM, self.DATE_TO = '2014-01', '2014-02'
+                self.calls = []
+
+            def before_open(self):
+                self.subscribe('BHP')
+                self.subscribe('WPL')
+
+            def open(self, symbol):
+                self.calls.append((self.market.updated_at, symbol))
+                if symbol == 'BHP':
+                    # AMP was already handled, CBA comes before WPL
+                    self.subscribe('CBA')
+                    self.subscribe('AMP')
+
+        calls = []
+        for batch_events in (False, True):
+            strategy = Subscriber()
+            strategy.BATCH_EVENTS = batch_events
+            botcoin.BacktestEngine([strategy], DATADIR)
+            calls.append(strategy.calls)
+
+        self.assertEqual(calls[0], calls[1])
+        self.assertEqual([s for _, s in calls[1][:3]], ['BHP', 'CBA', 'WPL'])
+
+
+class TestSkippedHooks(unittest.TestCase):
+
+    def test_only_overridden_hooks_get_events(self):
+
+        class OnClose(botcoin.Strategy):
+            def initialize(self):
+                self.SYMBOL_LIST = ['AMP', 'BHP', 'WPL']
+
+            def close(self, symbol):
+                pass
+
+        self.assertEqual(SignalsMovingAverage()._overridden_hooks(), {'after_close'})
+        self.assertEqual(OnClose()._overridden_hooks(), {'close'})
+        market = BacktestMarketData(DATADIR, ['AMP', 'BHP', 'WPL'], True, False, 2, '2014', '2014', batch_events=False)
+        after_close = BacktestPortfolio(market, SignalsMovingAverage())
+        on_close = BacktestPortfolio(market, OnClose())
+
+        # before_open, close for each symbol and after_close
+        self.assertEqual(len(list(market._update_bars())), 5)
+        self.assertEqual(after_close.events_queue.qsize(), 2)
+        self.assertEqual(on_close.events_queue.qsize(), 5)
+
+        market.events_queue_list.remove(on_close.events_queue)
+        self.assertEqual(len(list(market._update_bars())), 2)
+
+
+class TestSubscriptionRouting(unittest.TestCase):
+
+    def test_unsubscribed_symbols_are_not_relayed(self):
+
+        class OnlyBHP(botcoin.Strategy):
+            def initialize(self):
+                self.SYMBOL_LIST = ['AMP', 'BHP', 'WPL']
+
+            def before_open(self):
+                self.unsubscribe('AMP')
+                self.unsubscribe('WPL')
+
+            def close(self, symbol):
+                self.closed.append(symbol)
+        for batch_events in (True, False):
+            market = BacktestMarketData(DATADIR, ['AMP', 'BHP', 'WPL'], True, False, 2, '2014', '2014', batch_events=batch_events)
+            strategy = OnlyBHP()
+            portfolio = BacktestPortfolio(market, strategy)
+
+            for day in range(3):
+                strategy.closed = []
+                phases = 0
+                for _ in market._update_bars():
+                    phases += 1
+                    if phases == 2:
+                        # close is the only phase and only carries BHP
+                        event = portfolio.events_queue.queue[0]
+                        self.assertEqual(event.symbols or [event.symbol], ['BHP'])
+                    portfolio.run_cycle()
+
+                self.assertEqual(phases, 3)
+                self.assertEqual(strategy.closed, ['BHP'])
+                self.assertEqual(portfolio.holdings['subscribed_symbols'], 1)
+
+    def test_assigned_subscriptions_are_routed(self):
+
+        class Assigned(botcoin.Strategy):
+            def initialize(self):
+                self.SYMBOL_LIST = ['AMP', 'BHP', 'WPL']
+
+            def open(self, symbol):
+                self.subscribed_symbols = {'BHP', 'WPL'}
+
+            def close(self, symbol):
+                self.unsubscribe_all = True
+
+        market = BacktestMarketData(DATADIR, ['AMP', 'BHP', 'WPL'], True, False, 2, '2014', '2014')
+        portfolio = BacktestPortfolio(market, Assigned())
+        queue = portfolio.events_queue
+
+        # Routing follows subscriptions assigned after it was first worked out
+        bars = market._update_bars()
+        for phase in ('before_open', 'open', 'close'):
+            next(bars)
+            self.assertEqual(queue.queue[0].sub_type, phase)
+            portfolio.run_cycle()
+        self.assertEqual(market._subscribed_symbols(queue), [])
+
+
+class TestEventQueue(unittest.TestCase):
+
+    def test_priority_then_creation_order(self):
+        market = [MarketEvent('close', s) for s in ('AMP', 'BHP')]
+        signals = [SignalEvent(s, 'BUY', 1.0) for s in ('AMP', 'BHP', 'CBA')]
+        order = OrderEvent(signals[0], 'AMP', 100, 'BUY', 1.0, 100.0)
+        fill = FillEvent('AMP', 'BUY', 100, 1.0, 6.0)
+
+        for events_queue in (EventQueue(), queue.PriorityQueue()):
+            for e in market + signals + [order, fill]:
+                events_queue.put(e)
+
+            self.assertEqual(events_queue.qsize(), 7)
+            handled = [events_queue.get(False) for _ in range(7)]
+            self.assertEqual(handled, [order, fill] + signals + market)
+            self.assertTrue(events_queue.empty())
+            with self.assertRaises(queue.Empty):
+                events_queue.get(False)
+
+        with self.assertRaises(AttributeError):
+            market[0].unknown = True
+
+
+class TestInlineFills(unittest.TestCase):
+
+    def test_ledger_matches_holdings_and_trades(self):
+        portfolio = backtest('tests/test-strategies/3.py').portfolios[0]
+        ledger = pd.DataFrame(portfolio.ledger, columns=portfolio.LEDGER_COLUMNS)
+
+        trades = portfolio.performance['all_trades']
+        holdings = portfolio.performance['all_holdings']
+        self.assertEqual(len(ledger), 2*len(trades) - len(portfolio.open_trades))
+        self.assertAlmostEqual(ledger['commission'].sum(), holdings['commission'].iloc[-1])
+        self.assertAlmostEqual(
+            portfolio.INITIAL_CAPITAL - (ledger['quantity']*ledger['price'] + ledger['commission']).sum(),
+            holdings['cash'].iloc[-1])
+
+        # Trades are stamped with market time of their fills
+        opened = ledger[ledger['direction'] == 'BUY']['datetime']
+        self.assertEqual(list(trades['open_datetime']), list(opened))
+        self.assertTrue(set(trades['open_datetime']) <= set(holdings.index))
+
+
+class TestPerformance(unittest.TestCase):
+
+    @staticmethod
+    def drawdown_loop(curve):
+        # Reference implementation, one bar at a time
+        hwm = [0]
+        drawdown = pd.Series(index=curve.index, dtype=float)
+        duration = pd.Series(index=curve.index, dtype=float)
+        for t in range(1, len(curve.index)):
+            hwm.append(max(hwm[t-1], curve[t]))
+            drawdown[t] = (hwm[t]-curve[t])/hwm[t]
+            duration[t] = 0 if drawdown[t] == 0 else duration[t-1]+1
+        return drawdown.max()*100, duration.max()
+
+    def test_drawdown_matches_loop(self):
+        curve = backtest('tests/test-strategies/1.py').portfolios[0].performance['equity_curve']
+        self.assertEqual(performance.drawdown(curve), self.drawdown_loop(curve))
+
+        index = pd.date_range('2015-01-01', periods=500)
+        random = np.random.RandomState(0)
+        curves = pd.DataFrame((1 + random.normal(0, 0.02, (500, 4))).cumprod(axis=0), index=index)
+        curves.iloc[0] = np.nan
+        curves.iloc[100, 1] = np.nan
+
+        dd_max, dd_duration = performance.drawdown(curves.values)
+        for k in curves:
+            self.assertEqual((dd_max[k], dd_duration[k]), self.drawdown_loop(curves[k]))
+
+    def test_stacked_curves_match_single_portfolio(self):
+        portfolios = backtest('tests/test-strategies/4.py').portfolios
+        totals = pd.DataFrame({i: p.performance['all_holdings']['total'] for i, p in enumerate(portfolios)})
+
+        stats = performance.curves_performance(totals)
+        for i, p in enumerate(portfolios):
+            for key in ('total_return', 'ann_return', 'sharpe', 'sortino', 'calmar', 'dd_max', 'dd_duration'):
+                self.assertAlmostEqual(stats[key][i], p.performance[key])
+
+    def test_trade_stats(self):
+        stats = performance.trade_stats([10.0, -5.0, 20.0, 0.0])
+        self.assertEqual(stats['trades'], 4)
+        self.assertEqual(stats['pct_trades_profit'], 0.5)
+        self.assertEqual(stats['pct_trades_loss'], 0.5)
+        self.assertEqual(stats['profit_factor'], 6.0)
+        self.assertEqual(stats['expectancy'], 6.25)
+        self.assertEqual(performance.trade_stats([])['pct_trades_profit'], 0.0)
+
+
+class TestHoldingsRecorder(unittest.TestCase):
+
+    def test_frame_matches_list_of_dicts(self):
+        holdings = [{
+            'datetime': pd.Timestamp('2015-01-01') + pd.Timedelta(days=t),
+            'cash': 1000.0 - t,
+            'commission': 0.5*t,
+            'total': 1000.0 + t,
+            'open_trades': t % 3,
+            'subscribed_symbols': 10,
+        } for t in range(10)]
+
+        recorder = HoldingsRecorder(capacity=4)
+        for holding in holdings:
+            recorder.append(holding)
+        self.assertEqual(len(recorder), 10)
+
+        frame = recorder.frame()
+        expected = pd.DataFrame(holdings).set_index('datetime')
+        pd.testing.assert_frame_equal(frame, expected)
+
+        # Columns are views of the recorder's arrays
+        self.assertTrue(np.shares_memory(frame['total'].values, recorder._floats))
+        self.assertTrue(np.shares_memory(frame['open_trades'].values, recorder._ints))
+
+
+class TestMarkToMarket(unittest.TestCase):
+
+    def test_kept_values_match_recomputed(self):
+        # Any mismatch raises AssertionError while backtesting
+        checked = backtest('tests/test-strategies/4.py', CHECK_MARK_TO_MARKET=True)
+        for portfolio in checked.portfolios:
+            self.assertTrue(portfolio.CHECK_MARK_TO_MARKET)
+            self.assertEqual(portfolio._pending_costs, {})
+            self.assertEqual(portfolio._market_value_version, checked.market.price_version)
+            self.assertEqual(set(portfolio._position_values), set(portfolio.open_trades))
+
+
+class TestPositionSizing(unittest.TestCase):
+
+    @staticmethod
+    def sizing_loop(risk, direction, adj_price, position_cash):
+        # Reference implementation, one round lot at a time
+        quantity = (-1 if direction == 'SHORT' else 1) * position_cash / adj_price
+        quantity = floor(quantity/risk.ROUND_LOT_SIZE) * risk.ROUND_LOT_SIZE if risk.ROUND_LOT_SIZE else quantity
+        commission = risk.determine_commission(quantity, adj_price)
+        while commission + quantity * adj_price > position_cash:
+            quantity -= risk.ROUND_LOT_SIZE or 1
+            commission = risk.determine_commission(quantity, adj_price)
+        return quantity, commission
+
+    def test_matches_sizing_loop(self):
+        random = np.random.RandomState(0)
+        for _ in range(200):
+            cash = float(random.choice([1e2, 1e3, 1e5])) * random.uniform(0.5, 2)
+            risk = RiskAnalysis({
+                'CAPITAL_TRADABLE_CAP': 0,
+                'POSITION_SIZE': float(random.choice([0.1, 0.2, 1.0])),
+                'ADJUST_POSITION_DOWN': True,
+                'ROUND_LOT_SIZE': int(random.choice([0, 1, 10, 100])),
+                'COMMISSION_FIXED': float(random.choice([0.0, 1.0, 9.95])),
+                'COMMISSION_PCT': float(random.choice([0.0, 0.0008, 0.001, 0.01])),
+                'COMMISSION_MIN': float(random.choice([0.0, 6.0, 50.0])),
+            }, lambda: cash, lambda: cash)
+            prices = np.round(np.exp(random.uniform(-1, 7, 10)), 4)
+            direction = 'BUY' if random.rand() < 0.8 else 'SHORT'
+
+            quantities, commissions = risk.calculate_quantities_and_commissions(direction, prices)
+            for i, price in enumerate(prices):
+                expected = self.sizing_loop(risk, direction, price, cash*risk.POSITION_SIZE)
+                sized = risk.calculate_quantity_and_commission(direction, price)
+                if expected[0] >= 0:
+                    self.assertEqual(sized, expected)
+                    self.assertEqual((quantities[i], commissions[i]), expected)
+                else:
+                    # Negative quantities (e.g. commission alone over position cash) are
+                    # solved for instead of stepped down to, which rounds differently
+                    for quantity, commission in (sized, (quantities[i], commissions[i])):
+                        self.assertAlmostEqual(quantity, expected[0])
+                        self.assertAlmostEqual(commission, expected[1])
+
+    def test_commission_over_position_cash(self):
+        risk = RiskAnalysis({
+            'CAPITAL_TRADABLE_CAP': 0,
+            'POSITION_SIZE': 1.0,
+            'ADJUST_POSITION_DOWN': True,
+            'ROUND_LOT_SIZE': 1,
+            'COMMISSION_FIXED': 0.0,
+            'COMMISSION_PCT': 0.0,
+            'COMMISSION_MIN': 6.0,
+        }, lambda: 5.0, lambda: 5.0)
+
+        # 10000 lots down from 0, without taking them off one at a time
+        self.assertEqual(risk.calculate_quantity_and_commission('BUY', 0.0001), (-10000, 6.0))
+        quantities, commissions = risk.calculate_quantities_and_commissions('BUY', [0.0001, 1.0])
+        self.assertEqual(list(quantities), [-10000, -1])
+        self.assertEqual(list(commissions), [6.0, 6.0])
+
+
+class TestGridBacktest(unittest.TestCase):
+
+    def test_matches_vector_backtest(self):
+        strategies = [SignalsMovingAverage(f, s) for f in (2, 3, 5) for s in (10, 20, 30)]
+
+        vector = backtest(strategies, botcoin.VectorBacktestEngine)
+        grid = backtest(strategies, botcoin.GridBacktestEngine)
+
+        self.assertEqual(list(vector.results['strategy']), list(grid.results['strategy']))
+        for v, g in zip(vector.portfolios, grid.portfolios):
+            p, q = v.performance, g.performance
+            self.assertEqual(set(p), set(q))
+            for key in ('total_return', 'ann_return', 'sharpe', 'dd_max'):
+                self.assertAlmostEqual(p[key], q[key])
+            for key in ('trades', 'pct_trades_profit', 'dangerous'):
+                self.assertEqual(p[key], q[key])
+
+            # Held positions are valued with numpy sums instead of fsum, so
+            # totals can differ in the last bits
+            columns = ['cash', 'commission', 'open_trades', 'subscribed_symbols']
+            self.assertTrue(p['all_holdings'][columns].equals(q['all_holdings'][columns]))
+            pd.testing.assert_series_equal(p['all_holdings']['total'], q['all_holdings']['total'])
+            self.assertTrue(p['all_trades'].equals(q['all_trades']))
+            self.assertEqual(type(v.all_holdings), type(g.all_holdings))
+            pd.testing.assert_frame_equal(v.all_holdings.frame(), g.all_holdings.frame())
+
+
+class TestPruning(unittest.TestCase):
+    HOLDINGS = ['cash', 'commission', 'total', 'open_trades', 'subscribed_symbols']
+
+    def test_max_drawdown(self):
+        full = backtest('tests/test-strategies/2.py')
+        pruned = backtest('tests/test-strategies/2.py', PRUNE_MAX_DRAWDOWN=0.5)
+
+        self.assertTrue(pruned.results['truncated'].all())
+        self.assertFalse(full.results['truncated'].any())
+        for f, p in zip(full.portfolios, pruned.portfolios):
+            self.assertEqual(str(f.strategy), str(p.strategy))
+            truncated_at = p.performance['truncated_at']
+            self.assertTrue(p.performance['truncated'])
+            self.assertLess(truncated_at, pruned.market.date_to)
+
+            # Holdings are the same as the full backtest's up to the day it was pruned
+            holdings = p.performance['all_holdings'][self.HOLDINGS]
+            self.assertEqual(holdings.index[-1], truncated_at)
+            self.assertTrue(holdings.equals(f.performance['all_holdings'][self.HOLDINGS].loc[:truncated_at]))
+            self.assertLess(p.performance['dd_max'], f.performance['dd_max'])
+
+    def test_percentile_of_peers(self):
+        strategies = [SignalsMovingAverage(f, s) for f in (2, 3, 5) for s in (10, 20)]
+
+        full = backtest(strategies)
+        pruned = backtest(strategies, PRUNE_PERCENTILE=50, PRUNE_EVERY_BARS=60)
+
+        # Portfolios are ranked against all of their peers, whatever the number of workers
+        with self.assertLogs(level='WARNING'):
+            pooled = backtest(strategies, PRUNE_PERCENTILE=50, PRUNE_EVERY_BARS=60, BACKTEST_WORKERS=3)
+        self.assertTrue(pooled.results.equals(pruned.results))
+
+        full = {str(portfolio.strategy): portfolio.performance for portfolio in full.portfolios}
+        truncated = pruned.results['truncated']
+        self.assertTrue(truncated.any())
+        self.assertFalse(truncated.all())
+
+        for portfolio in pruned.portfolios:
+            p, f = portfolio.performance, full[str(portfolio.strategy)]
+            self.assertEqual(set(p), set(f))
+            if p['truncated']:
+                self.assertLess(p['truncated_at'], pruned.market.date_to)
+                self.assertTrue(p['all_holdings'][self.HOLDINGS].equals(
+                    f['all_holdings'][self.HOLDINGS].loc[:p['truncated_at']]))
+            else:
+                # Portfolios left running aren't affected by their peers being pruned
+                self.assertIsNone(p['truncated_at'])
+                for key in ('total_return', 'sharpe', 'trades', 'dd_max'):
+                    self.assertEqual(p[key], f[key])
+
+
+class TestParameterSearch(unittest.TestCase):
+    RANGES = ((2, 8, 1), (10, 40, 5))
+
+    def search(self, method, budget=15, batch_size=8):
+        return botcoin.ParameterSearch(SignalsMovingAverage, self.RANGES, DATADIR, method=method, budget=budget,
+                                       batch_size=batch_size, engine_class=botcoin.VectorBacktestEngine, seed=0)
+
+    def test_engine_on_loaded_market(self):
+        strategies = [SignalsMovingAverage(3, 10), SignalsMovingAverage(5, 20)]
+
+        loaded = backtest(strategies)
+        reused = backtest(strategies, market=loaded.market)
+        self.assertTrue(loaded.results.equals(reused.results))
+        self.assertTrue(np.shares_memory(loaded.market._panel.values, reused.market._panel.values))
+
+    def test_random(self):
+        search = self.search('random')
+        results, trace = search.run()
+
+        self.assertEqual(len(trace), 15)
+        self.assertEqual(list(trace['batch'].unique()), [1, 2])
+        self.assertEqual(trace['params'].nunique(), 15)
+        self.assertEqual(sorted(results['strategy']), sorted(trace['strategy']))
+        self.assertTrue(results['sharpe'].is_monotonic_decreasing)
+        self.assertFalse(results['truncated'].any())
+
+        # Same results as backtesting parameters on their own
+        best = results.iloc[0]
+        params = trace.set_index('strategy').loc[best['strategy'], 'params']
+        single = backtest([SignalsMovingAverage(*params)], botcoin.VectorBacktestEngine).results.iloc[0]
+        self.assertTrue(best.equals(single))
+
+    def test_budget_above_combinations(self):
+        results, trace = self.search('random', budget=100).run()
+        self.assertEqual(len(trace), 36)
+        self.assertEqual(len(results), 36)
+
+    def test_halving(self):
+        search = self.search('halving')
+        results, trace = search.run()
+        bars = len(search.market._panel)
+
+        # Rungs of 8, 4, 2 and 1 backtests on twice as many bars each time
+        self.assertEqual(list(trace.groupby('batch').size()), [8, 4, 2, 1])
+        self.assertEqual(list(trace.groupby('batch')['bars'].first()), [ceil(bars/8), ceil(bars/4), ceil(bars/2), bars])
+        for batch in (2, 3, 4):
+            previous = trace[trace['batch'] == batch - 1].nlargest(len(trace[trace['batch'] == batch]), 'sharpe')
+            self.assertEqual(set(trace[trace['batch'] == batch]['params']), set(previous['params']))
+
+        self.assertEqual(len(results), 8)
+        self.assertEqual(list(results['truncated']), [False] + [True]*7)
+        self.assertEqual(results.iloc[0]['strategy'], trace.iloc[-1]['strategy'])
+
+    def test_surrogate(self):
+        results, trace = self.search('surrogate', budget=16).run()
+
+        self.assertEqual(len(trace), 16)
+        self.assertEqual(trace['params'].nunique(), 16)
+        self.assertFalse(results['truncated'].any())
+
+    def test_wrong_method(self):
+        with self.assertRaises(ValueError):
+            self.search('exhaustive')
+
+
+class TestWalkForward(unittest.TestCase):
+
+    def walk_forward(self, **kwargs):
+        return botcoin.WalkForward(SignalsMovingAverage, ((2, 8, 1), (10, 40, 5)), DATADIR, 200, 100,
+                                   engine_class=botcoin.VectorBacktestEngine, budget=6, batch_size=6, seed=0, **kwargs)
+
+    def test_windows(self):
+        walk_forward = self.walk_forward()
+        equity_curve, windows = walk_forward.run()
+        index = walk_forward.market._panel.index
+
+        # Windows of 200 train and 100 test bars, moving 100 bars each time
+        self.assertEqual(len(windows), (len(index) - 200) // 100)
+        self.assertEqual(list(windows['train from']), list(index[[0, 100, 200]]))
+        self.assertEqual(list(windows['test from']), list(index[[200, 300, 400]]))
+        self.assertEqual(list(windows['test to']), list(index[[299, 399, 499]]))
+        self.assertTrue(equity_curve.index.equals(index[200:500]))
+
+        for i, window in windows.iterrows():
+            # Parameters are the best ones of a search on train bars only
+            market = walk_forward.market.slice(window['train from'], window['train to'])
+            results, trace = botcoin.ParameterSearch(
+                SignalsMovingAverage, ((2, 8, 1), (10, 40, 5)), walk_forward.data_dir, budget=6, batch_size=6,
+                engine_class=botcoin.VectorBacktestEngine, market=market, seed=0).run()
+            self.assertEqual(window['strategy'], results.iloc[0]['strategy'])
+            self.assertEqual(window['train sharpe'], results.iloc[0]['sharpe'])
+
+            # Test window looks back on all bars before it, and its equity
+            # continues from where the previous window's ended
+            market = walk_forward.market.slice(window['test from'], window['test to'], 200 + 100*i)
+            test = botcoin.VectorBacktestEngine([SignalsMovingAverage(*window['params'])], walk_forward.data_dir,
+                                                market=market)
+            self.assertEqual(window['sharpe'], test.results.iloc[0]['sharpe'])
+            curve = test.portfolios[0].performance['all_holdings']['total'] / test.portfolios[0].INITIAL_CAPITAL
+            level = equity_curve[:window['test from']].iloc[-2] if i else 1.0
+            pd.testing.assert_series_equal(equity_curve[window['test from']:window['test to']], curve*level,
+                                           check_names=False)
+
+        self.assertAlmostEqual(walk_forward.performance['total_return'], (equity_curve.iloc[-1] - 1)*100)
+
+    def test_history_bars(self):
+        loaded = backtest([SignalsMovingAverage(3, 10)]).market
+        index = loaded._panel.index
+        market = loaded.slice(index[100], index[199], 50)
+
+        self.assertEqual(len(market._panel), 150)
+        self.assertEqual((market.date_from, market.date_to), (index[100], index[199]))
+        self.assertEqual(market.slice()._history, 50)
+        self.assertEqual(loaded.slice(index[20], index[199], 50)._history, 20)
+
+        # History bars are looked back on but not backtested, the same by every engine
+        strategies = [SignalsMovingAverage(f, 20) for f in (3, 5)]
+        events = backtest(strategies, market=market)
+        vector = backtest(strategies, botcoin.VectorBacktestEngine, market=market)
+        grid = backtest(strategies, botcoin.GridBacktestEngine, market=market)
+        for e, v, g in zip(events.portfolios, vector.portfolios, grid.portfolios):
+            holdings = e.performance['all_holdings']
+            self.assertTrue(holdings.index.equals(index[100:200]))
+            self.assertTrue(holdings.equals(v.performance['all_holdings']))
+            pd.testing.assert_frame_equal(holdings, g.performance['all_holdings'])
+
+            trades = e.performance['all_trades']
+            self.assertTrue(trades.equals(v.performance['all_trades']))
+
+        # Moving averages have history from the first bar, so trades open on it
+        # instead of once 20 bars of the window went by
+        opened = [backtest([SignalsMovingAverage(3, 20)], botcoin.VectorBacktestEngine, market=m).portfolios[0]
+                  .performance['all_trades']['open_datetime'].min() for m in (market, market.slice(history=0))]
+        self.assertEqual(opened[0], index[100])
+        self.assertGreaterEqual(opened[1], index[119])
+
+    def test_anchored(self):
+        equity_curve, windows = self.walk_forward(anchored=True).run()
+        self.assertEqual(windows['train from'].nunique(), 1)
+        self.assertEqual(len(windows), 3)
+
+    def test_pool_matches_single_process(self):
+        single = self.walk_forward(workers=1).run()
+        pooled = self.walk_forward(workers=3).run()
+        self.assertTrue(single[0].equals(pooled[0]))
+        self.assertTrue(single[1].equals(pooled[1]))
+
+    def test_short_history(self):
+        with self.assertRaises(ValueError):
+            botcoin.WalkForward(SignalsMovingAverage, ((2, 8, 1),), DATADIR, 2000, 100).run()
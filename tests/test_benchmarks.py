@@ -0,0 +1,58 @@
+import os
+import timeit
+import unittest
+
+import botcoin
+from botcoin.backtest.data import BacktestMarketData
+
+class TestBarFeedBenchmark(unittest.TestCase):
+    """
+    Per bar cost of feeding a day's prices for every symbol into the market,
+    comparing the old DataFrame.iterrows feed with the panel cursor. Timings
+    depend on the machine, so they're only shown and compared with
+    BOTCOIN_BENCHMARKS=1 (e.g. python -m pytest -s tests/test_benchmarks.py).
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        datadir = os.path.join(os.getcwd(), 'tests/test-data/')
+        cls.market = BacktestMarketData(datadir, botcoin.settings.ASX_20, True, False, 2, '2013', '2014')
+        cls.frames = {s: cls.market._panel.frame(s) for s in cls.market.symbol_list}
+        cls.bars = len(cls.market._panel) * len(cls.market.symbol_list)
+
+    def iterrows_feed(self):
+        data = {s: {'bars': df.iterrows()} for s, df in self.frames.items()}
+        try:
+            while True:
+                for s in self.market.symbol_list:
+                    new_row = next(data[s]['bars'])
+                    data[s]['updated_at'] = new_row[0]
+                    data[s]['open'] = new_row[1].iloc[0]
+                    data[s]['high'] = new_row[1].iloc[1]
+                    data[s]['low'] = new_row[1].iloc[2]
+                    data[s]['close'] = new_row[1].iloc[3]
+                    data[s]['volume'] = new_row[1].iloc[4]
+        except StopIteration:
+            pass
+
+    def cursor_feed(self):
+        self.market._cursor = self.market._rolling.cursor = -1
+        rows = 0
+        while self.market._next_bar() is not None:
+            rows += 1
+        return rows
+
+    def test_cursor_feed_rows(self):
+        # Cursor moves over each panel row once, instead of one row per symbol
+        self.assertEqual(self.cursor_feed(), len(self.market._panel))
+        self.assertEqual(self.market.updated_at, self.frames[self.market.symbol_list[0]].index[-1])
+        self.assertIsNone(self.market._next_bar())
+
+    @unittest.skipUnless(os.environ.get('BOTCOIN_BENCHMARKS'), "set BOTCOIN_BENCHMARKS=1 to compare timings")
+    def test_bar_feed(self):
+        before = min(timeit.repeat(self.iterrows_feed, number=1, repeat=3)) / self.bars
+        after = min(timeit.repeat(self.cursor_feed, number=1, repeat=3)) / self.bars
+
+        timings = "Bar feed per bar: iterrows {:.2f}us, cursor {:.3f}us".format(before*1e6, after*1e6)
+        print(timings)
+        self.assertLess(after, before, timings)
@@ -0,0 +1,355 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import botcoin
+from botcoin import settings
+from botcoin.backtest.data import BacktestMarketData
+from botcoin.common.data import Bars, MarketData
+from botcoin.common.panel import RingBuffer
+
+DATADIR = os.path.join(os.getcwd(),'tests/test-data/')
+
+# Bars are rounded with settings grabbed off a strategy, which tests without a
+# portfolio don't have
+botcoin.utils._grab_settings_from_strategy(object())
+
+class TestDataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp() + '/'
+        shutil.copy(os.path.join(DATADIR, 'AMP.csv'), self.datadir)
+        self.cache_path = os.path.join(self.datadir, settings.DATA_CACHE_DIR, 'AMP.npz')
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def test_cached_frame_matches_csv(self):
+        parsed = MarketData._read_csv(self.datadir, 'AMP.csv', True, False, 2)
+
+        cold = MarketData._read_cached_csv(self.datadir, 'AMP.csv', True, False, 2)
+        self.assertTrue(os.path.exists(self.cache_path))
+        warm = MarketData._read_cached_csv(self.datadir, 'AMP.csv', True, False, 2)
+
+        pd.testing.assert_frame_equal(parsed, cold)
+        pd.testing.assert_frame_equal(parsed, warm)
+
+    def test_cache_rebuilt_when_stale(self):
+        MarketData._read_cached_csv(self.datadir, 'AMP.csv', True, False, 2)
+
+        # Different settings
+        unnormalized = MarketData._read_cached_csv(self.datadir, 'AMP.csv', False, False, 2)
+        pd.testing.assert_frame_equal(unnormalized, MarketData._read_csv(self.datadir, 'AMP.csv', False, False, 2))
+
+        # Changed csv
+        with open(self.datadir + 'AMP.csv', 'a') as f:
+            f.write('2015-12-31,10.0,10.0,10.0,10.0,0,10.0\n')
+        changed = MarketData._read_cached_csv(self.datadir, 'AMP.csv', False, False, 2)
+        self.assertEqual(changed.index[-1], pd.Timestamp('2015-12-31'))
+        self.assertEqual(changed['close'].iloc[-1], 10.0)
+
+    def test_corrupt_cache_is_rebuilt(self):
+        os.makedirs(os.path.dirname(self.cache_path))
+        with open(self.cache_path, 'wb') as f:
+            f.write(b'not a npz file')
+
+        df = MarketData._read_cached_csv(self.datadir, 'AMP.csv', True, False, 2)
+        pd.testing.assert_frame_equal(df, MarketData._read_csv(self.datadir, 'AMP.csv', True, False, 2))
+        with np.load(self.cache_path) as cached:
+            self.assertIn('key', cached.files)
+
+
+class TestParallelLoading(unittest.TestCase):
+
+    def test_parallel_frames_match_sequential(self):
+        symbols = ['AMP', 'ANZ', 'BHP', 'CBA', '^GSPC']
+
+        sequential = MarketData(DATADIR, symbols, True, False, 2, data_cache=False, load_workers=1)
+        parallel = MarketData(DATADIR, symbols, True, False, 2, data_cache=False, load_workers=3)
+
+        comb_index = None
+        for s in symbols:
+            index = MarketData._read_csv(DATADIR, s + '.csv', True, False, 2).index
+            comb_index = comb_index.union(index) if comb_index is not None else index
+
+        np.testing.assert_array_equal(sequential._panel.values, parallel._panel.values)
+        self.assertTrue(parallel._panel.index.equals(comb_index))
+
+
+class TestMarketPanel(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.symbols = ['AMP', 'BHP', 'WPL', '^GSPC']
+
+    def test_padding_matches_dataframe_fill(self):
+        market = MarketData(DATADIR, self.symbols, True, False, 2, data_cache=False)
+        frames = market._read_all_csvs(DATADIR, True, False, 2)
+
+        for s in self.symbols:
+            df = frames[s]
+            df['volume'] = df['volume'].fillna(0)
+            df['close'] = df['close'].ffill().fillna(0)
+            for col in ['open', 'high', 'low']:
+                df[col] = df[col].fillna(df['close'])
+
+            np.testing.assert_array_equal(market._panel.frame(s).values, df[list(market._panel.FIELDS)].values)
+
+    def test_bars_follow_cursor(self):
+        market = BacktestMarketData(DATADIR, self.symbols, True, False, 2, '2014', '2014')
+        df = market._panel.frame('BHP')
+
+        for day in range(10):
+            list(market._update_bars())
+
+        self.assertEqual(market.updated_at, df.index[9])
+        self.assertEqual(market.today('BHP').close, df['close'].iloc[9])
+        self.assertEqual(market.yesterday('BHP').datetime, df.index[8])
+        self.assertEqual(market.last_price('BHP'), df['close'].iloc[9])
+        np.testing.assert_array_equal(market.past_bars('BHP', 5).close, df['close'].iloc[4:9])
+        np.testing.assert_array_equal(market.bars('BHP', 5).high, df['high'].iloc[5:10])
+        np.testing.assert_array_equal(market.bars('BHP', 5).datetime, df.index[5:10])
+        np.testing.assert_array_equal(market.bars('BHP', 1).open, [df['open'].iloc[9]])
+
+        # Bars are views of the panel, which users can't write to
+        bars = market.past_bars('BHP', 5)
+        self.assertTrue(np.shares_memory(bars.close, market._panel.values))
+        with self.assertRaises(ValueError):
+            bars.close[0] = 0.0
+
+        with self.assertRaises(botcoin.BarError):
+            market.past_bars('BHP', 10)
+
+
+class TestRollingIndicators(unittest.TestCase):
+
+    def test_rolling_matches_full_computation(self):
+        market = BacktestMarketData(DATADIR, botcoin.settings.ASX_20[:10], True, False, 2, '2014', '2014')
+
+        checked = 0
+        while market.continue_execution:
+            list(market._update_bars())
+            for s in market.symbol_list:
+                for N in (4, 5, 20):
+                    for method in (market.bars, market.past_bars):
+                        try:
+                            bars = method(s, N)
+                        except botcoin.BarError:
+                            continue
+                        full = Bars(bars._datetimes, bars._values)
+
+                        self.assertIsNotNone(bars._rolling_stats('close'))
+                        self.assertEqual(bars.mavg(), full.mavg())
+                        self.assertEqual(bars.mavg('vol'), full.mavg('vol'))
+                        self.assertEqual(bars.bollingerbands(2), full.bollingerbands(2))
+                        checked += 1
+
+        self.assertGreater(checked, 5000)
+
+
+class TestPrecomputedIndicators(unittest.TestCase):
+
+    def test_indicators_match_bars(self):
+        market = BacktestMarketData(DATADIR, ['BHP', 'CBA', 'WPL'], True, False, 2, '2014', '2014')
+        market.precompute_indicators(['sma_5', 'std_5', 'donchian_high_5', 'donchian_low_5', 'atr_5', 'sma_3_volume'])
+
+        with self.assertRaises(ValueError):
+            market.precompute_indicators(['ema_5'])
+
+        checked = 0
+        while market.continue_execution:
+            day = market._update_bars()
+            for phase in day:
+                # First yield is before_open, today's bar must not be used yet
+                for s in market.symbol_list:
+                    try:
+                        past = market.past_bars(s, 6)
+                    except botcoin.BarError:
+                        with self.assertRaises(botcoin.BarError):
+                            market.indicator(s, 'atr_5')
+                        continue
+
+                    bars = market.past_bars(s, 5)
+                    self.assertEqual(market.indicator(s, 'sma_5'), bars.mavg())
+                    self.assertEqual(market.indicator(s, 'sma_3_volume'), market.past_bars(s, 3).mavg('vol'))
+                    self.assertEqual(market.indicator(s, 'std_5'), botcoin.utils._round(np.std(bars.close)))
+                    self.assertEqual(market.indicator(s, 'donchian_high_5'), max(bars.high))
+                    self.assertEqual(market.indicator(s, 'donchian_low_5'), min(bars.low))
+
+                    true_range = [max(h - l, abs(h - c), abs(l - c)) for h, l, c in
+                                  zip(past.high[1:], past.low[1:], past.close[:-1])]
+                    self.assertAlmostEqual(market.indicator(s, 'atr_5'), np.mean(true_range), places=2)
+                    checked += 1
+                break
+            list(day)
+
+            # After close today's bar is part of indicators
+            for s in market.symbol_list:
+                try:
+                    self.assertEqual(market.indicator(s, 'sma_5'), market.bars(s, 5).mavg())
+                except botcoin.BarError:
+                    pass
+
+        self.assertGreater(checked, 500)
+
+        with self.assertRaises(ValueError):
+            market.indicator('BHP', 'sma_10')
+
+    def test_indicators_from_history(self):
+        names = ['sma_5', 'std_5', 'donchian_high_5', 'donchian_low_5', 'atr_5', 'sma_3_volume']
+        market = BacktestMarketData(DATADIR, ['BHP', 'CBA', 'WPL'], True, False, 2, '2014', '2014')
+        market.precompute_indicators(names)
+
+        # Markets without precomputed values (e.g. live) compute them from history
+        checked = 0
+        while market.continue_execution:
+            day = market._update_bars()
+            for phase in day:
+                for s in market.symbol_list:
+                    for name in names:
+                        try:
+                            expected = market.indicator(s, name)
+                        except botcoin.BarError:
+                            with self.assertRaises(botcoin.BarError):
+                                MarketData.indicator(market, s, name)
+                            continue
+                        self.assertAlmostEqual(MarketData.indicator(market, s, name), expected, places=2)
+                        checked += 1
+                break
+            list(day)
+
+        self.assertGreater(checked, 3000)
+
+
+class TestRingBuffer(unittest.TestCase):
+
+    def test_tail_matches_panel(self):
+        panel = MarketData(DATADIR, ['AMP', 'BHP'], True, False, 2, data_cache=False)._panel.slice('2014', '2014')
+
+        ring = RingBuffer(7, panel.symbol_list)
+        for t in range(len(panel)):
+            ring.append(panel.datetime_values[t], panel.values[t])
+            for N in (1, 3, 7, 10):
+                start = max(t + 1 - min(N, 7), 0)
+                datetimes, values = ring.tail(N)
+                np.testing.assert_array_equal(datetimes, panel.datetime_values[start:t+1])
+                np.testing.assert_array_equal(values, panel.values[start:t+1])
+
+        self.assertEqual(len(ring), 7)
+        self.assertEqual(ring.values.shape[0], 14)
+
+    def test_max_lookback(self):
+        market = BacktestMarketData(DATADIR, ['BHP'], True, False, 2, '2014', '2014', max_lookback=5)
+        for day in range(10):
+            list(market._update_bars())
+
+        self.assertEqual(len(market.past_bars('BHP', 5)), 5)
+        with self.assertRaises(ValueError):
+            market.past_bars('BHP', 6)
+
+
+class TestCrossSectional(unittest.TestCase):
+
+    def test_panel_bars_match_bars(self):
+        market = BacktestMarketData(DATADIR, botcoin.settings.ASX_20[:10], True, False, 2, '2014', '2014')
+
+        for day in range(30):
+            list(market._update_bars())
+
+            for method, panel_method in ((market.bars, market.panel_bars), (market.past_bars, market.past_panel_bars)):
+                for N in (1, 5, 20):
+                    values, valid = panel_method(N, 'high')
+                    for i, s in enumerate(market.symbol_list):
+                        try:
+                            bars = method(s, N)
+                        except botcoin.BarError:
+                            self.assertFalse(valid[i])
+                            continue
+                        self.assertTrue(valid[i])
+                        np.testing.assert_array_equal(values[:, i], bars.high)
+
+        with self.assertRaises(ValueError):
+            market.panel_bars(5)[0][0, 0] = 0.0
+
+        with self.assertRaises(ValueError):
+            market.panel_bars(5, 'adj_close')
+
+    def test_panel_mavg_matches_bars(self):
+        market = BacktestMarketData(DATADIR, botcoin.settings.ASX_20[:10], True, False, 2, '2014', '2014')
+
+        for day in range(30):
+            list(market._update_bars())
+
+            for N in (1, 5, 20):
+                means, valid = market.panel_mavg(N)
+                for i, s in enumerate(market.symbol_list):
+                    try:
+                        mavg = market.bars(s, N).mavg()
+                    except botcoin.BarError:
+                        self.assertFalse(valid[i])
+                        self.assertTrue(np.isnan(means[i]))
+                        continue
+                    self.assertTrue(valid[i])
+                    self.assertEqual(means[i], mavg)
+
+    def test_rank_and_top_n(self):
+        market = BacktestMarketData(DATADIR, ['AMP', 'BHP', 'CBA', 'WPL'], True, False, 2, '2014', '2014')
+        list(market._update_bars())
+
+        closes = [market.today(s).close for s in market.symbol_list]
+        expected = sorted(market.symbol_list, key=lambda s: -closes[market.symbol_list.index(s)])
+        self.assertEqual(market.top_n('close', 2), expected[:2])
+        self.assertEqual(market.top_n('close', 10), expected)
+        self.assertEqual(market.top_n('close', 2, ascending=True), expected[::-1][:2])
+
+        ranks = market.rank([3.0, np.nan, 1.0, 2.0])
+        np.testing.assert_array_equal(ranks, [1, np.nan, 3, 2])
+        self.assertEqual(market.top_n([3.0, np.nan, 1.0, 2.0], 3), ['AMP', 'WPL', 'CBA'])
+        self.assertEqual(market.top_n([3.0, np.nan, 1.0, 2.0], 3, ascending=True), ['CBA', 'WPL', 'AMP'])
+
+        with self.assertRaises(ValueError):
+            market.rank([1.0, 2.0])
+
+
+def _attached_close_sum(handle):
+    """ Attaches to a published market in a separate process. """
+    market = BacktestMarketData.attach(handle, '2014', '2014')
+    return market._panel.values.shape, float(np.nansum(market._panel.field('close')))
+
+
+class TestSharedMemory(unittest.TestCase):
+
+    def setUp(self):
+        self.market = BacktestMarketData(DATADIR, ['AMP', 'BHP', 'WPL'], True, False, 2, '2013', '2015', data_cache=False)
+        self.handle = self.market.publish()
+
+    def tearDown(self):
+        self.market.unpublish()
+
+    def test_attached_market_matches_published(self):
+        attached = BacktestMarketData.attach(self.handle)
+        self.assertEqual(attached.symbol_list, self.market.symbol_list)
+        self.assertTrue(attached._panel.index.equals(self.market._panel.index))
+        np.testing.assert_array_equal(attached._panel.values, self.market._panel.values)
+
+        with self.assertRaises(ValueError):
+            attached._panel.values[0, 0, 0] = 0.0
+
+        # Attached markets run backtests like loaded ones
+        for day in range(20):
+            list(attached._update_bars())
+            list(self.market._update_bars())
+        self.assertEqual(attached.bars('BHP', 10).mavg(), self.market.bars('BHP', 10).mavg())
+
+    def test_attach_from_another_process(self):
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            shape, close_sum = pool.apply(_attached_close_sum, (self.handle,))
+
+        expected = self.market._panel.slice('2014', '2014')
+        self.assertEqual(shape, expected.values.shape)
+        self.assertEqual(close_sum, float(np.nansum(expected.field('close'))))